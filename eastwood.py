@@ -66,6 +66,11 @@ protocol_version = 498
 # Bungeecord, Waterfall or Velocity.
 ip_forwarding = true
 
+# Number of parallel links to open between the external and internal proxy.
+# Players are spread across the links, so a retransmission on one link won't
+# stall everyone, and each link compresses its poems on its own.
+links = 1
+
 [internal]
 # Internal proxy bind address.
 bind = "127.0.0.1:41429"
@@ -73,6 +78,21 @@ bind = "127.0.0.1:41429"
 # Minecraft server address to connect to.
 minecraft = "127.0.0.1:25565"
 
+# Amount of worker processes to spread emulated clients over. The main
+# process keeps the links to the external proxy and relays each player's
+# packets to the worker that owns them. Crashed workers are restarted.
+workers = 1
+
+# Seconds between logging traffic stats of every connected external proxy.
+# Any number of external proxies can connect, each one gets its own players
+# and chunk cache. Set to 0 to disable.
+stats_interval = 300
+
+# Threads that decompress packets from the minecraft server. The server's
+# compression is undone here, so poems carry raw packets and are only
+# compressed once on their way to the external proxy.
+inflate_threads = 1
+
 [external]
 # External proxy bind address. This is what Velocity, Bungeecord
 # or Waterfall should connect to. Do not connect directly, and always
@@ -90,19 +110,150 @@ internal = "127.0.0.1:41429"
 # funky load-balancing system.
 player_limit = 65535
 
+# Amount of external proxy processes to run. Each worker listens on the bind
+# address with SO_REUSEPORT and opens its own links to the internal proxy.
+# Crashed workers are restarted. Each worker keeps its own chunk cache, on disk
+# caches are postpended with the worker index.
+workers = 1
+
+# Packets this size or larger are compressed before being sent to clients,
+# like the server's network-compression-threshold. The external proxy does
+# this itself instead of forwarding packets the server already compressed.
+# Set to -1 to disable.
+compression_threshold = 256
+
+# Threads that compress packets for clients.
+compression_threads = 2
+
+# Seconds between logging the traffic stats of the links to the internal proxy
+# and of the duplicate packet filter. Every worker logs its own. Set to 0 to
+# disable.
+stats_interval = 300
+
+[poem]
+# Packets that are merged when several of them for the same player and entity
+# end up in one poem. Relative moves are summed, only the latest value of the
+# others is sent. Spawns, destroys and respawns are never reordered with them.
+# Set to [] to disable.
+coalesce = ["entity_relative_move", "entity_look_and_relative_move", "entity_look", "entity_teleport", "entity_head_look", "entity_velocity", "update_health"]
+
+# Send packets that are queued for several players with identical contents
+# (time updates, chat, tab list, entities everyone can see) only once, with
+# a list of players the other proxy hands it to.
+multicast = true
+
+# Amount of packets both proxies remember per link, so a packet that repeats
+# exactly (entity metadata, attributes, scoreboard and boss bar refreshes)
+# is sent as a short reference instead. Set to 0 to disable.
+reference_slots = 4096
+
+# Only packets of this size range (in bytes) are remembered. Smaller ones
+# aren't worth it, larger ones would take too much memory.
+reference_min_size = 32
+reference_max_size = 65536
+
+# How poems are laid out before compression. "rows" packs every packet with
+# its player, "columns" packs all players, packet names, lengths and packet
+# data separately. Columns are smaller before compression and decode faster
+# for large poems, compressed sizes are about the same. The receiving proxy
+# understands both, so this only needs to be set on the sending side.
+layout = "rows"
+
+# Unpack the bit packed block arrays of chunks the internal proxy sends into
+# one byte (or two for large palettes) per block, which compresses better.
+# The external proxy rebuilds the exact original packet. Transcoding is done
+# in a thread pool, chunks that wouldn't come out the same are sent as is.
+transcode_chunks = true
+
+[datagram]
+# Send packets that are superseded within milliseconds (movement, looking,
+# velocity) over UDP as well, so a lost TCP segment doesn't hold them up.
+# Datagrams use the same port number as the internal proxy's bind address
+# and the same AES secret. Stale packets are dropped by the receiver, lost
+# ones are resent in the next poem. Both proxies need the same settings.
+enabled = false
+
+# Packets that can be sent as datagrams. Only packets that carry absolute
+# state should be listed, relative moves can't be dropped or reordered.
+# Server teleports (player_position_and_look) must stay in order with
+# respawns and teleport confirms, so they always go over the link. Datagrams
+# for an entity are held until the spawn and moves sent before them arrived.
+packets = ["entity_teleport", "entity_look", "entity_head_look", "entity_velocity", "player_position", "player_look"]
+
+# Datagrams that aren't acked after this many milliseconds are resent in the
+# next poem, unless a newer packet for the same entity was sent since.
+ack_timeout_ms = 150
+
+# Chance of dropping a datagram on purpose (0 to 1), for testing the TCP
+# fallback over loopback. Keep this at 0.
+loss = 0.0
+
 [chunk_caching]
 # Enable chunk caching.
 # Warning: This feature is experimental, and will most likely raise stupid
 # amounts of exceptions. You have been warned.
 enabled = false
 
-# Chunk data should be pulled x times before entering the cache
+# Chunk data should be pulled more than x times before entering the cache.
+# Pulls are counted in a fixed size sketch that forgets old pulls over time and
+# counts up to 15 pulls per chunk, so thresholds above 14 are treated as 14.
 threshold = 5
 
+# Chunks cached per dimension. Once the cache is full, a chunk only enters it
+# if it was pulled more often recently than the least recently used cached
+# chunk, which is evicted for it.
+capacity = 8192
+
 # Set the path value to a filename to enable on-disk caching. The filename will
 # be postpended with the dimension and a .db filetype. Set to ":memory:" to use
 # in ram caching instead. In memory is recommended, however it isn't persistant.
 path = ":memory:"
+
+# Where cached chunks are stored. "sqlite" stores the sections of chunks once
+# no matter how many chunks have them. "log" appends compressed chunks to
+# segment files (named after the path, with their number and .log), reads
+# are faster but chunks aren't deduplicated. log_bytes is how many bytes of
+# compressed chunks the log keeps per dimension.
+backend = "sqlite"
+log_bytes = 268435456
+
+# Cache the light arrays of cached chunks as well (update_light packets are
+# about as big as the chunks). The external proxy keeps arrays by their hash,
+# the internal proxy sends a hash instead of an array it already sent to the
+# same player. Light caches are postpended with _light.db on disk.
+light = true
+
+# Light arrays the internal proxy remembers per player, and bytes of light
+# arrays the external proxy keeps in total (an array is 2048 bytes). The most
+# recently used light_hot_bytes of them are also kept in memory.
+light_per_player = 4096
+light_bytes = 134217728
+light_hot_bytes = 8388608
+
+# Chunks are identified by a hash of their data. The internal proxy sends only
+# the hash of a chunk the external proxy should have, which asks for the chunk
+# in full if its copy is different. The internal proxy keeps the last chunks it
+# sent per player for that, the external proxy holds the player's packets back
+# until the chunk arrives or the timeout (in seconds) runs out.
+resend_chunks = 64
+resend_timeout = 5
+
+# Chunks changed by block updates are kept decoded and are only encoded again
+# when they are sent or evicted. The working set is limited by the encoded size
+# of the chunks in it, the decoded chunks take more memory than that (how much
+# depends on the quarry version, block arrays are bigger than packed data).
+working_set_encoded_bytes = 16777216
+
+# Changed chunks are written to the cache in batches, every flush_interval
+# seconds or once dirty_bytes of them are waiting. They are also written when
+# the proxy stops.
+flush_interval = 5
+dirty_bytes = 8388608
+
+# Evicted chunks are announced to the internal proxy in batches and are only
+# removed uncache_grace seconds later, so chunks it referenced before it knew
+# are still sent from the cache.
+uncache_grace = 10
 """.format(datetime.datetime.now(), secrets.token_urlsafe(25), secrets.token_urlsafe(25), 'Eastwood'))
 		print('Config file generated at '+config_location+', please modify it.')
 		return
@@ -4,61 +4,197 @@ B I N C A C H E
 Naphtha's library for identifying and caching binary objects.
 
 (Aaa! This one is so much more simpler than Plasma, it's scary!)
+
+Elements are kept in a WITHOUT ROWID table keyed by their identifier, so lookups are a single index seek.
+Writes and access times are buffered and written in one transaction per batch, and the most recently used
+elements are kept in memory in front of sqlite. The capacity is in bytes of data, least recently used elements
+are removed first.
 """
 
 import sqlite3, time
+from collections import OrderedDict
+
+MAX_VARIABLES = 500 # Identifiers per IN (...) statement, sqlite allows 999 variables by default
 
 class Cache(object):
-	def __init__(self, elements: int = 8192, path: str = ':memory:', gctime: int = 4):
-		self.connection = sqlite3.connect(path)
+	def __init__(self, capacity: int = 67108864, path: str = ':memory:', gctime: int = 4, hot_bytes: int = 4194304, batch: int = 256):
+		"""
+		Args:
+			capacity: bytes of data to keep, the least recently used elements are removed first
+			path: sqlite database path
+			gctime: seconds between writing buffered changes and removing elements over the capacity
+			hot_bytes: bytes of the most recently used elements kept in memory
+			batch: buffered writes that trigger a write before gctime is up
+		"""
+		self.connection = sqlite3.connect(path, check_same_thread=False) # May be handed to a worker thread, it is only used by one thread at a time
 		self.cursor = self.connection.cursor()
-		self.limit = elements
+		self.capacity = capacity
 		self.gctime = gctime
 		self.last_gc = time.time()
-
-		self.cursor.execute('CREATE TABLE IF NOT EXISTS elements (identifier BLOB, accessed INTEGER, data BLOB);')
-		try:
-			self.cursor.execute('CREATE INDEX idx_elements_accessed ON elements (accessed);')
-		except:
-			pass
-
+		self.batch = batch
+
+		self.hot = OrderedDict() # Recently used elements by identifier, oldest first
+		self.hot_size = 0
+		self.hot_limit = hot_bytes
+		self.pending = {} # Buffered writes by identifier, None for removals
+		self.touched = {} # Buffered access times by identifier
+
+		self.cursor.execute('PRAGMA journal_mode=WAL;') # Ignored for in memory databases
+		self.cursor.execute('PRAGMA synchronous=NORMAL;')
+		self.cursor.execute('CREATE TABLE IF NOT EXISTS kv (identifier BLOB PRIMARY KEY, accessed REAL, size INTEGER, data BLOB) WITHOUT ROWID;')
+		self.cursor.execute('CREATE INDEX IF NOT EXISTS idx_kv_accessed ON kv (accessed);')
+
+		# Caches written by older versions have no index at all
+		self.cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'elements';")
+		if self.cursor.fetchone():
+			self.cursor.execute('INSERT OR REPLACE INTO kv (identifier, accessed, size, data) SELECT identifier, accessed, length(data), data FROM elements ORDER BY accessed;')
+			self.cursor.execute('DROP TABLE elements;')
+
+		self.cursor.execute('SELECT COALESCE(SUM(size), 0) FROM kv;')
+		self.size = self.cursor.fetchone()[0] # Bytes of data stored in sqlite
 		self.connection.commit()
 
 	def __regcall(self):
-		if time.time() - self.last_gc > self.gctime:
-			self.cursor.execute('DELETE FROM elements WHERE accessed IN (SELECT accessed FROM elements ORDER BY accessed DESC LIMIT -1 OFFSET {0});'.format(self.limit))
-			self.connection.commit()
-			self.last_gc = time.time()
+		if len(self.pending) + len(self.touched) >= self.batch or time.time() - self.last_gc > self.gctime:
+			self.commit()
 
 	def __del__(self):
-		self.connection.commit()
+		self.commit()
 		self.connection.close()
 
+	def __remember(self, identifier: bytes, data: bytes):
+		"""
+		Puts an element in front of the hot elements, the oldest ones are dropped from memory (not from sqlite)
+		"""
+		old = self.hot.pop(identifier, None)
+		if old is not None:
+			self.hot_size -= len(old)
+
+		if len(data) > self.hot_limit:
+			return
+
+		self.hot[identifier] = data
+		self.hot_size += len(data)
+		while self.hot_size > self.hot_limit:
+			self.hot_size -= len(self.hot.popitem(last=False)[1])
+
+	def __forget(self, identifier: bytes):
+		old = self.hot.pop(identifier, None)
+		if old is not None:
+			self.hot_size -= len(old)
+
+	def __select(self, statement: str, identifiers: list):
+		"""
+		Runs a statement with an IN (...) list of identifiers in chunks
+		Returns:
+			list: all rows
+		"""
+		rows = []
+		for i in range(0, len(identifiers), MAX_VARIABLES):
+			part = identifiers[i:i+MAX_VARIABLES]
+			self.cursor.execute(statement.format(','.join('?'*len(part))), part)
+			rows.extend(self.cursor.fetchall())
+
+		return rows
+
+	def commit(self):
+		"""
+		Writes buffered changes in one transaction and removes the least recently used elements over the capacity
+		"""
+		if self.pending:
+			identifiers = list(self.pending)
+			old_sizes = dict(self.__select('SELECT identifier, size FROM kv WHERE identifier IN ({});', identifiers))
+			self.size -= sum(old_sizes.values())
+
+			now = time.time()
+			puts = [(identifier, now, len(data), data) for identifier, data in self.pending.items() if data is not None]
+			self.cursor.executemany('INSERT OR REPLACE INTO kv (identifier, accessed, size, data) VALUES (?, ?, ?, ?);', puts)
+			self.cursor.executemany('DELETE FROM kv WHERE identifier = ?;', [(identifier,) for identifier, data in self.pending.items() if data is None and identifier in old_sizes])
+			self.size += sum(put[2] for put in puts)
+			self.pending.clear()
+
+		if self.touched:
+			self.cursor.executemany('UPDATE kv SET accessed = ? WHERE identifier = ?;', [(accessed, identifier) for identifier, accessed in self.touched.items()])
+			self.touched.clear()
+
+		if self.size > self.capacity:
+			# Walk the oldest elements until enough bytes are freed
+			removed = []
+			for identifier, size in self.connection.execute('SELECT identifier, size FROM kv ORDER BY accessed;'): # Read lazily on a cursor of its own
+				removed.append((identifier,))
+				self.size -= size
+				if self.size <= self.capacity:
+					break
+
+			self.cursor.executemany('DELETE FROM kv WHERE identifier = ?;', removed)
+			for (identifier,) in removed:
+				self.__forget(identifier)
+
+		self.connection.commit()
+		self.last_gc = time.time()
+
 	def insert(self, identifier: bytes, data: bytes):
-		self.cursor.execute('INSERT INTO elements (identifier, accessed, data) VALUES (?, ?, ?);', (identifier, time.time(), data))
+		self.pending[identifier] = data
+		self.touched.pop(identifier, None) # Written with a new access time
+		self.__remember(identifier, data)
 		self.__regcall()
 
-	def update(self, identifier: bytes, data: bytes):
-		self.cursor.execute('UPDATE elements SET accessed = ?, data = ? WHERE identifier = ?', (time.time(), data, identifier))
+	update = insert # Elements are replaced either way
+
+	def put_many(self, items):
+		"""
+		Args:
+			items: iterable of identifiers and data
+		"""
+		for identifier, data in items:
+			self.pending[identifier] = data
+			self.touched.pop(identifier, None)
+			self.__remember(identifier, data)
+
 		self.__regcall()
 
 	def destroy(self, identifier: bytes):
-		self.cursor.execute('DELETE FROM elements WHERE identifier = ?', (identifier,))
+		self.pending[identifier] = None
+		self.touched.pop(identifier, None)
+		self.__forget(identifier)
 		self.__regcall()
 
 	def get(self, identifier: bytes):
-		self.cursor.execute('SELECT * FROM elements WHERE identifier = ?', (identifier,))
-
-		try:
-			t = self.cursor.fetchone()[2]
-		except:
-			return None
+		return self.get_many((identifier,)).get(identifier)
+
+	def get_many(self, identifiers):
+		"""
+		Args:
+			identifiers: iterable of identifiers
+		Returns:
+			dict: data by identifier, identifiers that aren't cached are left out
+		"""
+		found = {}
+		missing = []
+		for identifier in identifiers:
+			if identifier in self.pending:
+				if self.pending[identifier] is not None:
+					found[identifier] = self.pending[identifier]
+			elif identifier in self.hot:
+				self.hot.move_to_end(identifier)
+				found[identifier] = self.hot[identifier]
+			else:
+				missing.append(identifier)
+
+		if missing:
+			for identifier, data in self.__select('SELECT identifier, data FROM kv WHERE identifier IN ({});', missing):
+				found[identifier] = data
+				self.__remember(identifier, data)
+
+		now = time.time()
+		for identifier in found:
+			if identifier not in self.pending:
+				self.touched[identifier] = now
 
-		self.cursor.execute('UPDATE elements SET accessed = ? where identifier = ?', (time.time(), identifier))
 		self.__regcall()
-
-		return t
+		return found
 
 	def get_all_identifiers(self):
-		self.cursor.execute("SELECT identifier FROM elements")
+		self.commit()
+		self.cursor.execute('SELECT identifier FROM kv;')
 		return [x[0] for x in self.cursor.fetchall()]
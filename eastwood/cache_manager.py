@@ -0,0 +1,197 @@
+"""
+TinyLFU admission and eviction for the chunk caches
+How often chunks are pulled is estimated with a count-min sketch of a fixed size whose counters are halved
+periodically, so popularity decays and memory doesn't grow with how much of the world was explored.
+A chunk is cached once it was pulled more than threshold times, when the cache is full only if it was pulled more
+often than the least recently used cached chunk, which is evicted for it.
+"""
+import os
+from collections import OrderedDict, deque
+from mmh3 import hash64
+
+ROWS = 4 # Hash functions of the sketch
+MAX_COUNT = 15 # Counters are capped like the 4 bit counters of TinyLFU
+HALVE = bytes(i >> 1 for i in range(256)) # Translation table that halves every counter at once
+JOURNAL_SIZE = 65536 # Changes remembered for syncing the internal proxy with only what changed
+
+class FrequencySketch:
+	"""
+	Count-min sketch of how often keys were seen recently
+	"""
+	def __init__(self, width, sample_size):
+		"""
+		Args:
+			width: counters per row, rounded up to a power of two
+			sample_size: increments between halving every counter
+		"""
+		self.width = 1 << max(width - 1, 1).bit_length()
+		self.mask = self.width - 1
+		self.rows = [bytearray(self.width) for _ in range(ROWS)]
+		self.sample_size = sample_size
+		self.additions = 0
+
+	def indices(self, key):
+		"""
+		Returns:
+			generator: counter index of the key in each row
+		"""
+		h1, h2 = hash64(key)
+		return ((h1 + i*h2) & self.mask for i in range(ROWS))
+
+	def increment(self, key):
+		"""
+		Counts a key once, every counter is halved once sample_size keys were counted
+		"""
+		for row, index in zip(self.rows, self.indices(key)):
+			if row[index] < MAX_COUNT:
+				row[index] += 1
+
+		self.additions += 1
+		if self.additions >= self.sample_size:
+			self.rows = [bytearray(row.translate(HALVE)) for row in self.rows]
+			self.additions //= 2
+
+	def estimate(self, key):
+		"""
+		Returns:
+			int: estimated amount of times a key was seen recently, never less than the real amount
+		"""
+		return min(row[index] for row, index in zip(self.rows, self.indices(key)))
+
+class CacheManager:
+	"""
+	Decides which chunks are cached and keeps the cached ones in least recently used order per dimension
+	"""
+	def __init__(self, capacity, threshold):
+		"""
+		Args:
+			capacity: chunks to cache per dimension
+			threshold: times a chunk has to be pulled recently before it is cached, at most MAX_COUNT - 1
+		"""
+		self.capacity = capacity
+		self.threshold = min(threshold, MAX_COUNT - 1) # Counters stop at MAX_COUNT, a higher threshold would never admit anything
+		self.sketch = FrequencySketch(capacity * 16, capacity * 10 * (self.threshold + 1)) # Wide enough for the chunks around the cached ones, forgets after 10x the capacity per pull a chunk needs
+		self.cached = {} # Cached chunk keys by dimension, least recently used first
+		self.snapshot = os.urandom(8) # Identifies the versions of this cache state (see cache_sync)
+		self.version = 0 # Bumped by every change
+		self.journal = deque(maxlen=JOURNAL_SIZE) # Versions, dimensions and keys of the last changes
+
+		self.admitted = 0
+		self.rejected = 0
+		self.evicted = 0
+
+	@staticmethod
+	def sketch_key(dimension, key):
+		return dimension.to_bytes(4, "big", signed=True) + key
+
+	def changed(self, dimension, key):
+		self.version += 1
+		self.journal.append((self.version, dimension, key))
+
+	def changes_since(self, version):
+		"""
+		Args:
+			version: version of the cache state
+		Returns:
+			dict: lists of chunk keys that changed since the version and whether they are cached by dimension, None if the journal doesn't go back that far
+		"""
+		if version > self.version or (version < self.version and (not self.journal or self.journal[0][0] > version + 1)):
+			return None
+
+		changed = {}
+		for change_version, dimension, key in reversed(self.journal):
+			if change_version <= version:
+				break
+			changed[(dimension, key)] = None
+
+		changes = {}
+		for dimension, key in changed:
+			changes.setdefault(dimension, []).append((key, self.contains(dimension, key)))
+		return changes
+
+	def contains(self, dimension, key):
+		"""
+		Args:
+			dimension: dimension of the chunk
+			key: chunk key
+		"""
+		return key in self.cached.get(dimension, ())
+
+	def record(self, dimension, key):
+		"""
+		Counts a pull of a chunk, cached or not
+		Args:
+			dimension: dimension of the chunk
+			key: chunk key
+		Returns:
+			bool: whether the chunk is cached
+		"""
+		self.sketch.increment(self.sketch_key(dimension, key))
+
+		cached = self.cached.get(dimension)
+		if cached is not None and key in cached:
+			cached.move_to_end(key)
+			return True
+
+		return False
+
+	def admit(self, dimension, key):
+		"""
+		Decides whether to cache a chunk that was pulled, the caller caches it if so
+		Args:
+			dimension: dimension of the chunk
+			key: chunk key, pulls are counted with record first
+		Returns:
+			tuple: whether to cache the chunk, and the keys of the chunks evicted for it
+		"""
+		frequency = self.sketch.estimate(self.sketch_key(dimension, key))
+		if frequency <= self.threshold:
+			return False, []
+
+		cached = self.cached.setdefault(dimension, OrderedDict())
+		evicted = []
+		if len(cached) >= self.capacity:
+			victim = next(iter(cached))
+			if frequency <= self.sketch.estimate(self.sketch_key(dimension, victim)):
+				self.rejected += 1
+				return False, []
+
+			while len(cached) >= self.capacity: # More if the store had more chunks than the capacity
+				evicted.append(cached.popitem(last=False)[0])
+				self.changed(dimension, evicted[-1])
+			self.evicted += len(evicted)
+
+		cached[key] = None
+		self.changed(dimension, key)
+		self.admitted += 1
+		return True, evicted
+
+	def add(self, dimension, key):
+		"""
+		Adds a chunk that is already cached, without deciding
+		"""
+		self.cached.setdefault(dimension, OrderedDict())[key] = None
+		self.changed(dimension, key)
+
+	def remove(self, dimension, key):
+		"""
+		Args:
+			dimension: dimension of the chunk
+			key: chunk key
+		Returns:
+			bool: whether the chunk was cached
+		"""
+		cached = self.cached.get(dimension)
+		if cached is None or key not in cached:
+			return False
+
+		del cached[key]
+		self.changed(dimension, key)
+		return True
+
+	def get_stats(self):
+		"""
+		Returns:
+			dict: cached chunks per dimension, and amount of admitted, rejected and evicted chunks
+		"""
+		return {"cached": {dimension: len(keys) for dimension, keys in self.cached.items()}, "admitted": self.admitted, "rejected": self.rejected, "evicted": self.evicted}
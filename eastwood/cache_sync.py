@@ -0,0 +1,90 @@
+"""
+Bulk sync of which chunks an external proxy has cached, sent when a link comes up instead of a toggle_chunk per chunk
+The internal proxy answers a hello with the snapshot and version of the cache state it has for the external proxy.
+If the external proxy still has the changes since that version, only the chunks that changed are sent, otherwise
+the whole state is sent as region bitmaps (see chunk_index)
+
+Layout of a cache_sync packet:
+	8 bytes: snapshot id, a new one every time the external proxy starts
+	varint: version of the cache state
+	bool: whether this is the whole state, the internal proxy then forgets every chunk that isn't in it
+	everything after it is zlib compressed:
+		varint: amount of dimensions
+		per dimension: varint dimension, varint amount of entries, then per entry
+			whole state: int region x, int region z, bitmap of the region
+			changes: 8 byte chunk key, bool whether it is cached, sorted by key
+"""
+import zlib
+
+from eastwood.chunk_index import REGION_BYTES, pack_key, region_bitmaps
+
+SNAPSHOT_SIZE = 8
+
+def pack_cache_sync(buff_class, snapshot, version, full, dimensions):
+	"""
+	Args:
+		buff_class: buffer class to pack with
+		snapshot: snapshot id
+		version: version of the cache state
+		full: whether this is the whole state
+		dimensions: dict of cached chunk keys by dimension for the whole state, or of lists of chunk keys and whether they are cached for changes
+	Returns:
+		bytes: packet data
+	"""
+	body = [buff_class.pack_varint(len(dimensions))]
+	for dimension, entries in dimensions.items():
+		if full:
+			entries = sorted(region_bitmaps(pack_key(key) for key in entries).items())
+			body.append(buff_class.pack_varint(dimension) + buff_class.pack_varint(len(entries)))
+			body.extend(buff_class.pack("ii", region_x, region_z) + bitmap for (region_x, region_z), bitmap in entries)
+		else:
+			body.append(buff_class.pack_varint(dimension) + buff_class.pack_varint(len(entries)))
+			body.extend(key + buff_class.pack("?", cached) for key, cached in sorted(entries))
+
+	return b"".join((snapshot, buff_class.pack_varint(version), buff_class.pack("?", full), zlib.compress(b"".join(body))))
+
+def unpack_cache_sync(buff_class, buff):
+	"""
+	Args:
+		buff_class: buffer class to unpack the compressed part with
+		buff: buffer of the packet
+	Returns:
+		tuple: snapshot id, version, whether it is the whole state and a dict by dimension of region bitmaps by region x and z for the whole state, or lists of chunk keys and whether they are cached for changes
+	"""
+	snapshot = buff.read(SNAPSHOT_SIZE)
+	version = buff.unpack_varint()
+	full = buff.unpack("?")
+	body = buff_class(zlib.decompress(buff.read()))
+
+	dimensions = {}
+	for _ in range(body.unpack_varint()):
+		dimension = body.unpack_varint()
+		if full:
+			dimensions[dimension] = {body.unpack("ii"): body.read(REGION_BYTES) for _ in range(body.unpack_varint())}
+		else:
+			dimensions[dimension] = [(body.read(8), body.unpack("?")) for _ in range(body.unpack_varint())]
+
+	return snapshot, version, full, dimensions
+
+def send_cache_sync(link, manager):
+	"""
+	Sends the cache state to the internal proxy over a link, only the changes if the internal proxy's version is known and recent enough
+	Args:
+		link: EWProtocol link to the internal proxy, its factory keeps the snapshot and version the internal proxy has
+		manager: CacheManager of the external proxy
+	"""
+	if link is None:
+		return # Sent once a link connects and tells the version
+	synced = getattr(link.factory, "synced_cache", None)
+	if synced is None:
+		return # Sent once the internal proxy tells which version it has
+
+	snapshot, version = synced
+	changes = manager.changes_since(version) if snapshot == manager.snapshot else None
+	data = pack_cache_sync(link.buff_class, manager.snapshot, manager.version, True, manager.cached)
+	if changes is not None:
+		diff = pack_cache_sync(link.buff_class, manager.snapshot, manager.version, False, changes)
+		data = min(data, diff, key=len)
+
+	link.send_packet("cache_sync", data)
+	link.factory.synced_cache = (manager.snapshot, manager.version)
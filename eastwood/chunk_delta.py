@@ -0,0 +1,93 @@
+"""
+Section aware deltas between two versions of a chunk column (everything in chunk_data after the full chunk bool)
+A re-sent chunk usually differs from the cached one in a few sections, the sections the other side already has are sent
+as their index in its version instead
+The internal proxy only keeps the hashes of the version the external proxy has, not the version itself
+
+Layout of a delta:
+	varint length + everything before the chunk data size (bitmask, heightmaps)
+	varint section count
+	per section: varint index + 1 of the same section in the base version, or 0 followed by varint length + section
+	varint 1 if everything after the sections (biomes, block entities) is the same as in the base version, or 0 followed by varint length + all of it
+"""
+from mmh3 import hash_bytes
+from quarry.net.protocol import BufferUnderrun
+
+from eastwood.chunk_store import join_column, split_column
+
+def column_version(buff_class, data):
+	"""
+	Args:
+		buff_class: buffer class to unpack with
+		data: column data
+	Returns:
+		tuple: hash of the column, hashes of its sections and hash of everything after them, the last two are None if the column can't be split
+	"""
+	try:
+		head, sections, tail = split_column(buff_class, data)
+	except BufferUnderrun:
+		return hash_bytes(data), None, None
+
+	return hash_bytes(data), [hash_bytes(section) for section in sections], hash_bytes(tail)
+
+def make_delta(buff_class, base, data):
+	"""
+	Args:
+		buff_class: buffer class to pack with
+		base: version of the column the other side has, from column_version
+		data: new column data
+	Returns:
+		tuple: delta (None if nothing is shared with the base version) and version of the new column
+	"""
+	try:
+		head, sections, tail = split_column(buff_class, data)
+	except BufferUnderrun:
+		return None, (hash_bytes(data), None, None)
+
+	section_hashes = [hash_bytes(section) for section in sections]
+	version = (hash_bytes(data), section_hashes, hash_bytes(tail))
+	if base[1] is None:
+		return None, version
+
+	base_indices = {section_hash: i for i, section_hash in enumerate(base[1])}
+	shared = False
+	delta = [buff_class.pack_varint(len(head)), head, buff_class.pack_varint(len(sections))]
+	for section_hash, section in zip(section_hashes, sections):
+		if section_hash in base_indices:
+			delta.append(buff_class.pack_varint(base_indices[section_hash] + 1))
+			shared = True
+		else:
+			delta.extend((buff_class.pack_varint(0), buff_class.pack_varint(len(section)), section))
+
+	if version[2] == base[2]:
+		delta.append(buff_class.pack_varint(1))
+		shared = True
+	else:
+		delta.extend((buff_class.pack_varint(0), buff_class.pack_varint(len(tail)), tail))
+
+	if not shared:
+		return None, version
+
+	return b"".join(delta), version
+
+def apply_delta(buff_class, base, delta):
+	"""
+	Args:
+		buff_class: buffer class to unpack with
+		base: column data of the base version
+		delta: delta from make_delta
+	Returns:
+		bytes: new column data
+	"""
+	_, base_sections, base_tail = split_column(buff_class, base)
+
+	buff = buff_class(delta)
+	head = buff.read(buff.unpack_varint())
+
+	sections = []
+	for _ in range(buff.unpack_varint()):
+		index = buff.unpack_varint()
+		sections.append(base_sections[index - 1] if index else buff.read(buff.unpack_varint()))
+
+	tail = base_tail if buff.unpack_varint() else buff.read(buff.unpack_varint())
+	return join_column(buff_class, head, sections, tail)
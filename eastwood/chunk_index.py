@@ -0,0 +1,139 @@
+"""
+Index of the chunks an external proxy has cached
+Chunk keys (x and z packed as big endian ints) are kept as 64 bit ints in a set per dimension, so lookups stay O(1)
+however many chunks are cached
+Regions of 32x32 chunks can be read and replaced at once as 1024 bit bitmaps, bit z*32 + x is the chunk at x, z in the region
+"""
+from collections import defaultdict
+
+REGION_SIZE = 32 # Chunks per side of a region
+REGION_BYTES = REGION_SIZE*REGION_SIZE // 8
+
+def pack_key(key):
+	"""
+	Args:
+		key: chunk key as bytes
+	Returns:
+		int: chunk key as a 64 bit int
+	"""
+	return int.from_bytes(key, "big")
+
+def unpack_key(packed):
+	"""
+	Args:
+		packed: chunk key as a 64 bit int
+	Returns:
+		bytes: chunk key
+	"""
+	return packed.to_bytes(8, "big")
+
+def chunk_position(packed):
+	"""
+	Returns:
+		tuple: chunk x and z of a packed key
+	"""
+	x, z = packed >> 32, packed & 0xFFFFFFFF
+	return x - (x >> 31 << 32), z - (z >> 31 << 32) # Both are signed
+
+def region_bitmaps(packed_keys):
+	"""
+	Args:
+		packed_keys: iterable of packed chunk keys
+	Returns:
+		dict: bitmaps as bytes by region x and z, only regions with chunks are included
+	"""
+	bitmaps = defaultdict(int)
+	for packed in packed_keys:
+		x, z = chunk_position(packed)
+		bitmaps[(x // REGION_SIZE, z // REGION_SIZE)] |= 1 << (z % REGION_SIZE * REGION_SIZE + x % REGION_SIZE)
+
+	return {region: bitmap.to_bytes(REGION_BYTES, "little") for region, bitmap in bitmaps.items()}
+
+class ChunkIndex:
+	"""
+	Set of cached chunk keys for any amount of dimensions
+	"""
+	def __init__(self):
+		self.dimensions = defaultdict(set) # Packed keys by dimension id
+
+	def __len__(self):
+		return sum(len(keys) for keys in self.dimensions.values())
+
+	def contains(self, dimension, key):
+		"""
+		Args:
+			dimension: dimension of the chunk
+			key: chunk key
+		"""
+		return dimension in self.dimensions and pack_key(key) in self.dimensions[dimension]
+
+	def set(self, dimension, key, cached):
+		"""
+		Sets whether a chunk is cached
+		Args:
+			dimension: dimension of the chunk
+			key: chunk key
+			cached: whether it is cached
+		"""
+		if cached:
+			self.dimensions[dimension].add(pack_key(key))
+		else:
+			self.dimensions[dimension].discard(pack_key(key))
+
+	def discard(self, dimension, key):
+		"""
+		Removes a chunk if it is cached
+		Returns:
+			bool: whether it was cached
+		"""
+		keys = self.dimensions.get(dimension)
+		packed = pack_key(key)
+		if keys is None or packed not in keys:
+			return False
+
+		keys.remove(packed)
+		return True
+
+	def keys(self, dimension):
+		"""
+		Returns:
+			generator: chunk keys cached in a dimension
+		"""
+		return (unpack_key(packed) for packed in self.dimensions.get(dimension, ()))
+
+	def region_bitmaps(self, dimension):
+		"""
+		Args:
+			dimension: dimension to get the regions of
+		Returns:
+			dict: bitmaps as bytes by region x and z, only regions with cached chunks are included
+		"""
+		return region_bitmaps(self.dimensions.get(dimension, ()))
+
+	def set_region(self, dimension, region_x, region_z, bitmap):
+		"""
+		Replaces which chunks of a region are cached
+		Args:
+			dimension: dimension of the region
+			region_x: region x
+			region_z: region z
+			bitmap: bitmap of the cached chunks as bytes
+		Returns:
+			list: keys of the chunks that are no longer cached
+		"""
+		keys = self.dimensions[dimension]
+		bitmap = int.from_bytes(bitmap, "little")
+
+		removed = []
+		for i in range(REGION_SIZE*REGION_SIZE):
+			x = region_x*REGION_SIZE + i % REGION_SIZE
+			z = region_z*REGION_SIZE + i // REGION_SIZE
+			packed = (x & 0xFFFFFFFF) << 32 | z & 0xFFFFFFFF
+
+			if bitmap >> i & 1:
+				keys.add(packed)
+			elif packed in keys:
+				keys.remove(packed)
+				removed.append(unpack_key(packed))
+
+		return removed
@@ -0,0 +1,277 @@
+"""
+Content addressed chunk storage
+Columns are split into sections that are stored once by their hash with a reference count, so the all air, stone
+and ocean sections thousands of chunks have in common take the space of one
+A chunk is stored as its heightmaps, the hashes of its sections and everything after them (biomes, tile entities)
+"""
+import sqlite3, time
+import zstandard as zstd
+from mmh3 import hash_bytes
+from quarry.net.protocol import BufferUnderrun
+from quarry.types.buffer import Buffer1_14
+from twisted.internet import reactor, threads
+from twisted.python.threadpool import ThreadPool
+
+from eastwood.chunk_transcoder import unpack_section_header
+
+HASH_SIZE = 16
+
+class ChunkStore:
+	"""
+	Drop-in replacement for bincache.Cache that stores chunk columns (everything in chunk_data after the full chunk bool)
+	"""
+	def __init__(self, elements=8192, path=":memory:", gctime=4, level=3, buff_class=Buffer1_14):
+		"""
+		Args:
+			elements: amount of chunks to keep, the least recently used ones are removed first
+			path: sqlite database path
+			gctime: seconds between removing chunks over the limit
+			level: zstd compression level of the sections and the rest of the chunk, they are compressed one by one on the store's thread
+			buff_class: buffer class to unpack columns with
+		"""
+		self.connection = sqlite3.connect(path, check_same_thread=False) # Only used by one ChunkWorker at a time
+		self.cursor = self.connection.cursor()
+		self.limit = elements
+		self.gctime = gctime
+		self.last_gc = time.time()
+		self.compressor = zstd.ZstdCompressor(level=level)
+		self.decompressor = zstd.ZstdDecompressor()
+		self.buff_class = buff_class
+		self.evicting = set() # Chunks over the limit that were reported but not destroyed yet
+		self.evicted = [] # Chunks over the limit that weren't reported yet
+
+		# Columns that can't be split are stored whole in head, with sections set to null
+		self.cursor.execute("CREATE TABLE IF NOT EXISTS chunks (identifier BLOB PRIMARY KEY, accessed REAL, head BLOB, sections BLOB, tail BLOB);")
+		self.cursor.execute("CREATE TABLE IF NOT EXISTS sections (hash BLOB PRIMARY KEY, refs INTEGER, data BLOB);")
+		self.cursor.execute("CREATE INDEX IF NOT EXISTS idx_chunks_accessed ON chunks (accessed);")
+		self.connection.commit()
+
+	def __del__(self):
+		self.connection.commit()
+		self.connection.close()
+
+	def gc(self):
+		"""
+		Picks the least recently used chunks over the limit for eviction, they stay readable until destroy_many is called
+		"""
+		if time.time() - self.last_gc > self.gctime:
+			self.cursor.execute("SELECT identifier FROM chunks ORDER BY accessed DESC LIMIT -1 OFFSET ?;", (self.limit,))
+			for (identifier,) in self.cursor.fetchall():
+				if identifier not in self.evicting:
+					self.evicting.add(identifier)
+					self.evicted.append(identifier)
+
+			self.last_gc = time.time()
+
+	def add_sections(self, sections):
+		"""
+		Stores sections, or adds a reference to ones that are already stored
+		Args:
+			sections: dict of section data by hash, with the amount of references to add
+		"""
+		for section_hash, (data, refs) in sections.items():
+			self.cursor.execute("UPDATE sections SET refs = refs + ? WHERE hash = ?;", (refs, section_hash))
+			if not self.cursor.rowcount:
+				self.cursor.execute("INSERT INTO sections (hash, refs, data) VALUES (?, ?, ?);", (section_hash, refs, self.compressor.compress(data)))
+
+	def remove_sections(self, hashes):
+		"""
+		Removes references to sections, sections nobody references are deleted
+		Args:
+			hashes: dict of the amount of references to remove by hash
+		"""
+		for section_hash, refs in hashes.items():
+			self.cursor.execute("UPDATE sections SET refs = refs - ? WHERE hash = ?;", (refs, section_hash))
+			self.cursor.execute("DELETE FROM sections WHERE hash = ? AND refs <= 0;", (section_hash,))
+
+	def get_hashes(self, identifier):
+		"""
+		Args:
+			identifier: chunk key
+		Returns:
+			dict: amount of references a stored chunk has to each section, None if the chunk isn't stored
+		"""
+		self.cursor.execute("SELECT sections FROM chunks WHERE identifier = ?;", (identifier,))
+		row = self.cursor.fetchone()
+		if not row:
+			return None
+
+		return count_hashes(row[0] or b"")
+
+	def insert(self, identifier, data):
+		"""
+		Stores a chunk, only sections that aren't stored yet are written
+		Args:
+			identifier: chunk key
+			data: column data
+		"""
+		self.evicting.discard(identifier) # Evicted chunks that are cached again are reported again
+		old_hashes = self.get_hashes(identifier) or {}
+
+		try:
+			head, sections, tail = split_column(self.buff_class, data)
+		except BufferUnderrun:
+			head, sections, tail = data, None, b"" # Stored as it is
+
+		section_hashes = [hash_bytes(section) for section in sections or ()]
+		hashes = None if sections is None else b"".join(section_hashes)
+		new_hashes = count_hashes(hashes or b"")
+		data_by_hash = dict(zip(section_hashes, sections or ()))
+
+		# Only the references that changed are touched
+		self.add_sections({section_hash: (data_by_hash[section_hash], refs - old_hashes.get(section_hash, 0)) for section_hash, refs in new_hashes.items() if refs > old_hashes.get(section_hash, 0)})
+		self.remove_sections({section_hash: refs - new_hashes.get(section_hash, 0) for section_hash, refs in old_hashes.items() if refs > new_hashes.get(section_hash, 0)})
+
+		self.cursor.execute("INSERT OR REPLACE INTO chunks (identifier, accessed, head, sections, tail) VALUES (?, ?, ?, ?, ?);", (identifier, time.time(), head, hashes, self.compressor.compress(tail) if tail else tail))
+		self.gc()
+
+	update = insert # Chunks are replaced section by section either way
+
+	def insert_many(self, items):
+		"""
+		Stores chunks in one transaction
+		Args:
+			items: list of chunk keys and column data
+		Returns:
+			list: keys of the chunks picked for eviction since the last call
+		"""
+		for identifier, data in items:
+			self.insert(identifier, data)
+
+		self.connection.commit()
+
+		evicted, self.evicted = self.evicted, []
+		return evicted
+
+	def destroy(self, identifier):
+		"""
+		Removes a chunk and its references to sections
+		Args:
+			identifier: chunk key
+		"""
+		hashes = self.get_hashes(identifier)
+		if hashes is None:
+			return
+
+		self.remove_sections(hashes)
+		self.cursor.execute("DELETE FROM chunks WHERE identifier = ?;", (identifier,))
+
+	def destroy_many(self, identifiers):
+		"""
+		Removes chunks in one transaction, once the chunks picked for eviction aren't needed anymore
+		Args:
+			identifiers: chunk keys
+		"""
+		for identifier in identifiers:
+			self.evicting.discard(identifier)
+			self.destroy(identifier)
+
+		self.connection.commit()
+
+	def get(self, identifier):
+		"""
+		Args:
+			identifier: chunk key
+		Returns:
+			bytes: column data, None if the chunk isn't stored
+		"""
+		self.cursor.execute("SELECT head, sections, tail FROM chunks WHERE identifier = ?;", (identifier,))
+		row = self.cursor.fetchone()
+		if not row:
+			return None
+
+		self.cursor.execute("UPDATE chunks SET accessed = ? WHERE identifier = ?;", (time.time(), identifier))
+		self.gc()
+
+		head, hashes, tail = row
+		if hashes is None:
+			return head
+
+		sections = []
+		for i in range(0, len(hashes), HASH_SIZE):
+			self.cursor.execute("SELECT data FROM sections WHERE hash = ?;", (hashes[i:i+HASH_SIZE],))
+			sections.append(self.decompressor.decompress(self.cursor.fetchone()[0]))
+
+		return join_column(self.buff_class, head, sections, self.decompressor.decompress(tail))
+
+	def get_all_identifiers(self):
+		self.cursor.execute("SELECT identifier FROM chunks;")
+		return [x[0] for x in self.cursor.fetchall()]
+
+	def get_stats(self):
+		"""
+		Returns:
+			dict: amount of chunks, unique sections and section references
+		"""
+		self.cursor.execute("SELECT COUNT(*), COALESCE(SUM(refs), 0) FROM sections;")
+		sections, refs = self.cursor.fetchone()
+		self.cursor.execute("SELECT COUNT(*) FROM chunks;")
+
+		return {"chunks": self.cursor.fetchone()[0], "sections": sections, "section_references": refs}
+
+class ChunkWorker:
+	"""
+	Runs chunk cache work (sqlite, compression, decoding) on a thread of its own so it never blocks the reactor
+	Work runs in the order it was added and the results are returned on the reactor thread
+	"""
+	def __init__(self):
+		self.pool = ThreadPool(1, 1, "ChunkWorker")
+		self.pool.start()
+		reactor.addSystemEventTrigger("during", "shutdown", self.pool.stop) # After dirty chunks are flushed
+
+	def run(self, func, *args, **kwargs):
+		"""
+		Args:
+			func: function to call on the worker thread
+		Returns:
+			Deferred: fires with the result of func
+		"""
+		return threads.deferToThreadPool(reactor, self.pool, func, *args, **kwargs)
+
+def split_column(buff_class, data):
+	"""
+	Splits a column into its parts
+	Args:
+		buff_class: buffer class to unpack with
+		data: column data
+	Returns:
+		tuple: everything before the chunk data size, list of sections, everything after the sections
+	"""
+	buff = buff_class(data)
+	bitmask = buff.unpack_varint()
+	buff.unpack_nbt() # Heightmaps
+	head = data[:buff.pos]
+
+	column = buff_class(buff.read(buff.unpack_varint()))
+	sections = []
+	for _ in range(bin(bitmask).count("1")):
+		header, bits, num_longs = unpack_section_header(column)
+		sections.append(header + column.read(num_longs*8))
+
+	biomes = column.read()
+	return head, sections, buff_class.pack_varint(len(biomes)) + biomes + buff.read()
+
+def join_column(buff_class, head, sections, tail):
+	"""
+	Joins the parts of a column split by split_column
+	Returns:
+		bytes: column data
+	"""
+	tail = buff_class(tail)
+	column = b"".join(sections) + tail.read(tail.unpack_varint()) # Biomes come after the sections
+
+	return b"".join((head, buff_class.pack_varint(len(column)), column, tail.read()))
+
+def count_hashes(hashes):
+	"""
+	Args:
+		hashes: concatenated section hashes
+	Returns:
+		dict: amount of times each hash appears
+	"""
+	counts = {}
+	for i in range(0, len(hashes), HASH_SIZE):
+		section_hash = hashes[i:i+HASH_SIZE]
+		counts[section_hash] = counts.get(section_hash, 0) + 1
+
+	return counts
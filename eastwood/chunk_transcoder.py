@@ -0,0 +1,153 @@
+"""
+Transcodes chunk sections into a byte aligned layout that compresses better than the bit packed one minecraft sends
+Palettes are kept in their original order, block indices are stored as one byte (or two bytes for wide palettes) per block
+4 bit sections are already nibble aligned and compress worse when widened, their arrays are kept as they are
+The external proxy rebuilds the exact original packet, chunks that wouldn't come out the same are never transcoded
+Transcoded chunks are sent in poems as "chunk_data_transcoded"
+
+Layout of a transcoded chunk:
+	varint length + everything before the chunk data size (x, z, full chunk, bitmask, heightmaps)
+	varint section count
+	per section: non air count, bits per block, palette, long count (copied as they are)
+	per section: 4096 block indices, or the original array for 4 bit sections
+	varint length + chunk data after the sections (biomes)
+	everything after the chunk data (block entities)
+"""
+import numpy as np
+from quarry.net.protocol import BufferUnderrun
+
+BLOCKS_PER_SECTION = 4096
+PACKED_WIDTHS = (4,) # Bits per block that are sent bit packed as they are
+
+def unpack_indices(array, bits):
+	"""
+	Unpacks a bit packed block array, values can span two longs
+	Args:
+		array: big endian longs
+		bits: bits per block
+	Returns:
+		ndarray: block indices as uint16
+	"""
+	if bits < 1 or bits > 16 or len(array)*8 < BLOCKS_PER_SECTION*bits:
+		raise ValueError("Unsupported block array")
+
+	longs = np.frombuffer(array, ">u8").astype("<u8") # Little endian, so bit k of the stream is bit k%64 of long k//64
+	stream = np.unpackbits(longs.view(np.uint8), bitorder="little")[:BLOCKS_PER_SECTION*bits].reshape(BLOCKS_PER_SECTION, bits)
+	stream = np.pad(stream, ((0, 0), (0, 16 - bits))) # Widen every value to 16 bits
+
+	return np.packbits(stream, axis=1, bitorder="little").view("<u2").ravel()
+
+def pack_indices(indices, bits, num_longs):
+	"""
+	Packs block indices into a bit packed block array
+	Args:
+		indices: block indices
+		bits: bits per block
+		num_longs: amount of longs in the array, unused bits are zero
+	Returns:
+		bytes: big endian longs
+	"""
+	values = np.ascontiguousarray(indices, "<u2").reshape(-1, 1).view(np.uint8)
+	stream = np.unpackbits(values, axis=1, bitorder="little")[:, :bits].ravel()
+	stream = np.pad(stream, (0, num_longs*64 - stream.size))
+
+	return np.packbits(stream, bitorder="little").view("<u8").astype(">u8").tobytes()
+
+def unpack_section_header(buff):
+	"""
+	Reads the header of a chunk section
+	Args:
+		buff: buffer at the start of the section
+	Returns:
+		tuple: raw header, bits per block, amount of longs in the block array
+	"""
+	start = buff.pos
+	bits = buff.unpack("HB")[1]
+	if bits <= 8: # Wider sections use the global palette
+		for _ in range(buff.unpack_varint()):
+			buff.unpack_varint()
+
+	num_longs = buff.unpack_varint()
+	return buff.buff[start:buff.pos], bits, num_longs
+
+def index_dtype(bits):
+	return ">u2" if bits > 8 else "u1"
+
+def transcode_chunk(buff_class, data):
+	"""
+	Args:
+		buff_class: buffer class to unpack with
+		data: chunk_data packet data
+	Returns:
+		bytes: transcoded chunk, None if it can't be transcoded
+	"""
+	buff = buff_class(data)
+	try:
+		buff.unpack("ii?")
+		bitmask = buff.unpack_varint()
+		buff.unpack_nbt() # Heightmaps
+		head = data[:buff.pos]
+
+		column = buff_class(buff.read(buff.unpack_varint()))
+		headers = []
+		arrays = []
+		transcoded = False
+		for _ in range(bin(bitmask).count("1")):
+			header, bits, num_longs = unpack_section_header(column)
+			array = column.read(num_longs*8)
+
+			headers.append(header)
+			if bits in PACKED_WIDTHS:
+				arrays.append(array)
+				continue
+
+			indices = unpack_indices(array, bits)
+			if pack_indices(indices, bits, num_longs) != array:
+				return None # Unused bits are set, the array wouldn't be rebuilt the same
+
+			arrays.append(indices.astype(index_dtype(bits)).tobytes())
+			transcoded = True
+
+		tail = column.read()
+		rest = buff.read()
+	except (BufferUnderrun, ValueError):
+		return None
+
+	if not transcoded:
+		return None # Nothing would change
+
+	return b"".join((
+		buff_class.pack_varint(len(head)), head,
+		buff_class.pack_varint(len(headers)),
+		*headers,
+		*arrays,
+		buff_class.pack_varint(len(tail)), tail,
+		rest
+	))
+
+def rebuild_chunk(buff_class, data):
+	"""
+	Args:
+		buff_class: buffer class to unpack with
+		data: transcoded chunk
+	Returns:
+		bytes: original chunk_data packet data
+	"""
+	buff = buff_class(data)
+	head = buff.read(buff.unpack_varint())
+	headers = [unpack_section_header(buff) for _ in range(buff.unpack_varint())]
+
+	sections = []
+	for header, bits, num_longs in headers:
+		if bits in PACKED_WIDTHS:
+			sections.append(header + buff.read(num_longs*8))
+			continue
+
+		dtype = np.dtype(index_dtype(bits))
+		indices = np.frombuffer(buff.read(BLOCKS_PER_SECTION*dtype.itemsize), dtype)
+		sections.append(header + pack_indices(indices, bits, num_longs))
+
+	sections.append(buff.read(buff.unpack_varint())) # Biomes
+	column = b"".join(sections)
+
+	return b"".join((head, buff_class.pack_varint(len(column)), column, buff.read()))
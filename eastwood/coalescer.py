@@ -0,0 +1,201 @@
+"""
+Merges packets in a poem that are superseded by later ones for the same player and entity
+Relative moves are summed, absolute state (teleports, head looks, velocity, health) is kept only once with its latest value
+Spawn and destroy packets of an entity, and respawns or joins of a player, are never reordered with its updates
+"""
+from quarry.net.protocol import BufferUnderrun
+
+SHORT_MIN, SHORT_MAX = -32768, 32767 # Range of relative move deltas
+
+POSITION_PACKETS = ("entity_relative_move", "entity_look_and_relative_move", "entity_look", "entity_teleport")
+LATEST_PACKETS = ("entity_head_look", "entity_velocity", "update_health") # Packets only the latest value matters for
+SPAWN_PACKETS = ("spawn_object", "spawn_experience_orb", "spawn_global_entity", "spawn_mob", "spawn_painting", "spawn_player")
+SESSION_BARRIERS = ("join_game", "respawn") # Entity ids are not meaningful across these
+
+class PositionRecord:
+	"""
+	Position and look of an entity, built up from several packets
+	"""
+	def __init__(self, entity_id, teleport=None):
+		"""
+		Args:
+			entity_id: id of the entity
+			teleport: x, y, z of a teleport, None if the record is relative
+		"""
+		self.entity_id = entity_id
+		self.teleport = teleport
+		self.delta = [0, 0, 0] # Summed relative move
+		self.look = None # Yaw and pitch
+		self.on_ground = False
+
+	def add_move(self, dx, dy, dz):
+		"""
+		Adds a relative move
+		Returns:
+			bool: False if the sum doesn't fit in a relative move anymore
+		"""
+		delta = [self.delta[0] + dx, self.delta[1] + dy, self.delta[2] + dz]
+		if not all(SHORT_MIN <= d <= SHORT_MAX for d in delta):
+			return False
+
+		self.delta = delta
+		return True
+
+	def pack(self, buff_class):
+		"""
+		Returns:
+			tuple: packet name and data
+		"""
+		entity_id = buff_class.pack_varint(self.entity_id)
+
+		if self.teleport:
+			return ("entity_teleport", entity_id + buff_class.pack("dddbb?", *self.teleport, *self.look, self.on_ground))
+
+		if not self.look:
+			return ("entity_relative_move", entity_id + buff_class.pack("hhh?", *self.delta, self.on_ground))
+
+		if self.delta == [0, 0, 0]:
+			return ("entity_look", entity_id + buff_class.pack("bb?", *self.look, self.on_ground))
+
+		return ("entity_look_and_relative_move", entity_id + buff_class.pack("hhhbb?", *self.delta, *self.look, self.on_ground))
+
+class PacketCoalescer:
+	"""
+	Coalesces the packets of a poem
+	"""
+	def __init__(self, buff_class, packets):
+		"""
+		Args:
+			buff_class: buffer class to parse packets with
+			packets: names of the packets that can be coalesced
+		"""
+		self.buff_class = buff_class
+		self.packets = set(packets)
+
+	def coalesce(self, entries):
+		"""
+		Args:
+			entries: list of (uuid, packet name, packet data) tuples, in the order they would be sent
+		Returns:
+			list: coalesced entries, in order
+		"""
+		output = [] # Entries, or PositionRecords that are packed at the end, None if superseded
+		positions = {} # Index of the open PositionRecord of an entity by (uuid, entity id)
+		latest = {} # Index of the latest packet by (uuid, packet name, entity id)
+
+		for uuid, packet_name, packet_data in entries:
+			uuid_hex = uuid.to_hex()
+
+			if packet_name in self.packets:
+				try:
+					if packet_name in POSITION_PACKETS:
+						self.add_position(output, positions, uuid, packet_name, packet_data)
+						continue
+					elif packet_name in LATEST_PACKETS:
+						entity_id = None if packet_name == "update_health" else self.buff_class(packet_data.buff).unpack_varint()
+
+						index = latest.get((uuid_hex, packet_name, entity_id))
+						if index is not None:
+							output[index][2].discard()
+							output[index] = None # Superseded
+
+						latest[(uuid_hex, packet_name, entity_id)] = len(output)
+				except BufferUnderrun:
+					pass # Malformed packets are left alone
+
+			elif packet_name in SESSION_BARRIERS:
+				for key in [key for key in positions if key[0] == uuid_hex]:
+					del positions[key]
+				for key in [key for key in latest if key[0] == uuid_hex]:
+					del latest[key]
+
+			elif packet_name in SPAWN_PACKETS or packet_name == "destroy_entities":
+				try:
+					for entity_id in self.get_entity_ids(packet_name, packet_data):
+						positions.pop((uuid_hex, entity_id), None)
+						latest.pop((uuid_hex, "entity_head_look", entity_id), None)
+						latest.pop((uuid_hex, "entity_velocity", entity_id), None)
+				except BufferUnderrun:
+					pass
+
+			output.append((uuid, packet_name, packet_data))
+
+		# Pack position records
+		coalesced = []
+		for entry in output:
+			if not entry:
+				continue # Superseded
+
+			if isinstance(entry[1], PositionRecord):
+				packet_name, data = entry[1].pack(self.buff_class)
+				entry = (entry[0], packet_name, self.buff_class(data))
+
+			coalesced.append(entry)
+
+		return coalesced
+
+	def add_position(self, output, positions, uuid, packet_name, packet_data):
+		"""
+		Adds a position packet to the open record of its entity, or opens a new one
+		Args:
+			output: output list
+			positions: index of the open PositionRecord by (uuid, entity id)
+			uuid: unique id of the client
+			packet_name: name of the packet
+			packet_data: buffer of the packet
+		"""
+		buff = self.buff_class(packet_data.buff)
+		entity_id = buff.unpack_varint()
+		key = (uuid.to_hex(), entity_id)
+
+		index = positions.get(key)
+		record = output[index][1] if index is not None else None
+
+		if packet_name == "entity_teleport":
+			x, y, z, yaw, pitch, on_ground = buff.unpack("dddbb?")
+			if record: # Teleports replace everything before them
+				output[index] = None
+
+			record = PositionRecord(entity_id, (x, y, z))
+			record.look = (yaw, pitch)
+			record.on_ground = on_ground
+		else:
+			if packet_name == "entity_look":
+				delta = (0, 0, 0)
+			else:
+				delta = buff.unpack("hhh")
+
+			look = buff.unpack("bb") if packet_name != "entity_relative_move" else None
+			on_ground = buff.unpack("?")
+
+			if record and delta != (0, 0, 0) and (record.teleport or not record.add_move(*delta)):
+				record = None # Moves can't be added to teleports, or the sum is too far
+
+			if record: # Record is moved to the latest position
+				output[index] = None
+			else:
+				record = PositionRecord(entity_id)
+				record.add_move(*delta)
+
+			if look:
+				record.look = look
+			record.on_ground = on_ground
+
+		packet_data.discard()
+		positions[key] = len(output)
+		output.append((uuid, record))
+
+	def get_entity_ids(self, packet_name, packet_data):
+		"""
+		Gets the entities a spawn or destroy packet is about
+		Args:
+			packet_name: name of the packet
+			packet_data: buffer of the packet
+		Returns:
+			list: entity ids
+		"""
+		buff = self.buff_class(packet_data.buff)
+		if packet_name == "destroy_entities":
+			return [buff.unpack_varint() for _ in range(buff.unpack_varint())]
+
+		return [buff.unpack_varint()]
@@ -0,0 +1,479 @@
+"""
+Optional UDP lane between the proxies for packets that are superseded within milliseconds (movement, looking, velocity)
+Every datagram packet gets a sequence number, receivers drop packets older than the newest one they have for the same entity
+Datagrams that are not acked in time are resent in the link's next poem, unless a newer packet for the same entity was sent since
+Resent packets are named "datagram" in the poem, their data is the sequence number and barrier followed by the original packet name and data
+
+Datagrams are also kept in order with the packets of the same entity that go over the link itself (spawns, relative
+moves, respawns, see EntityOrder). Every datagram packet carries a barrier, the number of the last poem with such a
+packet. Receivers hold datagrams until that poem arrived, and drop datagrams that were sent before a packet of the
+same entity that arrived already. Datagrams are sent in poems instead while such a packet waits for the next poem.
+"""
+import random, secrets
+from collections import Counter
+from quarry.net.protocol import BufferUnderrun
+from twisted.internet import reactor
+from twisted.internet.protocol import DatagramProtocol
+from twisted.internet.task import LoopingCall
+
+from eastwood.coalescer import POSITION_PACKETS, SESSION_BARRIERS, SPAWN_PACKETS
+from eastwood.plasma import AESCrypt_Mursha27Fx43Fx2_IV12_NI
+
+TOKEN_SIZE = 16 # Size of the token that identifies a lane
+MAX_DATAGRAM_SIZE = 1200 # Datagrams are kept under the usual path MTU so they are never fragmented
+KEEPALIVE_INTERVAL = 5 # Seconds between keepalives, so the internal proxy knows where to send datagrams
+
+# Datagram kinds
+PACKETS = 0 # per packet: varint sequence number, varint barrier, uuid, packet (name + data)
+ACKS = 1 # varint sequence numbers received
+KEEPALIVE = 2 # empty
+
+# Packets over the link that datagrams of the same entity (or player) are kept in order with
+ENTITY_PACKETS = frozenset(POSITION_PACKETS + SPAWN_PACKETS + ("entity_head_look", "entity_velocity"))
+PLAYER_PACKETS = frozenset(("player_position_and_look", "teleport_confirm", "player_position", "player_look"))
+SESSION = "session" # Key part of packets every datagram of a player is kept in order with (SESSION_BARRIERS)
+
+SUPERSEDED_BY = {"entity_look": ("entity_teleport",)} # Packets whose state is also in newer packets of another kind
+
+# Results of EntityOrder.check
+READY, HELD, STALE = range(3)
+
+class EntityOrder:
+	"""
+	Counts poems and remembers which poem had the last packet of every entity, on both ends of a link
+	Kept by the link from the start, as datagrams have to be ordered with packets sent before the lane was up
+	"""
+	def __init__(self, buff_class):
+		"""
+		Args:
+			buff_class: buffer class to read entity ids with
+		"""
+		self.buff_class = buff_class
+		self.unsent = Counter() # Packets buffered but not sent in a poem yet by key
+		self.sent = {} # Number of the last poem sent with a packet by key
+		self.received = {} # Number of the last poem received with a packet by key
+		self.poems_sent = 0
+		self.poems_received = 0
+
+	def key(self, uuid_hex, packet_name, data):
+		"""
+		Args:
+			uuid_hex: unique id of the client as hex
+			packet_name: name of the packet
+			data: packet data
+		Returns:
+			tuple: uuid and entity id (None for the player itself, SESSION for respawns), None if datagrams aren't ordered with the packet
+		"""
+		if packet_name in ENTITY_PACKETS:
+			return (uuid_hex, self.buff_class(data).unpack_varint())
+		if packet_name in PLAYER_PACKETS:
+			return (uuid_hex, None)
+		if packet_name in SESSION_BARRIERS:
+			return (uuid_hex, SESSION)
+		return None
+
+	def packet_buffered(self, uuid, packet_name, data):
+		"""
+		Counts a packet added to the next poem
+		"""
+		key = self.key(uuid.to_hex(), packet_name, data)
+		if key:
+			self.unsent[key] += 1
+
+	def poem_sent(self, entries):
+		"""
+		Counts a poem that was sent
+		Args:
+			entries: uuids, packet names and buffers of the packets in the poem
+		"""
+		self.poems_sent += 1
+		for uuid, packet_name, packet_data in entries:
+			key = self.key(uuid.to_hex(), packet_name, packet_data.buff)
+			if key and self.unsent[key]:
+				self.sent[key] = self.poems_sent
+				self.unsent[key] -= 1
+				if not self.unsent[key]:
+					del self.unsent[key]
+
+	def barrier(self, uuid_hex, entity_id):
+		"""
+		Args:
+			uuid_hex: unique id of the client as hex
+			entity_id: entity id, None for the player itself
+		Returns:
+			int: number of the poem a datagram for the entity has to be delivered after, None if a packet for it is still waiting for a poem
+		"""
+		keys = ((uuid_hex, entity_id), (uuid_hex, SESSION))
+		if any(key in self.unsent for key in keys):
+			return None
+
+		return max(self.sent.get(key, 0) for key in keys)
+
+	def poem_received(self):
+		self.poems_received += 1
+
+	def packet_received(self, uuid, packet_name, data):
+		"""
+		Remembers the poem a packet arrived in, call poem_received for the poem first
+		"""
+		key = self.key(uuid.to_hex(), packet_name, data)
+		if key:
+			self.received[key] = self.poems_received
+
+	def check(self, uuid_hex, entity_id, barrier):
+		"""
+		Args:
+			uuid_hex: unique id of the client as hex
+			entity_id: entity id, None for the player itself
+			barrier: barrier of the datagram
+		Returns:
+			int: STALE if it was sent before a packet that arrived already, HELD if the poem it comes after didn't arrive yet, READY otherwise
+		"""
+		if barrier < max(self.received.get((uuid_hex, entity_id), 0), self.received.get((uuid_hex, SESSION), 0)):
+			return STALE
+		if barrier > self.poems_received:
+			return HELD
+		return READY
+
+	def forget_session(self, uuid_hex):
+		"""
+		Drops the poem numbers of a session that was removed
+		"""
+		for keys in (self.sent, self.received):
+			for key in [key for key in keys if key[0] == uuid_hex]:
+				del keys[key]
+
+class DatagramLane:
+	"""
+	Datagram side channel of an EWProtocol link
+	"""
+	def __init__(self, link, port, token, addr=None):
+		"""
+		Args:
+			link: EWProtocol link this lane belongs to
+			port: DatagramPort datagrams are sent and received on
+			token: random token that identifies this lane in datagrams
+			addr: address of the other side, the internal proxy learns it from the first datagram instead
+		"""
+		self.link = link
+		self.order = link.entity_order
+		self.port = port
+		self.token = token
+		self.addr = addr
+
+		config = link.config["datagram"]
+		self.packets = set(config["packets"]) # Packet names that can be sent over this lane
+		self.ack_timeout = config["ack_timeout_ms"]/1000
+		self.loss = config["loss"] # Chance of dropping a datagram on purpose, to test the fallback
+
+		secret = link.config["global"]["secret"]
+		self.cipher = AESCrypt_Mursha27Fx43Fx2_IV12_NI(secret.encode()) if secret else None # Same key as the TCP link
+
+		self.seq = 0 # Sequence number of the last packet sent
+		self.output_buffer = [] # Packets waiting to be sent in the next datagrams
+		self.pending = {} # Unacked packets by entity key: (sequence number, time sent, uuid, packet name, packet data)
+		self.pending_keys = {} # Lookup for entity keys of unacked packets by sequence number
+		self.latest = {} # Newest sequence number received by entity key
+		self.held = [] # Received packets waiting for the poem they come after: (barrier, sequence number, uuid, packet name, packet)
+		self.acks = [] # Sequence numbers to ack
+		self.flush_call = None # Delayed call for flush
+		self.check_call = LoopingCall(self.check_pending)
+		self.keepalive_call = LoopingCall(self.send, KEEPALIVE, b"")
+
+	def start(self):
+		"""
+		Starts checking for lost datagrams
+		The side that knows the address sends keepalives, so the other side learns it
+		"""
+		self.port.lanes[self.token] = self
+		self.check_call.start(self.ack_timeout/2, now=False)
+
+		if self.addr:
+			self.keepalive_call.start(KEEPALIVE_INTERVAL)
+
+	def stop(self):
+		"""
+		Stops the lane, unacked packets are dropped along with the link
+		"""
+		self.port.lanes.pop(self.token, None)
+		for call in (self.check_call, self.keepalive_call):
+			if call.running:
+				call.stop()
+
+		if self.flush_call and self.flush_call.active():
+			self.flush_call.cancel()
+
+	def entity_key(self, uuid, packet_name, data):
+		"""
+		Gets the key packets supersede each other by
+		Entity packets start with the entity id, player packets are about the player itself
+		Args:
+			uuid: unique id of the client
+			packet_name: name of the packet
+			data: packet data
+		Returns:
+			tuple: uuid, packet name and entity id
+		"""
+		entity_id = None
+		if packet_name.startswith("entity_"):
+			entity_id = self.link.buff_class(data).unpack_varint()
+
+		return (uuid.to_hex(), packet_name, entity_id)
+
+	def buffer_packet(self, uuid, packet_name, packet_data):
+		"""
+		Adds a packet to the next datagram
+		It goes in the next poem instead if a packet of the same entity is waiting for it
+		Args:
+			uuid: unique id of the client the packet belongs to
+			packet_name: name of the packet
+			packet_data: buffer of the packet
+		Returns:
+			bool: whether the packet was added, False if it has to go in the poem
+		"""
+		data = packet_data.buff
+		key = self.entity_key(uuid, packet_name, data)
+		barrier = self.order.barrier(key[0], key[2])
+		if barrier is None:
+			return False
+
+		packet_data.discard()
+		self.seq += 1
+		buff_class = self.link.buff_class
+		entry = b"".join((
+			buff_class.pack_varint(self.seq),
+			buff_class.pack_varint(barrier),
+			buff_class.pack_uuid(uuid),
+			buff_class.pack_packet(buff_class.pack_string(packet_name) + data)
+		))
+
+		# The newest packet for an entity replaces the one waiting for an ack
+		old = self.pending.get(key)
+		if old:
+			self.pending_keys.pop(old[0], None)
+
+		self.pending[key] = (self.seq, barrier, reactor.seconds(), uuid, packet_name, data)
+		self.pending_keys[self.seq] = key
+		self.output_buffer.append(entry)
+		self.schedule_flush()
+		return True
+
+	def schedule_flush(self):
+		if not self.flush_call: # Packets added in the same reactor iteration share datagrams
+			self.flush_call = reactor.callLater(0, self.flush)
+
+	def flush(self):
+		"""
+		Sends buffered packets and acks
+		"""
+		self.flush_call = None
+
+		for kind, entries in ((PACKETS, self.output_buffer), (ACKS, [self.link.buff_class.pack_varint(seq) for seq in self.acks])):
+			datagram = []
+			size = 0
+			for entry in entries:
+				if datagram and size + len(entry) > MAX_DATAGRAM_SIZE:
+					self.send(kind, b"".join(datagram))
+					datagram = []
+					size = 0
+
+				datagram.append(entry)
+				size += len(entry)
+
+			if datagram:
+				self.send(kind, b"".join(datagram))
+
+		self.output_buffer = []
+		self.acks = []
+
+	def send(self, kind, payload):
+		"""
+		Sends a datagram to the other side
+		Args:
+			kind: kind of datagram
+			payload: datagram data
+		"""
+		if not self.addr or random.random() < self.loss:
+			return
+
+		data = bytes((kind,)) + payload
+		if self.cipher:
+			data = self.cipher.encrypt(self.token + data) # The token is repeated inside so garbage is never parsed
+
+		self.port.transport.write(self.token + data, self.addr)
+		self.link.stats["datagrams_sent"] += 1
+
+	def datagram_received(self, data):
+		"""
+		Parses a datagram from the other side
+		Args:
+			data: datagram data without the token
+		"""
+		if self.cipher:
+			try:
+				data = self.cipher.decrypt(data)
+			except ValueError:
+				return # Truncated or not from the other side
+
+			if data[:TOKEN_SIZE] != self.token:
+				return # Not from the other side
+
+			data = data[TOKEN_SIZE:]
+
+		if not data:
+			return
+
+		self.link.stats["datagrams_received"] += 1
+
+		kind = data[0]
+		buff = self.link.buff_class(data[1:])
+		try:
+			if kind == PACKETS:
+				self.parse_packets(buff)
+			elif kind == ACKS:
+				while True:
+					seq = buff.unpack_varint()
+					key = self.pending_keys.pop(seq, None)
+					if key and self.pending[key][0] == seq:
+						del self.pending[key]
+		except BufferUnderrun:
+			pass
+
+		buff.discard()
+
+	def parse_packets(self, buff):
+		"""
+		Delivers and acks packets from a datagram
+		Args:
+			buff: buffer of packed entries
+		"""
+		while True: # Unpack data until a bufferunderrun
+			seq = buff.unpack_varint()
+			barrier = buff.unpack_varint()
+			uuid = buff.unpack_uuid()
+			packet = buff.unpack_packet(self.link.buff_class)
+			packet_name = packet.unpack_string()
+			packet.save()
+
+			try:
+				client = self.link.get_client(uuid)
+				if not client or getattr(client, "protocol_mode", "play") != "play":
+					continue # The datagram overtook the poem that gets the client in game, let it be resent in a poem
+			except KeyError:
+				pass # The client is gone, ack so the packet isn't resent
+
+			self.acks.append(seq)
+			self.schedule_flush()
+			self.receive_packet(barrier, seq, uuid, packet_name, packet)
+
+	def parse_resent_packet(self, uuid, packet):
+		"""
+		Delivers a packet that was resent in a poem
+		Args:
+			uuid: unique id of the client
+			packet: buffer with the sequence number, barrier, packet name and packet data
+		"""
+		seq = packet.unpack_varint()
+		barrier = packet.unpack_varint()
+		packet_name = packet.unpack_string()
+		packet.save()
+		self.receive_packet(barrier, seq, uuid, packet_name, packet)
+
+	def receive_packet(self, barrier, seq, uuid, packet_name, packet):
+		"""
+		Delivers a packet once the poem it comes after arrived, unless a newer packet for its entity arrived first
+		Args:
+			barrier: number of the poem the packet comes after
+			seq: sequence number of the packet
+			uuid: unique id of the client
+			packet_name: name of the packet
+			packet: buffer of the packet
+		"""
+		key = self.entity_key(uuid, packet_name, packet.buff)
+		order = self.order.check(key[0], key[2], barrier)
+		if order == HELD:
+			self.held.append((barrier, seq, uuid, packet_name, packet))
+			self.link.stats["datagram_packets_held"] += 1
+		elif order == STALE:
+			self.link.stats["datagram_packets_stale"] += 1 # A newer packet for this entity came over the link
+		else:
+			self.deliver_packet(seq, uuid, packet_name, packet)
+
+	def release_held(self):
+		"""
+		Delivers held packets whose poem arrived, called after every poem
+		"""
+		if self.held:
+			held, self.held = self.held, []
+			for entry in held:
+				self.receive_packet(*entry)
+
+	def deliver_packet(self, seq, uuid, packet_name, packet):
+		"""
+		Delivers a packet if it is newer than the last datagram for its entity with the same state
+		Args:
+			seq: sequence number of the packet
+			uuid: unique id of the client
+			packet_name: name of the packet
+			packet: buffer of the packet
+		"""
+		key = self.entity_key(uuid, packet_name, packet.buff)
+		newest = max([self.latest.get(key, 0)] + [self.latest.get((key[0], name, key[2]), 0) for name in SUPERSEDED_BY.get(packet_name, ())])
+		if newest >= seq:
+			self.link.stats["datagram_packets_stale"] += 1
+			return # A newer packet for this entity was already delivered
+
+		self.latest[key] = seq
+		self.link.dispatch("deliver_packet", uuid, packet_name, packet)
+
+	def check_pending(self):
+		"""
+		Resends packets that were not acked in time in the link's next poem
+		"""
+		now = reactor.seconds()
+		lost = [key for key, (seq, barrier, sent, uuid, packet_name, data) in self.pending.items() if now - sent > self.ack_timeout]
+
+		buff_class = self.link.buff_class
+		for key in lost:
+			seq, barrier, sent, uuid, packet_name, data = self.pending.pop(key)
+			self.pending_keys.pop(seq, None)
+
+			# Poems are ordered with everything else on the link, the barrier drops it if the entity moved on over the link since
+			self.link.input_buffer.append((uuid, "datagram", buff_class(b"".join((buff_class.pack_varint(seq), buff_class.pack_varint(barrier), buff_class.pack_string(packet_name), data)))))
+
+		self.link.stats["datagram_fallbacks"] += len(lost)
+
+	def forget_session(self, uuid):
+		"""
+		Drops the sequence numbers of a session that was removed
+		Args:
+			uuid: unique id of the session
+		"""
+		uuid_hex = uuid.to_hex()
+		for key in [key for key in self.latest if key[0] == uuid_hex]:
+			del self.latest[key]
+
+		self.held = [entry for entry in self.held if entry[2] != uuid]
+		self.order.forget_session(uuid_hex)
+
+class DatagramPort(DatagramProtocol):
+	"""
+	UDP port that hands datagrams to the lane their token belongs to
+	"""
+	def __init__(self):
+		self.lanes = {} # Lookup for lanes by token
+
+	def datagramReceived(self, data, addr):
+		lane = self.lanes.get(data[:TOKEN_SIZE])
+		if not lane:
+			return # Unknown or closed lane
+
+		lane.addr = addr # Reply to wherever the other side sends from
+		lane.datagram_received(data[TOKEN_SIZE:])
+
+def new_token():
+	"""
+	Returns:
+		bytes: random lane token
+	"""
+	return secrets.token_bytes(TOKEN_SIZE)
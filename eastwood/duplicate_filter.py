@@ -0,0 +1,76 @@
+"""
+Time windowed duplicate detection for packets several links deliver
+Hashes are kept in two generations that rotate every window, so a hash is found for exactly one window after it was
+first seen no matter when in a generation that was, and lookups stay O(1)
+"""
+import time
+from mmh3 import hash128
+
+class DuplicateFilter:
+	"""
+	Remembers hashes of data by key (dimension) for a time window
+	"""
+	def __init__(self, window, clock=time.monotonic):
+		"""
+		Args:
+			window: seconds data counts as a duplicate for
+			clock: function returning the current time in seconds
+		"""
+		self.window = window
+		self.clock = clock
+		self.current = {} # Time first seen by key and hash, seen in the current generation
+		self.previous = {} # Same for the generation before it
+		self.rotated = clock()
+
+		self.checked = 0
+		self.duplicates = 0
+
+	def rotate(self, now):
+		"""
+		Starts a new generation once the current one is a window old, the previous one is dropped as everything in it is older than a window
+		"""
+		if now - self.rotated < self.window:
+			return
+
+		self.previous = self.current
+		self.current = {}
+		self.rotated = now
+
+	def is_duplicate(self, key, data):
+		"""
+		Checks whether data was seen in the last window, and remembers it if it wasn't
+		Args:
+			key: what the data belongs to, data is only compared with data of the same key
+			data: data to hash
+		Returns:
+			bool: whether data is a duplicate
+		"""
+		now = self.clock()
+		self.rotate(now)
+		self.checked += 1
+
+		entry = (key, hash128(data))
+		seen = self.current.get(entry)
+		if seen is None:
+			seen = self.previous.get(entry)
+
+		if seen is not None and now - seen <= self.window:
+			self.duplicates += 1
+			return True
+
+		self.current[entry] = now
+		return False
+
+	def get_stats(self):
+		"""
+		Returns:
+			dict: amount of checks, duplicates and remembered hashes, the duplicate rate and the estimated false positive rate
+		"""
+		entries = len(self.current) + len(self.previous)
+		return {
+			"checked": self.checked,
+			"duplicates": self.duplicates,
+			"entries": entries,
+			"duplicate_rate": self.duplicates / self.checked if self.checked else 0.0,
+			"false_positive_rate": entries / 2**128, # Chance a new packet collides with a remembered 128 bit hash
+		}
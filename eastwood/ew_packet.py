@@ -12,13 +12,15 @@ packet_names = [
 	("poem", "upstream downstream"),
 	# packet id # 0
 	# fields:
-	# 	per packet:
-	#		uuid: the user/sender of the packet
+	# 	per record:
+	#		byte: flags (see eastwood.poem)
+	#		varint: amount of recipients, only if the multicast flag is set
+	#		uuid: the user/sender of the packet, once per recipient
 	#		bytes: the packet itself
-	("delete_conn", "upstream"),
+	("delete_conn", "upstream downstream"),
 	# packet id # 1
 	# fields:
-	#	uuid: the user/sender to remove
+	#	uuid: the user/sender to remove, sent downstream when the internal proxy lost its connection to the server
 	("add_conn", "upstream"),
 	# packet id # 2
 	# fields:
@@ -36,7 +38,43 @@ packet_names = [
 	# packet id # 5
 	# fields:
 	# 	varint: dimension
-	#	bytes: chunk key
+	#	bytes: chunk key (8 bytes)
+	#	bool: whether the chunk is cached now
+	("hello", "upstream"),
+	# packet id # 6
+	# fields:
+	#	uuid: id of the external proxy, links with the same id share sessions and cache state
+	("datagram_token", "downstream"),
+	# packet id # 7
+	# fields:
+	#	bytes: token that starts every datagram of this link
+	("reference_reset", "upstream downstream"),
+	# packet id # 8
+	# fields:
+	#	varint: number of the poem the sender of this packet missed a reference in, counted from 1
+	#	varint: index of the record with the reference, it and every record after it are sent again after the reset record
+	("chunk_region", "upstream"),
+	# packet id # 9
+	# fields:
+	# 	varint: dimension
+	#	int: region x
+	#	int: region z
+	#	bytes: bitmap of the region's cached chunks, bit z*32 + x is the chunk at x, z in the region
+	("uncache_chunks", "upstream"),
+	# packet id # 10
+	# fields:
+	# 	varint: dimension
+	#	varint: amount of chunks
+	#	bytes: chunk keys, 8 bytes each, of chunks that are about to be evicted
+	("cache_version", "downstream"),
+	# packet id # 11
+	# fields:
+	#	bytes: snapshot id (8 bytes) of the cache state the internal proxy has, all zeros if none
+	#	varint: version of it
+	("cache_sync", "upstream"),
+	# packet id # 12
+	# fields:
+	#	see eastwood.cache_sync
 ]
 
 """
@@ -2,25 +2,54 @@
 The proxy layer after bungeecord and before the internal proxy, runs on the vps
 Acts as a proxy to intercept, encode, and send minecraft packets to the internal proxy
 """
+from multiprocessing import get_context
 from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
 
 from eastwood.external_proxy.external import ExternalProxyExternalFactory
 from eastwood.external_proxy.internal import ExternalProxyInternalFactory
-from eastwood.misc import parse_ip_port
+from eastwood.misc import listen_reuse_port, parse_ip_port
+from eastwood.supervisor import WorkerSupervisor, setup_logging
 
 def create(config):
 	"""
 	Does two things:
 	Creates an instance of ExternalProxyInternalFactory which communicates with the internal proxy
 	Creates an instance of ExternalProxyExternalFactory which communicates to the clients/bungee
+	If more than one worker is configured, the factories are created in worker processes instead
 	Args:
 		config: config dict
 	"""
+	num_workers = config["external"]["workers"]
+	if num_workers > 1:
+		# Every worker writes its connection count here, so the player limit is shared
+		connection_counts = get_context("spawn").Array("i", num_workers)
+
+		def reset_count(index):
+			connection_counts[index] = 0 # Crashed workers have no connections left
+
+		supervisor = WorkerSupervisor("external", run_worker, num_workers, args=(config, connection_counts))
+		supervisor.on_restart = reset_count
+		supervisor.start()
+		return
+
+	create_factories(config)
+
+def create_factories(config, connection_counts=None, worker_index=0):
+	"""
+	Creates the factories and starts connecting/listening
+	Args:
+		config: config dict
+		connection_counts: shared connection counts of all workers, None if there is only one process
+		worker_index: index of this worker in connection_counts
+	"""
 	# Create an instance of ExternalProxyInternalFactory which communicates with the internal proxy as a client
 	internal_factory = ExternalProxyInternalFactory("downstream", config)
 
 	# Creates an instance of ExternalProxyExternalFactory which communicates to the clients/bungee
 	server = ExternalProxyExternalFactory("upstream", config)
+	server.connection_counts = connection_counts
+	server.worker_index = worker_index
 
 	# Assign other_factory
 	internal_factory.other_factory = server
@@ -29,5 +58,29 @@ def create(config):
 	# Call reactor
 	internal_host, internal_port = parse_ip_port(config["external"]["internal"])
 	host, port = parse_ip_port(config["external"]["bind"])
-	reactor.connectTCP(internal_host, internal_port, internal_factory)
-	reactor.listenTCP(port, server, interface=host)
+	for _ in range(config["global"]["links"]): # Open every link to the internal proxy
+		reactor.connectTCP(internal_host, internal_port, internal_factory)
+
+	if connection_counts is None:
+		reactor.listenTCP(port, server, interface=host)
+	else:
+		listen_reuse_port(host, port, server) # Workers share the bind address, the kernel balances connections between them
+
+	if config["external"]["stats_interval"] > 0: # Log link and duplicate filter stats
+		LoopingCall(internal_factory.log_stats).start(config["external"]["stats_interval"], now=False)
+
+def run_worker(index, config, connection_counts):
+	"""
+	Entry point of an external worker process
+	Args:
+		index: index of this worker
+		config: config dict
+		connection_counts: shared connection counts of all workers
+	"""
+	setup_logging()
+
+	if config["chunk_caching"]["path"] != ":memory:":
+		config["chunk_caching"]["path"] += "_worker{}".format(index) # Every worker is its own peer with its own cache
+
+	create_factories(config, connection_counts, index)
+	reactor.run()
@@ -1,8 +1,12 @@
 from quarry.net.protocol import BufferUnderrun
+from twisted.internet import reactor
 
+from eastwood.chunk_transcoder import rebuild_chunk
 from eastwood.factories.mc_factory import MCFactory
+from eastwood.mc_compression import MinecraftCompressionInterface
 from eastwood.modules import Module
 from eastwood.modules.chunk_cacher import ChunkCacher
+from eastwood.non_blocking_io import HandlerManager
 from eastwood.protocols.mc_protocol import MCProtocol
 
 class ExternalProxyExternalModule(Module):
@@ -12,26 +16,28 @@ class ExternalProxyExternalModule(Module):
 	"""
 	def connectionMade(self):
 		# Make sure we are not over the connection limit
-		self.protocol.factory.num_connections += 1
-		if self.protocol.factory.num_connections > self.protocol.factory.max_connections:
+		if not self.protocol.factory.connection_added():
 			self.protocol.transport.loseConnection() # Kick
 			return
 
 		# Tell the other mcprotocol
 		try:
-			self.protocol.other_factory.instance.send_packet("add_conn", self.protocol.buff_class.pack_uuid(self.protocol.uuid))
+			self.protocol.link.send_packet("add_conn", self.protocol.buff_class.pack_uuid(self.protocol.uuid))
 		except AttributeError:
 			self.protocol.transport.loseConnection()
 
 	def connectionLost(self, reason):
 		# Subtract from conn limit
-		self.protocol.factory.num_connections -= 1
+		self.protocol.factory.connection_removed()
 
 		# Tell the internal mcprotocol
 		try:
-			self.protocol.other_factory.instance.send_packet("delete_conn", self.protocol.buff_class.pack_uuid(self.protocol.uuid))
+			self.protocol.link.send_packet("delete_conn", self.protocol.buff_class.pack_uuid(self.protocol.uuid))
 		except AttributeError:
-			pass
+			return
+
+		if self.protocol.link.datagram_lane:
+			self.protocol.link.datagram_lane.forget_session(self.protocol.uuid)
 
 	def packet_recv_handshake(self, buff):
 		"""
@@ -52,13 +58,28 @@ class ExternalProxyExternalModule(Module):
 	def packet_send_login_success(self, buff):
 		"""
 		Set protocol_mode to play
+		Compression is turned on first, the server's set_compression is handled by the internal proxy
 		https://wiki.vg/Protocol#Handshake
 		"""
+		threshold = self.protocol.factory.compression_threshold
+		if threshold >= 0:
+			self.protocol.send_packet("login_set_compression", self.protocol.buff_class.pack_varint(threshold))
+			self.protocol.compression_threshold = threshold # Both directions are compressed after set_compression
+
 		self.protocol.send_packet("login_success", buff.read()) # Send packet myself
 		self.protocol.protocol_mode = "play" # Change mode after sending to prevent an error
 
 		return ("login_success", None) # Prevent old packet from sending
 
+	def packet_send_chunk_data_transcoded(self, buff):
+		"""
+		Rebuilds a chunk the internal proxy transcoded, then handles it like any other chunk_data packet
+		"""
+		packet = self.protocol.buff_class(rebuild_chunk(self.protocol.buff_class, buff.read()))
+		new_packet = self.protocol.dispatch("packet_send_chunk_data", packet)
+
+		return new_packet or ("chunk_data", self.protocol.buff_class(packet.buff))
+
 class ExternalProxyExternalProtocol(MCProtocol):
 	"""
 	The ExternalProxyExternalProtocol intercepts all packets sent to this proxy
@@ -68,11 +89,40 @@ class ExternalProxyExternalProtocol(MCProtocol):
 	def create(self):
 		super().create()
 		self.queue = [] # A queue exists at first to prevent packets from sending when the lan client/other mcprotocol hasn't been created yet
+		self.held_packets = None # Packets from the internal proxy waiting behind a chunk that is read from the cache or resent
+
+	def connectionMade(self):
+		# Pick the link before modules are called, they may send packets over it
+		self.link = self.other_factory.get_instance(self.uuid)
+
+		super().connectionMade()
 
 	def create_modules(self, modules):
 		new_modules = (ChunkCacher, ExternalProxyExternalModule) if self.config["chunk_caching"]["enabled"] else (ExternalProxyExternalModule,)
 		super().create_modules(new_modules + modules)
 
+	def hold_packets(self):
+		"""
+		Holds back packets to the client until release_packets is called
+		"""
+		if self.held_packets is None:
+			self.held_packets = []
+
+	def release_packets(self):
+		"""
+		Delivers held packets in order, the rest are held again if one of them starts a new hold
+		"""
+		if self.held_packets is None:
+			return
+
+		held, self.held_packets = self.held_packets, None
+		for i, (packet_name, packet) in enumerate(held):
+			if self.held_packets is not None:
+				self.held_packets.extend(held[i:])
+				return
+
+			self.link.dispatch("deliver_packet", self.uuid, packet_name, packet)
+
 	def packet_received(self, buff, name):
 		# Intercept packet here
 		if self.queue != None: # Queue exists, add them there instead
@@ -108,3 +158,39 @@ class ExternalProxyExternalFactory(MCFactory):
 
 		self.max_connections = config["external"]["player_limit"]
 		self.num_connections = 0
+		self.connection_counts = None # Connection counts of every worker process, shared between them
+		self.worker_index = 0 # Index of this process in connection_counts
+
+		# Packets to clients are compressed in a thread pool
+		self.compression_threshold = config["external"]["compression_threshold"]
+		self.deflater = HandlerManager(config["external"]["compression_threads"],
+									MinecraftCompressionInterface,
+									"compress",
+									reactor.callFromThread,
+									plasma_args=(self.buff_class, self.compression_threshold),
+									callback_args=(self.frame_deflated,)
+									)
+		self.deflater.start()
+
+	def connection_added(self):
+		"""
+		Counts a new connection
+		Returns:
+			bool: whether the connection is within the player limit
+		"""
+		self.num_connections += 1
+		if self.connection_counts is None:
+			return self.num_connections <= self.max_connections
+
+		with self.connection_counts.get_lock():
+			self.connection_counts[self.worker_index] = self.num_connections
+			return sum(self.connection_counts) <= self.max_connections
+
+	def connection_removed(self):
+		"""
+		Uncounts a connection
+		"""
+		self.num_connections -= 1
+		if self.connection_counts is not None:
+			with self.connection_counts.get_lock():
+				self.connection_counts[self.worker_index] = self.num_connections
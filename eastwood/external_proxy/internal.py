@@ -1,5 +1,12 @@
+import logging, socket
+from collections import Counter
+from twisted.internet import reactor
 from twisted.internet.protocol import ReconnectingClientFactory
+from quarry.types.uuid import UUID
 
+from eastwood.cache_sync import send_cache_sync
+from eastwood.datagram import DatagramLane, DatagramPort
+from eastwood.misc import parse_ip_port
 from eastwood.modules import Module
 from eastwood.plasma import IteratedSaltedHash
 from eastwood.factories.ew_factory import EWFactory
@@ -9,6 +16,10 @@ class ExternalProxyInternalModule(Module):
 	"""
 	Handles sending data as buffered "poems" from clients to the internal proxy and vice versa
 	"""
+	def __init__(self, protocol):
+		super().__init__(protocol)
+
+		self.datagram_listener = None # UDP port of this link's datagram lane
 	def connectionMade(self):
 		"""
 		Send auth packet, otherwise packets will be dropped
@@ -25,6 +36,68 @@ class ExternalProxyInternalModule(Module):
 			self.protocol.send_packet("auth", data) # Send
 			self.logger.info("Sent auth packet")
 
+		# Tell the internal proxy which external proxy this link belongs to
+		self.protocol.send_packet("hello", self.protocol.buff_class.pack_uuid(self.protocol.factory.peer_id))
+
+	def connectionLost(self, reason):
+		"""
+		Kick clients that were using this link, their packets have nowhere to go
+		The cache state is sent in full over the link that is left
+		"""
+		for client in list(self.protocol.other_factory.uuid_dict.values()):
+			if client.link is self.protocol:
+				client.transport.loseConnection()
+
+		if self.datagram_listener:
+			self.datagram_listener.stopListening()
+
+		# Cache state sent over this link may be lost, the internal proxy gets all of it again over the link that takes over
+		if getattr(self.protocol.other_factory, "loaded_cache", False) and hasattr(self.protocol.factory, "synced_cache"):
+			self.protocol.factory.synced_cache = (None, 0)
+			send_cache_sync(self.protocol.factory.get_control_instance(), self.protocol.other_factory.cache_manager)
+
+	def packet_recv_datagram_token(self, buff):
+		"""
+		The internal proxy has datagrams enabled, open a lane to it
+		"""
+		if self.datagram_listener: # Only one lane per link
+			return
+
+		if not self.protocol.entity_order:
+			self.logger.warning("The internal proxy has datagrams enabled, but this proxy doesn't")
+			return
+
+		port = DatagramPort()
+		self.datagram_listener = reactor.listenUDP(0, port)
+
+		# Datagrams go to the same port number as the link, twisted needs the host to be an ip
+		host, internal_port = parse_ip_port(self.protocol.config["external"]["internal"])
+		addr = (socket.gethostbyname(host), internal_port)
+
+		self.protocol.datagram_lane = DatagramLane(self.protocol, port, buff.read(), addr)
+		self.protocol.datagram_lane.start()
+
+	def packet_recv_cache_version(self, buff):
+		"""
+		Version of the cache state the internal proxy has, the cache state is synced from it
+		"""
+		self.protocol.factory.synced_cache = (buff.read(8), buff.unpack_varint())
+
+		# Otherwise it is synced once the chunk cacher loaded the cache
+		if getattr(self.protocol.other_factory, "loaded_cache", False):
+			send_cache_sync(self.protocol.factory.get_control_instance(), self.protocol.other_factory.cache_manager)
+
+	def packet_recv_delete_conn(self, buff):
+		"""
+		The internal proxy lost the client's connection to the server, kick the client
+		"""
+		try:
+			client = self.protocol.other_factory.get_client(buff.unpack_uuid())
+		except KeyError:
+			return # Client disconnected already
+
+		client.transport.loseConnection()
+
 	def packet_recv_release_queue(self, buff):
 		"""
 		Allow client with packed uuid to send packets
@@ -35,9 +108,9 @@ class ExternalProxyInternalModule(Module):
 		except KeyError:
 			return # Client disconnected before we could release the queue
 
-		# Add queued packets to buffer
+		# Add queued packets to the buffer of the client's link
 		for packet_uuid, packet_name, packet_data in client.queue:
-			self.protocol.factory.input_buffer.append((uuid, packet_name, packet_data))
+			client.link.buffer_packet(uuid, packet_name, packet_data)
 
 		client.queue = None # Remove queue
 
@@ -45,6 +118,40 @@ class ExternalProxyInternalFactory(EWFactory, ReconnectingClientFactory):
 	"""
 	Quick and dirty hack to combine the ReconnectingClientFactory with the data of EWFactory
 	"""
+	def __init__(self, handle_direction, config):
+		super().__init__(handle_direction, config)
+		self.logger = logging.getLogger(name=self.__class__.__name__)
+		self.logger.setLevel(logging.INFO)
+
+		self.peer_id = UUID.random() # Identifies this external proxy (or worker) to the internal proxy, which can serve many at once
+
 	def buildProtocol(self, addr):
 		self.resetDelay() # Reset the reconnect delay
 		return EWProtocol(self, self.buff_class, self.handle_direction, self.other_factory, self.config, modules=(ExternalProxyInternalModule,))
+
+	def get_stats(self):
+		"""
+		Returns:
+			dict: stats of each link, and of the duplicate packet filter if chunk caching is enabled
+		"""
+		stats = {
+			"links": [dict(link.stats) for link in self.instances],
+			"total": dict(sum((link.stats for link in self.instances), Counter()))
+		}
+
+		processed_packets = getattr(self.other_factory, "processed_packets", None) # Created by the first chunk cacher
+		if processed_packets:
+			stats["duplicate_filter"] = processed_packets.get_stats()
+
+		return stats
+
+	def log_stats(self):
+		"""
+		Logs the stats of this external proxy
+		"""
+		stats = self.get_stats()
+		self.logger.info("Peer {}: {} links, {}".format(self.peer_id.to_hex(), len(stats["links"]), stats["total"]))
+
+		duplicates = stats.get("duplicate_filter")
+		if duplicates:
+			self.logger.info("Duplicate filter: {} checked, {:.1%} duplicates, {} hashes remembered, {:.1e} false positive rate".format(duplicates["checked"], duplicates["duplicate_rate"], duplicates["entries"], duplicates["false_positive_rate"]))
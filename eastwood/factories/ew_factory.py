@@ -1,5 +1,3 @@
-from collections import deque
-
 from eastwood.factories.base_factory import BaseFactory
 from eastwood.protocols.ew_protocol import EWProtocol
 
@@ -16,5 +14,29 @@ class EWFactory(BaseFactory):
 			config: config dict
 		"""
 		super().__init__(handle_direction, config)
-		self.input_buffer = deque()
-		self.instance = None # Only one protcol can exist in EWFactory
+		self.instances = [] # Connected links, clients are sharded across them
+		self.max_instances = config["global"]["links"]
+
+	def get_instance(self, uuid):
+		"""
+		Gets the link a client's packets should be sent over
+		Args:
+			uuid: unique id of client
+		Returns:
+			protocol: link protocol, or None if there are no links
+		"""
+		if not self.instances:
+			return None
+
+		return self.instances[uuid.int % len(self.instances)]
+
+	def get_control_instance(self):
+		"""
+		Gets the link that cache state is sent over, one link keeps it in order
+		Returns:
+			protocol: link protocol, or None if there are no links
+		"""
+		if not self.instances:
+			return None
+
+		return self.instances[0]
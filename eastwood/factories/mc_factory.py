@@ -15,6 +15,8 @@ class MCFactory(BaseFactory):
 		"""
 		super().__init__(handle_direction, config)
 		self.uuid_dict = {} # Lookup for connection protocols by uuid
+		self.inflater = None # HandlerManager shared by every connection to decompress packets with, None to decompress inline
+		self.deflater = None # HandlerManager shared by every connection to compress packets with, None to compress inline
 
 	def get_client(self, uuid):
 		"""
@@ -25,3 +27,22 @@ class MCFactory(BaseFactory):
 			protocol: protocol of client
 		"""
 		return self.uuid_dict[uuid.to_hex()]
+
+	def frame_inflated(self, data, protocol):
+		"""
+		Handles a packet decompressed by the inflater
+		Args:
+			data: packet id and packet data
+			protocol: protocol the packet was received by
+		"""
+		if protocol.transport.connected and not protocol.transport.disconnecting: # Packets after a kick are dropped
+			protocol.frame_received(self.buff_class(data))
+
+	def frame_deflated(self, data, protocol):
+		"""
+		Writes a packet compressed by the deflater
+		Args:
+			data: packet frame
+			protocol: protocol the packet is sent by
+		"""
+		protocol.transport.write(data)
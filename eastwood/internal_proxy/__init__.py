@@ -4,25 +4,37 @@ The internal proxy's job is to recieve packets from the external proxy and emula
 It also sends server packets back to the external proxy to be distributed to the clients
 """
 from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
 
-from eastwood.factories.ew_factory import EWFactory
+from eastwood.datagram import DatagramPort
 from eastwood.internal_proxy.external import InternalProxyExternalFactory
-from eastwood.internal_proxy.internal import InternalProxyInternalProtocol
+from eastwood.internal_proxy.internal import InternalProxyInternalFactory
+from eastwood.internal_proxy.shard import ShardManagerFactory, run_worker
 from eastwood.misc import parse_ip_port
+from eastwood.supervisor import WorkerSupervisor
 
 def create(config):
 	"""
-	Create an instance of InternalProxyInternalProtocol which communicates with the external proxy
+	Create an instance of InternalProxyInternalFactory which communicates with the external proxies
 	Create an instance of InternalProxyExternalFactory which controls the clients to the real server
+	If more than one worker is configured, a ShardManagerFactory relays clients to worker processes instead
 	Args:
 		config: config dict
 	"""
-	# Create an instance of EWFactory with InternalProxyInternalProtocol which communicates with the external proxy
-	internal_factory = EWFactory("upstream", config)
-	internal_factory.protocol = InternalProxyInternalProtocol
+	# Create an instance of InternalProxyInternalFactory which communicates with the external proxies
+	internal_factory = InternalProxyInternalFactory("upstream", config)
 
-	# Create an instance of InternalProxyExternalFactory which controls the clients to the real server
-	client_man = InternalProxyExternalFactory(config)
+	num_workers = config["internal"]["workers"]
+	if num_workers > 1:
+		# Create an instance of ShardManagerFactory which hands clients to the workers
+		client_man = ShardManagerFactory(config)
+
+		# Workers connect back to the front process on a local port
+		shard_port = reactor.listenTCP(0, client_man, interface="127.0.0.1").getHost().port
+		WorkerSupervisor("internal", run_worker, num_workers, args=(config, shard_port)).start()
+	else:
+		# Create an instance of InternalProxyExternalFactory which controls the clients to the real server
+		client_man = InternalProxyExternalFactory(config)
 
 	# Assign other_factory
 	internal_factory.other_factory = client_man
@@ -30,3 +42,10 @@ def create(config):
 
 	host, port = parse_ip_port(config["internal"]["bind"])
 	reactor.listenTCP(port, internal_factory, interface=host)
+
+	if config["datagram"]["enabled"]: # Datagrams are received on the same port number
+		internal_factory.datagram_port = DatagramPort()
+		reactor.listenUDP(port, internal_factory.datagram_port, interface=host)
+
+	if config["internal"]["stats_interval"] > 0: # Log link stats of every external proxy
+		LoopingCall(internal_factory.log_stats).start(config["internal"]["stats_interval"], now=False)
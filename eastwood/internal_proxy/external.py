@@ -1,10 +1,17 @@
-from twisted.internet import reactor
+from collections import OrderedDict
+from mmh3 import hash_bytes
+from twisted.internet import reactor, threads
 from twisted.internet.protocol import ClientFactory
 from quarry.types.uuid import UUID
 
+from eastwood.cache_sync import unpack_cache_sync
+from eastwood.chunk_delta import column_version, make_delta
+from eastwood.chunk_transcoder import transcode_chunk
 from eastwood.factories.mc_factory import MCFactory
+from eastwood.mc_compression import MinecraftCompressionInterface
 from eastwood.misc import parse_ip_port
 from eastwood.modules import Module
+from eastwood.non_blocking_io import HandlerManager
 from eastwood.protocols.mc_protocol import MCProtocol
 from eastwood.server_pinger import ServerPingerFactory
 
@@ -17,9 +24,26 @@ class InternalProxyExternalModule(Module):
 
 		self.dimension = 0 # Player dimension, used for tracking chunks
 
+		chunk_caching = self.protocol.config["chunk_caching"]
+		self.cache_light = chunk_caching["light"]
+		self.light_per_player = chunk_caching["light_per_player"]
+		self.light_hashes = OrderedDict() # Hashes of the last light arrays sent in full to this player, oldest first
+		self.resend_chunks = chunk_caching["resend_chunks"]
+		self.sent_chunks = OrderedDict() # Chunks sent by key and hash to this player, kept in case the external proxy asks for them, oldest first
+		self.sent_lights = OrderedDict() # Light updates sent with cached arrays by chunk key and hash, kept in case the external proxy asks for them, oldest first
+
 	def connectionMade(self):
 		# Protocol is connected, allow the other MCProtocol to send packets
-		self.protocol.other_factory.instance.send_packet("release_queue", self.protocol.buff_class.pack_uuid(self.protocol.uuid))
+		self.protocol.link.send_packet("release_queue", self.protocol.buff_class.pack_uuid(self.protocol.uuid))
+
+	def packet_recv_login_set_compression(self, buff):
+		"""
+		Decompress server packets from now on, the external proxy compresses for the client itself
+		The raw packets are sent over the link, so poems are only compressed once
+		"""
+		self.protocol.compression_threshold = buff.unpack_varint()
+
+		return ("login_set_compression", None) # The client gets the external proxy's threshold instead
 
 	def packet_recv_login_success(self, buff):
 		# Switch protocol mode to play
@@ -73,7 +97,9 @@ class InternalProxyExternalModule(Module):
 
 	def packet_recv_chunk_data(self, buff):
 		"""
-		If chunk is cached on the other side, strip chunk packet of all data instead of the key
+		If the other side should have this version of the chunk cached, only the key and the hash of the chunk are sent
+		If it has another version, only the sections it doesn't have are sent as a delta against it
+		The external proxy checks the hashes against its copy and asks for the chunk with chunk_nack if they differ
 		"""
 		chunk_x, chunk_z, full_chunk = buff.unpack("ii?") # Use the chunk x and z values in bytes as the key
 		chunk_key = self.protocol.buff_class.pack("ii", chunk_x, chunk_z)
@@ -81,9 +107,136 @@ class InternalProxyExternalModule(Module):
 		if not full_chunk:
 			return # Ignore non full chunks
 
-		if chunk_key in self.protocol.factory.cache_lists[self.dimension]:
-			# Send stripped chunk packet if cached
-			return ("chunk_data", self.protocol.buff_class(b"".join((chunk_key, self.protocol.buff_class.pack("?", True)))))
+		if self.protocol.peer.cached_chunks.contains(self.dimension, chunk_key):
+			data = buff.read() # Everything after the full chunk bool, as the external proxy caches it
+			body_hash = hash_bytes(data)
+			chunk_versions = self.protocol.peer.chunk_versions[self.dimension]
+			base = chunk_versions.get(chunk_key)
+
+			if base and base[0] == body_hash:
+				self.keep_chunk(chunk_key, body_hash, buff.buff)
+				self.protocol.link.stats["chunk_references"] += 1
+				return ("chunk_reference", self.protocol.buff_class(chunk_key + body_hash))
+
+			if base:
+				delta, chunk_versions[chunk_key] = make_delta(self.protocol.buff_class, base, data)
+				if delta:
+					self.keep_chunk(chunk_key, body_hash, buff.buff)
+					self.protocol.link.stats["chunk_deltas"] += 1
+					return ("chunk_delta", self.protocol.buff_class(b"".join((chunk_key, base[0], body_hash, delta))))
+			else:
+				chunk_versions[chunk_key] = column_version(self.protocol.buff_class, data) # The external proxy caches the version sent in full
+
+		if self.protocol.transcode_chunks:
+			self.transcode_chunk(buff.buff)
+			return ("chunk_data", None) # Buffered once transcoded
+
+	def packet_recv_update_light(self, buff):
+		"""
+		Light arrays of cached chunks that were sent to this player before are replaced by their hash
+		The external proxy keeps the arrays by hash, packets of one player are always in order so the array gets there first
+		The update is kept by its hash in case the external proxy evicted an array and asks for it in full with light_nack
+		"""
+		chunk_x = buff.unpack_varint()
+		chunk_z = buff.unpack_varint()
+		chunk_key = self.protocol.buff_class.pack("ii", chunk_x, chunk_z)
+
+		if not self.cache_light or not self.protocol.peer.cached_chunks.contains(self.dimension, chunk_key):
+			return # Only chunks the external proxy caches
+
+		packet_hash = hash_bytes(buff.buff)
+		cached = False
+
+		sky_mask, block_mask = buff.unpack_varint(), buff.unpack_varint()
+		buff.unpack_varint() # Empty sky light mask
+		buff.unpack_varint() # Empty block light mask
+
+		data = [packet_hash, buff.buff[:buff.pos]] # Chunk position and masks are kept
+		for _ in range(bin(sky_mask).count("1") + bin(block_mask).count("1")):
+			array = buff.read(buff.unpack_varint())
+			light_hash = hash_bytes(array)
+
+			if light_hash in self.light_hashes:
+				self.light_hashes.move_to_end(light_hash)
+				data.append(b"\x01" + light_hash)
+				cached = True
+			else:
+				self.light_hashes[light_hash] = None
+				if len(self.light_hashes) > self.light_per_player:
+					self.light_hashes.popitem(last=False)
+				data.append(b"\x00" + self.protocol.buff_class.pack_varint(len(array)) + array)
+
+		data.append(buff.read())
+		if cached:
+			self.sent_lights[chunk_key + packet_hash] = buff.buff
+			self.sent_lights.move_to_end(chunk_key + packet_hash)
+			if len(self.sent_lights) > self.resend_chunks:
+				self.sent_lights.popitem(last=False)
+
+		return ("update_light_cached", self.protocol.buff_class(b"".join(data)))
+
+	def packet_send_light_miss(self, buff):
+		"""
+		The external proxy no longer has a light array, it is sent in full next time
+		"""
+		self.light_hashes.pop(buff.read(), None)
+
+		return ("light_miss", None) # Not a minecraft packet
+
+	def packet_send_light_nack(self, buff):
+		"""
+		The external proxy no longer has an array of a light update, the update is resent in full
+		It is sent empty if it was forgotten, the external proxy stops waiting for it then
+		"""
+		reference = buff.read() # Chunk key and hash of the update_light packet
+		data = self.sent_lights.get(reference, b"")
+
+		self.protocol.link.buffer_packet(self.protocol.uuid, "light_resend", self.protocol.buff_class(reference + data))
+
+		return ("light_nack", None) # Not a minecraft packet
+
+	def keep_chunk(self, chunk_key, body_hash, data):
+		"""
+		Keeps a chunk that wasn't sent in full until it is surely not asked for anymore
+		Args:
+			chunk_key: chunk x and z
+			body_hash: hash of everything after the full chunk bool
+			data: chunk_data packet data
+		"""
+		self.sent_chunks[chunk_key + body_hash] = data
+		self.sent_chunks.move_to_end(chunk_key + body_hash)
+		if len(self.sent_chunks) > self.resend_chunks:
+			self.sent_chunks.popitem(last=False)
+
+	def packet_send_chunk_nack(self, buff):
+		"""
+		The external proxy's copy of a referenced or delta encoded chunk is different or gone, the chunk is resent in full
+		It is sent empty if it was forgotten, the external proxy stops waiting for it then
+		"""
+		reference = buff.read() # Chunk key and hash, chunks with the same data can be at different positions
+		data = self.sent_chunks.get(reference, b"")
+
+		self.protocol.link.stats["chunk_resends"] += 1
+		self.protocol.link.buffer_packet(self.protocol.uuid, "chunk_resend", self.protocol.buff_class(reference + data))
+
+		return ("chunk_nack", None) # Not a minecraft packet
+
+	def transcode_chunk(self, data):
+		"""
+		Transcodes chunk sections in the thread pool, the chunk is sent as it is if they can't be transcoded
+		Args:
+			data: chunk_data packet data
+		"""
+		buff_class = self.protocol.buff_class
+
+		def transcoded(new_data):
+			if new_data is None:
+				return ("chunk_data", buff_class(data))
+			return ("chunk_data_transcoded", buff_class(new_data))
+
+		deferred = threads.deferToThread(transcode_chunk, buff_class, data)
+		deferred.addCallbacks(transcoded, lambda failure: ("chunk_data", buff_class(data)))
+		self.protocol.link.buffer_deferred(self.protocol.uuid, deferred)
 
 class InternalProxyExternalProtocol(MCProtocol):
 	"""
@@ -92,6 +245,8 @@ class InternalProxyExternalProtocol(MCProtocol):
 	def create(self):
 		super().create()
 		self.ip_forward = self.config["global"]["ip_forwarding"]
+		self.peer = None # External proxy this client belongs to, set by the factory
+		self.transcode_chunks = self.config["poem"]["transcode_chunks"]
 
 	def create_modules(self, modules):
 		super().create_modules((InternalProxyExternalModule,) + modules)
@@ -109,17 +264,84 @@ class InternalProxyExternalFactory(MCFactory, ClientFactory):
 		self.mc_host, self.mc_port = parse_ip_port(config["internal"]["minecraft"])
 		self.ping_factory = ServerPingerFactory(self.mc_host, self.mc_port)
 		self.ping_factory.callback = self.on_successful_ping
+		self.link_dict = {} # Links and peers of reserved connections, handed to the protocol when it is built
+
+		# Server packets of every client are decompressed in a thread pool
+		self.inflater = HandlerManager(config["internal"]["inflate_threads"],
+									MinecraftCompressionInterface,
+									"decompress",
+									reactor.callFromThread,
+									plasma_args=(self.buff_class,),
+									callback_args=(self.frame_inflated,)
+									)
+		self.inflater.start()
 
-	def add_connection(self, uuid):
+	def add_connection(self, uuid, link):
 		"""
 		Adds a connection to this factory
 		Note: If there is a uuid conflict, undefined behavior will occur
 		Args:
 			uuid: idenifier of connection
+			link: EWProtocol link the connection's packets are sent over
 		"""
 		self.uuid_dict[uuid.to_hex()] = None # Reserve the spot (connection will be created by a ping call
+		self.link_dict[uuid.to_hex()] = (link, link.peer) # The peer is saved now, as a worker link can change peers
 		self.ping_factory.connect()
 
+	def remove_connection(self, uuid):
+		"""
+		Removes a connection from this factory
+		Args:
+			uuid: idenifier of connection
+		"""
+		try:
+			self.get_client(uuid).transport.loseConnection()
+		except KeyError:
+			pass # Already gone
+		except AttributeError:
+			del self.uuid_dict[uuid.to_hex()] # Delete the reference if it is none
+			self.link_dict.pop(uuid.to_hex(), None)
+
+	def link_lost(self, link):
+		"""
+		Disconnects connections that were using a link
+		Args:
+			link: EWProtocol link that was lost
+		"""
+		for client in list(self.uuid_dict.values()):
+			if client and client.link is link:
+				client.transport.loseConnection()
+
+	def toggle_chunk(self, peer, dimension, key, cached):
+		"""
+		Sets whether a chunk is cached by an external proxy
+		Args:
+			peer: external proxy the chunk is cached by
+			dimension: dimension of the chunk
+			key: chunk key
+			cached: whether it is cached
+		"""
+		peer.toggle_chunk(dimension, key, cached)
+
+	def sync_cache(self, peer, data):
+		"""
+		Applies a cache_sync from an external proxy
+		Args:
+			peer: external proxy that sent it
+			data: packet data
+		"""
+		peer.sync_cache(*unpack_cache_sync(self.buff_class, self.buff_class(data)))
+
+	def uncache_chunks(self, peer, dimension, keys):
+		"""
+		Removes chunks an external proxy is about to evict
+		Args:
+			peer: external proxy the chunks were cached by
+			dimension: dimension of the chunks
+			keys: chunk keys
+		"""
+		peer.uncache_chunks(dimension, keys)
+
 	def do_ping(self):
 		# Only do the ping if there are null keys (reserved clients waiting to join)
 		if None in self.uuid_dict.values():
@@ -137,6 +359,7 @@ class InternalProxyExternalFactory(MCFactory, ClientFactory):
 			k = [*self.uuid_dict.keys()][[*self.uuid_dict.values()].index(None)]
 			pc = InternalProxyExternalProtocol(self, self.buff_class, self.handle_direction, self.other_factory, self.config)
 			pc.uuid = UUID(hex=k)
+			pc.link, pc.peer = self.link_dict.pop(k)
 			return pc
 		except ValueError:
 			pass
@@ -1,5 +1,10 @@
+import logging, math
 from quarry.net.protocol import BufferUnderrun
+from twisted.internet import reactor
 
+from eastwood.datagram import DatagramLane, new_token
+from eastwood.factories.ew_factory import EWFactory
+from eastwood.internal_proxy.peer import Peer
 from eastwood.modules import Module
 from eastwood.plasma import IteratedSaltedHash
 from eastwood.protocols.ew_protocol import EWProtocol
@@ -8,34 +13,71 @@ class InternalProxyInternalModule(Module):
 	"""
 	This internal module handles adding and removing pseudo clients
 	"""
-	def __init__(self, protocol):
-		super().__init__(protocol)
-
-		if not hasattr(self.protocol.other_factory, "cache_list"):
-			self.protocol.other_factory.cache_lists = {-1: [], 0: [], 1: []} # List to keep track of cached data
+	def packet_recv_hello(self, buff):
+		# Find out which external proxy is on the other end
+		self.protocol.factory.peer_hello(self.protocol, buff.unpack_uuid())
 
 	def packet_recv_add_conn(self, buff):
-		# Add a connection to InternalProxyMCClientFactory
-		self.protocol.other_factory.add_connection(buff.unpack_uuid())
+		uuid = buff.unpack_uuid()
+		if not self.protocol.peer:
+			self.logger.warning("Connection added before hello, disconnecting")
+			self.protocol.transport.loseConnection()
+			return
+
+		if not self.protocol.peer.add_session(uuid, self.protocol):
+			self.logger.warning("Connection {} already exists".format(uuid.to_hex()))
+			return
+
+		# Add a connection to InternalProxyMCClientFactory, its packets will be sent back over this link
+		self.protocol.other_factory.add_connection(uuid, self.protocol)
 
 	def packet_recv_toggle_chunk(self, buff):
 		dimension = buff.unpack_varint()
-		key = buff.read()
+		key = buff.read(8)
+		cached = buff.unpack("?")
+		if self.protocol.peer:
+			self.protocol.other_factory.toggle_chunk(self.protocol.peer, dimension, key, cached)
 
-		if key in self.protocol.other_factory.cache_lists[dimension]:
-			self.protocol.other_factory.cache_lists[dimension].remove(key)
-		else:
-			self.protocol.other_factory.cache_lists[dimension].append(key)
+	def packet_recv_cache_sync(self, buff):
+		"""
+		Which chunks the external proxy has cached, in bulk
+		"""
+		if self.protocol.peer:
+			self.protocol.other_factory.sync_cache(self.protocol.peer, buff.read())
+
+	def packet_recv_uncache_chunks(self, buff):
+		"""
+		Chunks the external proxy is about to evict, sent in batches
+		"""
+		dimension = buff.unpack_varint()
+		keys = [buff.read(8) for _ in range(buff.unpack_varint())]
+		if self.protocol.peer:
+			self.protocol.other_factory.uncache_chunks(self.protocol.peer, dimension, keys)
+
+	def packet_recv_chunk_region(self, buff):
+		"""
+		Sent by the shard front process to catch a worker up on the chunks a peer has cached
+		"""
+		dimension = buff.unpack_varint()
+		region_x, region_z = buff.unpack("ii")
+		if self.protocol.peer:
+			self.protocol.peer.set_chunk_region(dimension, region_x, region_z, buff.read())
 
 	def packet_recv_delete_conn(self, buff):
-		# Delete uuid connection
+		# Delete uuid connection, only if it belongs to the peer asking
 		uuid = buff.unpack_uuid()
-		try:
-			self.protocol.other_factory.get_client(uuid).transport.loseConnection()
-		except KeyError:
-			pass # Already gone
-		except AttributeError:
-			del self.protocol.other_factory.uuid_dict[uuid.to_hex()] # Delete the reference if it is none
+		if self.protocol.peer and self.protocol.peer.remove_session(uuid):
+			self.protocol.other_factory.remove_connection(uuid)
+
+			if self.protocol.datagram_lane:
+				self.protocol.datagram_lane.forget_session(uuid)
+
+	def connectionLost(self, reason):
+		"""
+		Disconnect emulated clients that were using this link
+		"""
+		self.protocol.other_factory.link_lost(self.protocol)
+		self.protocol.factory.peer_link_lost(self.protocol)
 
 class InternalProxyInternalProtocol(EWProtocol):
 	"""
@@ -49,6 +91,15 @@ class InternalProxyInternalProtocol(EWProtocol):
 	def create_modules(self, modules):
 		super().create_modules((InternalProxyInternalModule,) + modules)
 
+	def get_client(self, uuid):
+		"""
+		Only clients in the peer's own session namespace can be reached
+		"""
+		if not self.peer or not self.peer.owns(uuid):
+			raise KeyError(uuid.to_hex())
+
+		return super().get_client(uuid)
+
 	def packet_received(self, buff, name):
 		"""
 		Non AES version of parse_decrypted_packet
@@ -89,3 +140,109 @@ class InternalProxyInternalProtocol(EWProtocol):
 
 		# Either the auth packet was not valid, or the compare was rejected, dc
 		self.transport.loseConnection()
+
+class InternalProxyInternalFactory(EWFactory):
+	"""
+	Accepts links from any number of external proxies (peers)
+	Every peer gets its own sessions and cache state, and can open up to global.links links
+	"""
+	protocol=InternalProxyInternalProtocol
+	peer_timeout=300 # Seconds to remember a peer after its last link is lost, so it can reconnect
+
+	def __init__(self, handle_direction, config):
+		"""
+		Args:
+			handle_direction: direction packets being handled by this protocol are going (can be "clientbound" or "serverbound")
+			config: config dict
+		"""
+		super().__init__(handle_direction, config)
+		self.logger = logging.getLogger(name=self.__class__.__name__)
+		self.logger.setLevel(logging.INFO)
+
+		self.max_links = self.max_instances # The link limit is per peer
+		self.max_instances = math.inf
+		self.peers = {} # Lookup for peers by id
+		self.datagram_port = None # DatagramPort shared by the datagram lanes of every link, if enabled
+
+	def get_peer(self, peer_id):
+		"""
+		Gets a peer, creating it if it's new
+		Args:
+			peer_id: uuid of the peer
+		Returns:
+			Peer: the peer
+		"""
+		peer = self.peers.get(peer_id.to_hex())
+		if not peer:
+			peer = self.peers[peer_id.to_hex()] = Peer(peer_id)
+			self.logger.info("New peer {}".format(peer_id.to_hex()))
+
+		return peer
+
+	def peer_hello(self, link, peer_id):
+		"""
+		Assigns a link to the peer that sent the hello
+		Args:
+			link: link the hello was received on
+			peer_id: uuid of the peer
+		"""
+		peer = self.get_peer(peer_id)
+		if len(peer.links) >= self.max_links:
+			link.transport.loseConnection()
+			return
+
+		if peer.forget_call and peer.forget_call.active(): # The peer is back
+			peer.forget_call.cancel()
+
+		peer.links.append(link)
+		link.peer = peer
+
+		if self.datagram_port: # Give the link a datagram lane, the external proxy starts it with the token
+			link.datagram_lane = DatagramLane(link, self.datagram_port, new_token())
+			link.datagram_lane.start()
+			link.send_packet("datagram_token", link.datagram_lane.token)
+
+		# The external proxy syncs its cache state from the version this has
+		link.send_packet("cache_version", peer.cache_snapshot, self.buff_class.pack_varint(peer.cache_version))
+
+	def peer_link_lost(self, link):
+		"""
+		Removes a link from its peer, and forgets the peer later if it was the last one
+		Args:
+			link: link that was lost
+		"""
+		peer = link.peer
+		if not peer:
+			return
+
+		peer.remove_link(link)
+		if not peer.links:
+			peer.forget_call = reactor.callLater(self.peer_timeout, self.forget_peer, peer)
+
+	def forget_peer(self, peer):
+		"""
+		Drops a peer and its cache state
+		Args:
+			peer: peer to forget
+		"""
+		if self.peers.get(peer.peer_id.to_hex()) is peer and not peer.links:
+			del self.peers[peer.peer_id.to_hex()]
+			self.logger.info("Forgot peer {}".format(peer.peer_id.to_hex()))
+
+	def get_stats(self):
+		"""
+		Returns:
+			dict: stats of every peer, by peer id
+		"""
+		return {peer_hex: peer.get_stats() for peer_hex, peer in self.peers.items()}
+
+	def log_stats(self):
+		"""
+		Logs the stats of every peer
+		"""
+		for peer_hex, stats in self.get_stats().items():
+			total = stats["total"]
+			lookups = total.get("reference_hits", 0) + total.get("reference_stores", 0)
+			hit_rate = total.get("reference_hits", 0)/lookups if lookups else 0
+
+			self.logger.info("Peer {}: {} sessions, {} cached chunks, {} links, {:.1%} reference hit rate, {}".format(peer_hex, stats["sessions"], stats["cached_chunks"], len(stats["links"]), hit_rate, total))
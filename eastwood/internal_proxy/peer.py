@@ -0,0 +1,148 @@
+"""
+State the internal proxy keeps for every external proxy connected to it
+"""
+from collections import Counter, defaultdict
+
+from eastwood.cache_sync import SNAPSHOT_SIZE
+from eastwood.chunk_index import ChunkIndex
+
+class Peer:
+	"""
+	An external proxy, identified by the id it sends in its hello packet
+	Holds everything that is per external proxy instead of per link: its sessions and its cache state
+	"""
+	def __init__(self, peer_id):
+		"""
+		Args:
+			peer_id: uuid of the external proxy
+		"""
+		self.peer_id = peer_id
+		self.links = [] # Links of this peer
+		self.sessions = {} # Lookup for the link of each session by uuid, sessions of other peers can't be touched
+		self.cached_chunks = ChunkIndex() # Chunks cached by this peer
+		self.chunk_versions = defaultdict(dict) # Hashes of the version of each cached chunk this peer was last sent by dimension (see chunk_delta.column_version)
+		self.forget_call = None # Delayed call to forget this peer after its last link is lost
+		self.cache_snapshot = bytes(SNAPSHOT_SIZE) # Snapshot id and version of the last cache_sync (see cache_sync)
+		self.cache_version = 0
+
+	def add_session(self, uuid, link):
+		"""
+		Registers a session to this peer
+		Args:
+			uuid: unique id of the session
+			link: link the session was added on
+		Returns:
+			bool: False if the uuid is already taken
+		"""
+		if uuid.to_hex() in self.sessions:
+			return False
+
+		self.sessions[uuid.to_hex()] = link
+		return True
+
+	def remove_session(self, uuid):
+		"""
+		Unregisters a session
+		Args:
+			uuid: unique id of the session
+		Returns:
+			bool: whether the session belonged to this peer
+		"""
+		return self.sessions.pop(uuid.to_hex(), None) is not None
+
+	def owns(self, uuid):
+		"""
+		Checks if a session belongs to this peer
+		Args:
+			uuid: unique id of the session
+		"""
+		return uuid.to_hex() in self.sessions
+
+	def remove_link(self, link):
+		"""
+		Removes a link and the sessions that were added on it
+		Args:
+			link: link that was lost
+		"""
+		if link in self.links:
+			self.links.remove(link)
+
+		for uuid_hex, session_link in list(self.sessions.items()):
+			if session_link is link:
+				del self.sessions[uuid_hex]
+
+	def toggle_chunk(self, dimension, key, cached):
+		"""
+		Sets whether a chunk is cached by this peer
+		Args:
+			dimension: dimension of the chunk
+			key: chunk key
+			cached: whether it is cached
+		"""
+		self.cached_chunks.set(dimension, key, cached)
+		if not cached:
+			self.chunk_versions[dimension].pop(key, None)
+
+	def sync_cache(self, snapshot, version, full, dimensions):
+		"""
+		Applies a cache_sync
+		Args:
+			snapshot: snapshot id
+			version: version of the cache state
+			full: whether it is the whole state, chunks that aren't in it aren't cached
+			dimensions: region bitmaps or changes by dimension (see cache_sync.unpack_cache_sync)
+		"""
+		if full:
+			for dimension in list(self.cached_chunks.dimensions):
+				self.cached_chunks.dimensions[dimension].clear()
+
+			for dimension, bitmaps in dimensions.items():
+				for (region_x, region_z), bitmap in bitmaps.items():
+					self.cached_chunks.set_region(dimension, region_x, region_z, bitmap)
+
+			# Versions of chunks that aren't cached anymore are dropped
+			for dimension, versions in self.chunk_versions.items():
+				for key in [key for key in versions if not self.cached_chunks.contains(dimension, key)]:
+					del versions[key]
+		else:
+			for dimension, changes in dimensions.items():
+				for key, cached in changes:
+					self.toggle_chunk(dimension, key, cached)
+
+		self.cache_snapshot = snapshot
+		self.cache_version = version
+
+	def uncache_chunks(self, dimension, keys):
+		"""
+		Removes chunks the external proxy is about to evict
+		Args:
+			dimension: dimension of the chunks
+			keys: chunk keys
+		"""
+		for key in keys:
+			if self.cached_chunks.discard(dimension, key):
+				self.chunk_versions[dimension].pop(key, None)
+
+	def set_chunk_region(self, dimension, region_x, region_z, bitmap):
+		"""
+		Replaces which chunks of a region are cached by this peer
+		Args:
+			dimension: dimension of the region
+			region_x: region x
+			region_z: region z
+			bitmap: bitmap of the cached chunks (see chunk_index)
+		"""
+		for key in self.cached_chunks.set_region(dimension, region_x, region_z, bitmap):
+			self.chunk_versions[dimension].pop(key, None)
+
+	def get_stats(self):
+		"""
+		Returns:
+			dict: stats of this peer and each of its links
+		"""
+		return {
+			"sessions": len(self.sessions),
+			"cached_chunks": len(self.cached_chunks),
+			"links": [dict(link.stats) for link in self.links],
+			"total": dict(sum((link.stats for link in self.links), Counter()))
+		}
@@ -0,0 +1,321 @@
+"""
+Spreads the internal proxy's emulated clients over worker processes
+The front process keeps the links to the external proxy and relays every player's packets to the worker that owns them
+Workers hold the emulated connections to the minecraft server and do all of the per packet work
+"""
+import logging
+from twisted.internet import reactor
+from twisted.internet.protocol import ClientFactory
+from quarry.types.uuid import UUID
+
+from eastwood.cache_sync import unpack_cache_sync
+from eastwood.factories.ew_factory import EWFactory
+from eastwood.internal_proxy.external import InternalProxyExternalFactory
+from eastwood.internal_proxy.internal import InternalProxyInternalFactory, InternalProxyInternalModule
+from eastwood.modules import Module
+from eastwood.protocols.ew_protocol import EWProtocol, PoemModule
+from eastwood.supervisor import setup_logging
+
+def local_config(config):
+	"""
+	Config for links between processes on the same machine, they are neither authenticated nor encrypted
+	Args:
+		config: config dict
+	Returns:
+		dict: copy of config with the password and secret cleared
+	"""
+	new_config = dict(config)
+	new_config["global"] = dict(config["global"], password="", secret="")
+	new_config["datagram"] = dict(config["datagram"], enabled=False) # Workers are reached over loopback
+	return new_config
+
+class ShardClient:
+	"""
+	Stand-in for a client that lives in another process
+	Packets sent to it are added to the next poem of the link it is reached through
+	"""
+	def __init__(self, uuid, link):
+		"""
+		Args:
+			uuid: unique id of client
+			link: link the client is reached through
+		"""
+		self.uuid = uuid
+		self.link = link
+
+	def dispatch(self, function_name, *args, **kwargs):
+		"""
+		Packets are handled by the process that owns the client
+		"""
+
+	def send_packet(self, name, *data):
+		self.link.buffer_packet(self.uuid, name, self.link.buff_class(b"".join(data)))
+
+class ShardLinkProtocol(EWProtocol):
+	"""
+	Link between the front process and a worker
+	Poems are not compressed, and are sent as soon as the reactor is free instead of every buffer_ms
+	"""
+	poem_module=PoemModule
+
+	def create(self):
+		super().create()
+		self.flush_call = None # Delayed call for flush
+
+	def buffer_packet(self, uuid, packet_name, packet_data):
+		super().buffer_packet(uuid, packet_name, packet_data)
+		self.schedule_flush()
+
+	def buffer_deferred(self, uuid, deferred):
+		super().buffer_deferred(uuid, deferred)
+		deferred.addCallback(lambda packet: self.schedule_flush()) # Packets held back by it can be sent now
+
+	def schedule_flush(self):
+		if not self.flush_call: # Packets added in the same reactor iteration share a poem
+			self.flush_call = reactor.callLater(0, self.flush)
+
+	def flush(self):
+		self.flush_call = None
+		self.send_poem()
+
+class ShardFrontModule(Module):
+	"""
+	Relays control packets from a worker to the external proxy
+	"""
+	def packet_recv_release_queue(self, buff):
+		uuid = buff.unpack_uuid()
+		try:
+			self.protocol.factory.get_link_client(uuid).link.send_packet("release_queue", buff.pack_uuid(uuid))
+		except KeyError:
+			pass # Client disconnected already
+
+class ShardFrontProtocol(ShardLinkProtocol):
+	"""
+	Front process end of a worker link
+	"""
+	def create(self):
+		super().create()
+		self.selected_peer = None # Peer the worker applies control packets to, changed with a hello packet
+
+	def create_modules(self, modules):
+		super().create_modules((ShardFrontModule,) + modules)
+
+	def connectionMade(self):
+		super().connectionMade()
+
+		# Catch the worker up on chunks cached by the external proxies, a region at a time
+		if self in self.factory.instances:
+			for peer in self.factory.other_factory.peers.values():
+				for dimension in list(peer.cached_chunks.dimensions):
+					for (region_x, region_z), bitmap in peer.cached_chunks.region_bitmaps(dimension).items():
+						self.select_peer(peer)
+						self.send_packet("chunk_region", self.buff_class.pack_varint(dimension), self.buff_class.pack("ii", region_x, region_z), bitmap)
+
+	def select_peer(self, peer):
+		"""
+		Makes the worker apply the next control packets to a peer
+		Args:
+			peer: peer to select
+		"""
+		if self.selected_peer is not peer:
+			self.selected_peer = peer
+			self.send_packet("hello", self.buff_class.pack_uuid(peer.peer_id))
+
+	def connectionLost(self, reason):
+		if self in self.factory.instances:
+			self.factory.shard_lost(self)
+
+		super().connectionLost(reason)
+
+	def get_client(self, uuid):
+		"""
+		Packets from workers are relayed to the external proxy
+		"""
+		return self.factory.get_link_client(uuid)
+
+class ShardManagerFactory(EWFactory):
+	"""
+	Takes the place of InternalProxyExternalFactory in the front process
+	Assigns clients to workers by uuid and relays packets between them and the external proxy's links
+	"""
+	protocol=ShardFrontProtocol
+
+	def __init__(self, config):
+		"""
+		Args:
+			config: config dict
+		"""
+		super().__init__("downstream", local_config(config))
+		self.logger = logging.getLogger(name=self.__class__.__name__)
+		self.max_instances = config["internal"]["workers"]
+
+		self.shard_dict = {} # Lookup for worker links by client uuid
+		self.link_dict = {} # Lookup for external proxy links by client uuid
+
+	def get_client(self, uuid):
+		"""
+		Gets a client, packets sent to it are relayed to its worker
+		Args:
+			uuid: unique id of client
+		Returns:
+			ShardClient: client stand-in
+		"""
+		return ShardClient(uuid, self.shard_dict[uuid.to_hex()])
+
+	def get_link_client(self, uuid):
+		"""
+		Gets a client, packets sent to it are relayed to the external proxy
+		Args:
+			uuid: unique id of client
+		Returns:
+			ShardClient: client stand-in
+		"""
+		return ShardClient(uuid, self.link_dict[uuid.to_hex()])
+
+	def add_connection(self, uuid, link):
+		"""
+		Assigns a connection to a worker
+		Args:
+			uuid: idenifier of connection
+			link: EWProtocol link the connection's packets are sent over
+		"""
+		shard = self.get_instance(uuid)
+		if not shard:
+			self.logger.warning("No workers are connected, dropping connection {}".format(uuid.to_hex()))
+			return
+
+		self.shard_dict[uuid.to_hex()] = shard
+		self.link_dict[uuid.to_hex()] = link
+		shard.select_peer(link.peer)
+		shard.send_packet("add_conn", self.buff_class.pack_uuid(uuid))
+
+	def remove_connection(self, uuid):
+		"""
+		Removes a connection from its worker
+		Args:
+			uuid: idenifier of connection
+		"""
+		link = self.link_dict.pop(uuid.to_hex(), None)
+		shard = self.shard_dict.pop(uuid.to_hex(), None)
+		if shard and link:
+			shard.select_peer(link.peer)
+			shard.send_packet("delete_conn", self.buff_class.pack_uuid(uuid))
+
+	def link_lost(self, link):
+		"""
+		Removes connections that were using a link to the external proxy
+		Args:
+			link: EWProtocol link that was lost
+		"""
+		for uuid_hex, client_link in list(self.link_dict.items()):
+			if client_link is link:
+				self.remove_connection(UUID(hex=uuid_hex))
+
+	def shard_lost(self, shard):
+		"""
+		Forgets connections that were living on a worker, the external proxy disconnects their clients
+		Args:
+			shard: link of the worker that was lost
+		"""
+		for uuid_hex, client_shard in list(self.shard_dict.items()):
+			if client_shard is shard:
+				del self.shard_dict[uuid_hex]
+				link = self.link_dict.pop(uuid_hex, None)
+				if link and link.connected:
+					link.send_packet("delete_conn", self.buff_class.pack_uuid(UUID(hex=uuid_hex)))
+
+	def toggle_chunk(self, peer, dimension, key, cached):
+		"""
+		Sets whether a chunk is cached by an external proxy, for every worker
+		Args:
+			peer: external proxy the chunk is cached by
+			dimension: dimension of the chunk
+			key: chunk key
+			cached: whether it is cached
+		"""
+		peer.toggle_chunk(dimension, key, cached) # Replayed to workers that connect later
+
+		for shard in self.instances:
+			shard.select_peer(peer)
+			shard.send_packet("toggle_chunk", self.buff_class.pack_varint(dimension), key, self.buff_class.pack("?", cached))
+
+	def sync_cache(self, peer, data):
+		"""
+		Applies a cache_sync from an external proxy, for every worker
+		Args:
+			peer: external proxy that sent it
+			data: packet data
+		"""
+		peer.sync_cache(*unpack_cache_sync(self.buff_class, self.buff_class(data)))
+
+		for shard in self.instances:
+			shard.select_peer(peer)
+			shard.send_packet("cache_sync", data)
+
+	def uncache_chunks(self, peer, dimension, keys):
+		"""
+		Removes chunks an external proxy is about to evict, for every worker
+		Args:
+			peer: external proxy the chunks were cached by
+			dimension: dimension of the chunks
+			keys: chunk keys
+		"""
+		peer.uncache_chunks(dimension, keys)
+
+		for shard in self.instances:
+			shard.select_peer(peer)
+			shard.send_packet("uncache_chunks", self.buff_class.pack_varint(dimension), self.buff_class.pack_varint(len(keys)), *keys)
+
+class ShardWorkerFactory(InternalProxyInternalFactory, ClientFactory):
+	"""
+	Worker process end of the link to the front process
+	"""
+	def __init__(self, config):
+		"""
+		Args:
+			config: config dict
+		"""
+		super().__init__("upstream", local_config(config))
+
+	def peer_hello(self, link, peer_id):
+		"""
+		The front process selects which peer the next control packets are for
+		"""
+		link.peer = self.get_peer(peer_id)
+
+	def peer_link_lost(self, link):
+		pass # The worker stops with its link
+
+	def buildProtocol(self, addr):
+		return ShardLinkProtocol(self, self.buff_class, self.handle_direction, self.other_factory, self.config, modules=(InternalProxyInternalModule,))
+
+	def clientConnectionFailed(self, connector, reason):
+		if reactor.running:
+			reactor.stop() # The supervisor will start a new worker
+
+	def clientConnectionLost(self, connector, reason):
+		if reactor.running:
+			reactor.stop() # The front process is gone, so are our clients
+
+def run_worker(index, config, port):
+	"""
+	Entry point of an internal worker process
+	Args:
+		index: index of this worker
+		config: config dict
+		port: local port the front process listens on for workers
+	"""
+	setup_logging()
+
+	# Create an instance of ShardWorkerFactory which communicates with the front process
+	shard_factory = ShardWorkerFactory(config)
+
+	# Create an instance of InternalProxyExternalFactory which controls the clients to the real server
+	client_man = InternalProxyExternalFactory(config)
+
+	# Assign other_factory
+	shard_factory.other_factory = client_man
+	client_man.other_factory = shard_factory
+
+	reactor.connectTCP("127.0.0.1", port, shard_factory)
+	reactor.run()
@@ -0,0 +1,329 @@
+"""
+Append-only log chunk storage
+Chunk columns are compressed and appended to fixed size segment files that are read and written through mmap, an
+in-memory index points each key to its latest record. Replacing or removing a chunk only appends a record, segments
+that are mostly dead records are compacted by copying their live records to the end of the log. Over the capacity,
+the chunks of the oldest segment are picked for eviction and the segment is deleted once they are destroyed.
+The index isn't stored, it is rebuilt by scanning the segments when the store is opened. Scanning a segment stops
+at the first record that is cut off or doesn't match its checksum, which is where a crash stopped writing.
+
+Layout of a record:
+	unsigned int crc32 of everything after it
+	unsigned short key length
+	unsigned int data length, 0xFFFFFFFF for a removed key
+	key, data
+"""
+import mmap, os, struct, tempfile, time, zlib
+import zstandard as zstd
+
+HEADER = struct.Struct(">IHI")
+REMOVED = 0xFFFFFFFF
+
+class Segment:
+	"""
+	Segment file mapped in memory
+	"""
+	def __init__(self, path, size):
+		"""
+		Args:
+			path: file path, created with size zero bytes if it doesn't exist
+			size: size of new segments
+		"""
+		self.path = path
+		self.file = open(path, "a+b")
+		if os.path.getsize(path) < size:
+			self.file.truncate(size)
+
+		self.mapping = mmap.mmap(self.file.fileno(), 0)
+		self.end = 0 # Where the next record goes
+		self.live = 0 # Bytes of records the index points to
+
+	def scan(self):
+		"""
+		Reads records until the first one that is incomplete, moves the end after the last valid one
+		Returns:
+			generator: offsets, keys and data offsets and lengths (REMOVED for removed keys)
+		"""
+		offset = 0
+		while offset + HEADER.size <= len(self.mapping):
+			checksum, key_length, length = HEADER.unpack_from(self.mapping, offset)
+			record_end = offset + HEADER.size + key_length + (0 if length == REMOVED else length)
+			if not key_length or record_end > len(self.mapping) or zlib.crc32(self.mapping[offset + 4:record_end]) != checksum:
+				break
+
+			key = self.mapping[offset + HEADER.size:offset + HEADER.size + key_length]
+			yield offset, key, offset + HEADER.size + key_length, length
+			offset = record_end
+
+		self.end = offset
+
+	def append(self, key, data):
+		"""
+		Args:
+			key: record key
+			data: record data, None to remove the key
+		Returns:
+			int: offset of the data, None if the segment is full
+		"""
+		length = REMOVED if data is None else len(data)
+		record = HEADER.pack(0, len(key), length)[4:] + key + (data or b"")
+		if self.end + 4 + len(record) > len(self.mapping):
+			return None
+
+		offset = self.end
+		self.mapping[offset:offset + 4] = struct.pack(">I", zlib.crc32(record))
+		self.mapping[offset + 4:offset + 4 + len(record)] = record
+		self.end += 4 + len(record)
+		return offset + HEADER.size + len(key)
+
+	def close(self, delete=False):
+		self.mapping.close()
+		self.file.close()
+		if delete:
+			os.remove(self.path)
+
+class LogStore:
+	"""
+	Drop-in replacement for ChunkStore that keeps chunks in an append-only log instead of sqlite
+	Only used from one ChunkWorker at a time
+	"""
+	def __init__(self, capacity=268435456, path=":memory:", gctime=4, segment_bytes=16777216, level=3):
+		"""
+		Args:
+			capacity: bytes of compressed chunks to keep, the oldest segments are dropped first
+			path: path the segment files are named after, ":memory:" to keep them in a temporary directory
+			gctime: seconds between compacting and dropping segments
+			segment_bytes: size of a segment file, also the largest chunk that can be stored
+			level: zstd compression level of the chunks
+		"""
+		if path == ":memory:":
+			self.directory = tempfile.TemporaryDirectory() # Removed with the store
+			path = os.path.join(self.directory.name, "chunks")
+
+		self.path = path
+		self.capacity = capacity
+		self.gctime = gctime
+		self.last_gc = time.time()
+		self.segment_bytes = segment_bytes
+		self.compressor = zstd.ZstdCompressor(level=level)
+		self.decompressor = zstd.ZstdDecompressor()
+
+		self.index = {} # Segment, data offset and length by key
+		self.accessed = set() # Keys read since their segment was last compacted or dropped
+		self.segments = {} # Segments by number, oldest first
+		self.retiring = set() # Numbers of segments whose chunks were picked for eviction or copied, deleted once nothing points into them
+		self.evicted = [] # Chunks picked for eviction that weren't reported yet
+		self.removed = {} # Segment number of the removal record by removed key, kept while an older segment may hold the key
+
+		# Rebuild the index, later records replace earlier ones
+		directory, name = os.path.split(os.path.abspath(path))
+		numbers = sorted(int(file[len(name) + 1:-4]) for file in os.listdir(directory) if file.startswith(name + "_") and file.endswith(".log") and file[len(name) + 1:-4].isdigit())
+		for number in numbers:
+			segment = self.open_segment(number)
+			for offset, key, data_offset, length in segment.scan():
+				self.forget(key)
+				if length != REMOVED:
+					self.index[key] = (number, data_offset, length)
+					self.removed.pop(key, None)
+					segment.live += length
+				else:
+					self.removed[key] = number
+
+		self.active = self.segments[numbers[-1]] if numbers else self.open_segment(0)
+		self.active_number = numbers[-1] if numbers else 0
+
+	def __del__(self):
+		for segment in self.segments.values():
+			segment.close()
+
+	def open_segment(self, number):
+		segment = Segment("{}_{:06d}.log".format(self.path, number), self.segment_bytes)
+		self.segments[number] = segment
+		return segment
+
+	def forget(self, key):
+		"""
+		Removes a key from the index, the record it pointed to is dead
+		"""
+		location = self.index.pop(key, None)
+		if location is not None:
+			self.segments[location[0]].live -= location[2]
+
+	def append(self, key, data):
+		"""
+		Appends a record to the active segment, a new segment is started if it is full
+		"""
+		offset = self.active.append(key, data)
+		if offset is None:
+			self.active.mapping.flush()
+			self.active_number += 1
+			self.active = self.open_segment(self.active_number)
+			offset = self.active.append(key, data)
+			if offset is None:
+				raise ValueError("Chunk doesn't fit in a segment")
+
+		self.forget(key)
+		if data is not None:
+			self.index[key] = (self.active_number, offset, len(data))
+			self.removed.pop(key, None)
+			self.active.live += len(data)
+		else:
+			self.removed[key] = self.active_number
+
+	def rewrite(self, number, keep):
+		"""
+		Copies records of a segment to the end of the log, the segment is deleted once nothing points into it
+		Removal records are copied too while an older segment is left, it may still hold a record of the removed key
+		Args:
+			number: segment number
+			keep: function that returns whether to copy the record of a key, the other keys are picked for eviction
+		"""
+		segment = self.segments[number]
+		for key, (key_number, offset, length) in list(self.index.items()):
+			if key_number != number:
+				continue
+
+			if keep(key):
+				self.append(key, segment.mapping[offset:offset + length])
+			else:
+				self.evicted.append(key) # Readable until it is destroyed
+			self.accessed.discard(key)
+
+		older = min(self.segments) < number
+		for key, key_number in list(self.removed.items()):
+			if key_number != number:
+				continue
+
+			if older:
+				self.append(key, None)
+			else:
+				del self.removed[key] # Nothing older can bring the key back
+
+		self.retiring.add(number)
+		self.drop_retired()
+
+	def drop_retired(self):
+		"""
+		Deletes retiring segments nothing points into anymore
+		"""
+		for number in [number for number in self.retiring if not self.segments[number].live]:
+			self.retiring.remove(number)
+			self.segments.pop(number).close(delete=True)
+
+	def live_bytes(self):
+		"""
+		Returns:
+			int: bytes of records the index points to, without the ones picked for eviction
+		"""
+		return sum(segment.live for number, segment in self.segments.items() if number not in self.retiring)
+
+	def sealed(self):
+		"""
+		Returns:
+			list: numbers of the segments that aren't written to or retiring
+		"""
+		return [number for number in self.segments if number != self.active_number and number not in self.retiring]
+
+	def gc(self):
+		"""
+		Compacts the segment with the most dead records, and picks the chunks of the oldest segments for eviction while over the capacity
+		Chunks that were read since they were written are copied instead
+		"""
+		if time.time() - self.last_gc < self.gctime:
+			return
+
+		sealed = self.sealed()
+		if sealed:
+			number = min(sealed, key=lambda number: self.segments[number].live)
+			if self.segments[number].live < self.segment_bytes // 2:
+				self.rewrite(number, lambda key: True)
+
+		while self.live_bytes() > self.capacity and self.sealed():
+			self.rewrite(min(self.sealed()), lambda key: key in self.accessed)
+
+		self.drop_retired() # Their chunks may have been cached again since
+		self.active.mapping.flush()
+		self.last_gc = time.time()
+
+	def insert(self, identifier, data):
+		"""
+		Args:
+			identifier: chunk key
+			data: column data
+		"""
+		self.append(identifier, self.compressor.compress(data))
+		self.gc()
+
+	update = insert
+
+	def insert_many(self, items):
+		"""
+		Stores chunks and writes them to disk once
+		Args:
+			items: list of chunk keys and column data
+		Returns:
+			list: keys of the chunks picked for eviction since the last call
+		"""
+		for identifier, data in items:
+			self.append(identifier, self.compressor.compress(data))
+
+		self.active.mapping.flush()
+		self.gc()
+
+		evicted, self.evicted = self.evicted, []
+		return evicted
+
+	def destroy(self, identifier):
+		if identifier in self.index:
+			self.append(identifier, None)
+
+	def destroy_many(self, identifiers):
+		"""
+		Removes chunks, once the chunks picked for eviction aren't needed anymore
+		Args:
+			identifiers: chunk keys
+		"""
+		for identifier in identifiers:
+			self.destroy(identifier)
+
+		self.active.mapping.flush()
+		self.drop_retired()
+
+	def get_view(self, identifier):
+		"""
+		Returns:
+			memoryview: compressed chunk in the mapping of its segment, None if the chunk isn't stored
+		"""
+		location = self.index.get(identifier)
+		if location is None:
+			return None
+
+		number, offset, length = location
+		return memoryview(self.segments[number].mapping)[offset:offset + length]
+
+	def get(self, identifier):
+		"""
+		Args:
+			identifier: chunk key
+		Returns:
+			bytes: column data, None if the chunk isn't stored
+		"""
+		view = self.get_view(identifier)
+		if view is None:
+			return None
+
+		self.accessed.add(identifier)
+		try:
+			return self.decompressor.decompress(view) # Straight from the mapping
+		finally:
+			view.release() # Segments can't be closed while views into them exist
+
+	def get_all_identifiers(self):
+		return list(self.index)
+
+	def get_stats(self):
+		"""
+		Returns:
+			dict: amount of chunks and segments, and bytes of live records
+		"""
+		return {"chunks": len(self.index), "segments": len(self.segments), "live_bytes": self.live_bytes()}
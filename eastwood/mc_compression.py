@@ -0,0 +1,43 @@
+"""
+Minecraft packet compression (set_compression), handled in HandlerManager threads so zlib never blocks the reactor
+zlib releases the GIL, so a pool of threads compresses packets of different players in parallel
+"""
+import zlib
+
+class MinecraftCompressionInterface:
+	"""
+	Plasma-like interface that packs and unpacks compressed minecraft packet frames
+	"""
+	def __init__(self, buff_class, threshold=-1):
+		"""
+		Args:
+			buff_class: buffer class to pack varints with
+			threshold: packets this size or larger are compressed, -1 if compression is off
+		"""
+		self.buff_class = buff_class
+		self.threshold = threshold
+
+	def compress(self, data):
+		"""
+		Args:
+			data: packet id and packet data
+		Returns:
+			bytes: length prefixed packet frame, ready to be written
+		"""
+		return self.buff_class.pack_packet(data, self.threshold)
+
+	def decompress(self, data):
+		"""
+		Args:
+			data: body of a compressed packet frame (uncompressed length and the maybe compressed packet)
+		Returns:
+			bytes: packet id and packet data
+		"""
+		buff = self.buff_class(data)
+		uncompressed_length = buff.unpack_varint()
+		data = buff.read()
+
+		if uncompressed_length > 0: # Packets under the threshold are sent as they are
+			data = zlib.decompress(data)
+
+		return data
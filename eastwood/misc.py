@@ -1,3 +1,6 @@
+import socket
+from twisted.internet import reactor
+
 def parse_ip_port(string):
 	"""
 	Takes IP:PORT formatted string and splits the address + port, port is also casted to an int
@@ -6,3 +9,25 @@ def parse_ip_port(string):
 	"""
 	string = string.split(":")
 	return string[0], int(string[1])
+
+def listen_reuse_port(host, port, factory, backlog=50):
+	"""
+	Listens on a TCP port with SO_REUSEPORT set, so several processes can accept connections on the same address
+	Args:
+		host: interface to bind to
+		port: port to bind to
+		factory: twisted factory to build protocols with
+		backlog: listen backlog
+	Returns:
+		port: twisted listening port
+	"""
+	sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+	sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+	sock.bind((host, port))
+	sock.listen(backlog)
+	sock.setblocking(False)
+
+	listening_port = reactor.adoptStreamPort(sock.fileno(), socket.AF_INET, factory)
+	sock.close() # Twisted duplicates the fd
+	return listening_port
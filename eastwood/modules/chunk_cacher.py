@@ -1,13 +1,20 @@
 """
 Chunk caching system to reduce the netusage of the most expensive packet to send (chunk data packets)
 """
-from collections import defaultdict
-from mmh3 import hash128
-from twisted.internet import reactor
+from collections import OrderedDict, defaultdict
+from mmh3 import hash_bytes
+from quarry.net.protocol import BufferUnderrun
+from twisted.internet import defer, reactor
+from twisted.internet.task import LoopingCall
 
 from eastwood.bincache import Cache
+from eastwood.cache_manager import CacheManager
+from eastwood.cache_sync import send_cache_sync
+from eastwood.chunk_delta import apply_delta
+from eastwood.chunk_store import ChunkStore, ChunkWorker
+from eastwood.duplicate_filter import DuplicateFilter
+from eastwood.log_store import LogStore
 from eastwood.modules import Module
-from eastwood.plasma import ParallelCompressionInterface
 
 class ChunkCacher(Module):
 	"""
@@ -20,51 +27,94 @@ class ChunkCacher(Module):
 	# https://github.com/barneygale/minebnc/blob/master/plugins/world.py
 	def __init__(self, protocol):
 		super().__init__(protocol)
-		self.threshold = self.protocol.config["chunk_caching"]["threshold"]
+		self.resend_timeout = self.protocol.config["chunk_caching"]["resend_timeout"]
+		self.decoded_budget = self.protocol.config["chunk_caching"]["working_set_encoded_bytes"] # Limits the encoded size of the decoded chunks, not their memory
+		self.dirty_budget = self.protocol.config["chunk_caching"]["dirty_bytes"]
 		self.dimension = 0 # Player dimension, used for tracking chunks
-
-		self.plasma = ParallelCompressionInterface()
+		self.awaited_chunk = None # Key and hash of the chunk being read or asked for with chunk_nack or light_nack, packets to the client are held until it is sent
+		self.give_up_call = None # Delayed call to stop waiting for the chunk
 
 		# Factory variables that we set in this module's init
+		if not hasattr(self.protocol.factory, "chunk_worker"):
+			self.protocol.factory.chunk_worker = ChunkWorker() # Every store is only used on its thread
 		if not hasattr(self.protocol.factory, "caches"):
-			# Generate path extensions
+			# Generate path extensions, log segments are named after the path with their number and .log
+			backend = self.protocol.config["chunk_caching"]["backend"]
+			extension = ".db" if backend == "sqlite" else ""
 			path0 = path1 = path2 = self.protocol.config["chunk_caching"]["path"]
 			if path0 != ":memory:":
-				path0 += "_nether.db"
-				path1 += "_overworld.db"
-				path2 += "_end.db"
-
-			self.protocol.factory.caches = {-1: Cache(path=path0), 0: Cache(path=path1), 1: Cache(path=path2)} # Bincache for each dimension (-1=Nether, 0=Overworld, 1=End)
-		if not hasattr(self.protocol.factory, "tracker"):
-			self.protocol.factory.tracker = {-1: defaultdict(int), 0: defaultdict(int), 1: defaultdict(int)} # Dictionary to keep track of the amount of times chunks has been pulled
+				path0 += "_nether" + extension
+				path1 += "_overworld" + extension
+				path2 += "_end" + extension
+
+			# Chunk store for each dimension (-1=Nether, 0=Overworld, 1=End), chunks are compressed by the store
+			capacity = self.protocol.config["chunk_caching"]["capacity"]
+			if backend == "log":
+				store_class = LogStore
+				store_args = {"capacity": self.protocol.config["chunk_caching"]["log_bytes"]}
+			else:
+				store_class = ChunkStore
+				store_args = {"elements": capacity, "buff_class": self.protocol.buff_class} # Chunks are evicted by the cache manager first
+			self.protocol.factory.caches = {-1: store_class(path=path0, **store_args), 0: store_class(path=path1, **store_args), 1: store_class(path=path2, **store_args)}
+		if not hasattr(self.protocol.factory, "light_cache"):
+			path = self.protocol.config["chunk_caching"]["path"]
+			if path != ":memory:":
+				path += "_light.db"
+
+			self.protocol.factory.light_cache = Cache(capacity=self.protocol.config["chunk_caching"]["light_bytes"], path=path, hot_bytes=self.protocol.config["chunk_caching"]["light_hot_bytes"]) # Light arrays by hash, shared by every dimension
+		if not hasattr(self.protocol.factory, "cache_manager"):
+			self.protocol.factory.cache_manager = CacheManager(self.protocol.config["chunk_caching"]["capacity"], self.protocol.config["chunk_caching"]["threshold"]) # Decides which chunks are cached
 		if not hasattr(self.protocol.factory, "loaded_cache"):
 			self.protocol.factory.loaded_cache = False
 		if not hasattr(self.protocol.factory, "processed_packets"):
-			self.protocol.factory.processed_packets = {-1: [], 0: [], 1: []} # Hashes for processed packets to prevent duplicate processing
-
-			# Set timer to clear processed packets, this should be only called once
-			# It is set to be called after 2x the buffer_wait
-			reactor.callLater(self.protocol.config["global"]["buffer_ms"]/500, self.clear_processed_packets)
-		if not hasattr(self.protocol.factory, "last_grabbed_key"):
-			self.protocol.factory.last_grabbed_key = None
-		if not hasattr(self.protocol.factory, "last_grabbed_value"):
-			self.protocol.factory.last_grabbed_value = None
+			# Hashes of processed packets to prevent duplicate processing, remembered for 2x the buffer_wait
+			self.protocol.factory.processed_packets = DuplicateFilter(self.protocol.config["global"]["buffer_ms"]/500)
+		if not hasattr(self.protocol.factory, "decoded_chunks"):
+			self.protocol.factory.decoded_chunks = OrderedDict() # Working set of decoded chunks by dimension and key, oldest first
+			self.protocol.factory.decoded_bytes = 0 # Encoded size of the decoded chunks
+		if not hasattr(self.protocol.factory, "dirty_chunks"):
+			self.protocol.factory.dirty_chunks = OrderedDict() # Chunk data by dimension and key that isn't written to the cache yet
+			self.protocol.factory.dirty_bytes = 0
+
+			# Write them on a timer and before the proxy stops, this should be only set once
+			self.protocol.factory.flush_loop = LoopingCall(flush_chunks, self.protocol.factory)
+			self.protocol.factory.flush_loop.start(self.protocol.config["chunk_caching"]["flush_interval"], now=False)
+			reactor.addSystemEventTrigger("before", "shutdown", stop_chunk_cache, self.protocol.factory)
+		if not hasattr(self.protocol.factory, "uncaching"):
+			self.protocol.factory.uncaching = set() # Dimension and key of evicted chunks that are still readable
+			self.protocol.factory.uncache_pending = defaultdict(list) # Keys of evicted chunks the other protocol wasn't told about yet by dimension
+			self.protocol.factory.uncache_call = None # Delayed call to tell it
+		if not hasattr(self.protocol.factory, "applying"):
+			self.protocol.factory.applying = {} # Deferreds waiting for deltas being applied to chunks by dimension and key
+		if not hasattr(self.protocol.factory, "decoding"):
+			self.protocol.factory.decoding = {} # Deferreds waiting for chunks that are being decoded by dimension and key
+		if not hasattr(self.protocol.factory, "encoding"):
+			self.protocol.factory.encoding = {} # Deferreds waiting for changed decoded chunks that are being encoded by dimension and key
 
 	def connectionMade(self):
 		"""
-		Loads cached chunks into the tracker
-		Also sends over toggle_chunk packets for already cached chunks
+		Loads cached chunks into the cache manager
+		Then tells the other protocol about all of them in one cache_sync
 		"""
 		if self.protocol.factory.loaded_cache: # Should only be called once
 			return
 
+		deferreds = []
 		for i in self.protocol.factory.caches.keys():
-			for ident in self.protocol.factory.caches[i].get_all_identifiers():
-				self.protocol.factory.tracker[i][ident] = self.threshold + 1 # Set tracker to read from it
-				self.protocol.other_factory.instance.send_packet("toggle_chunk", self.protocol.buff_class.pack_varint(i), ident) # Send toggle_chunk
+			deferred = self.protocol.factory.chunk_worker.run(self.protocol.factory.caches[i].get_all_identifiers)
+			deferred.addCallback(self.load_identifiers, i)
+			deferreds.append(deferred)
 
+		defer.DeferredList(deferreds).addCallback(lambda _: send_cache_sync(self.protocol.other_factory.get_control_instance(), self.protocol.factory.cache_manager))
 		self.protocol.factory.loaded_cache = True
 
+	def load_identifiers(self, identifiers, dimension):
+		"""
+		Called with the chunks in the cache of a dimension
+		"""
+		for ident in identifiers:
+			self.protocol.factory.cache_manager.add(dimension, ident)
+
 	def packet_send_join_game(self, buff):
 		"""
 		Called when the client joins the game, we need to capture the dimension
@@ -92,7 +142,7 @@ class ChunkCacher(Module):
 				return
 
 			# Non full chunks act as a large multiblockchange
-			if self.protocol.factory.tracker[self.dimension][chunk_key] <= self.threshold: # Check if chunk is cached
+			if not self.protocol.factory.cache_manager.contains(self.dimension, chunk_key):
 				return # Ignore uncached changes
 
 			# Chunk bitmask
@@ -101,24 +151,9 @@ class ChunkCacher(Module):
 			# TODO: Actually care about this
 			buff.unpack_nbt() # Ignore heightmap data
 
-			# Unpack cached sections
-			sections, biomes = self.get_chunk_sections(chunk_key) # Get chunk
-			if not sections or not biomes:
-				# Data is gone! Ignore the change request
-				self.handle_missing_data(chunk_key)
-				return
-
 			# Unpack changed sections
 			changed_sections, _ = buff.unpack_chunk(prim_bit_mask, full_chunk, self.dimension == 0) # Varint is the bitmask
 
-			# Apply new sections if they are not empty
-			for i, new_section in enumerate(changed_sections):
-				if new_section:
-					sections[i] = new_section
-
-			# Update cache
-			self.set_chunk_sections(chunk_key, sections, biomes)
-
 			# Update block entities
 			tile_entities = {}
 			for _ in range(buff.unpack_varint()): # Loop through every tile entity
@@ -127,31 +162,285 @@ class ChunkCacher(Module):
 
 				tile_entities[(te_obj["x"], te_obj["y"], te_obj["z"])] = tile_entity
 
-			self.set_tile_entities(chunk_key, tile_entities)
+			def apply_changes(column):
+				if not column:
+					return # Data is gone! Ignore the change request
+
+				# Apply new sections if they are not empty
+				for i, new_section in enumerate(changed_sections):
+					if new_section:
+						column.sections[i] = new_section
+
+				column.tile_entities = tile_entities
+				column.dirty = True
+
+			self.get_decoded_chunk(chunk_key).addCallback(apply_changes)
 			return
 
-		if self.protocol.factory.tracker[self.dimension][chunk_key] < self.threshold:
-			# Chunk hasn't been pulled enough to warrant caching
-			self.protocol.factory.tracker[self.dimension][chunk_key] += 1
+		# The cache stores the everything in the chunk data packet after the full chunk bool
+		data = buff.read()
+		if self.protocol.factory.cache_manager.record(self.dimension, chunk_key):
+			self.set_cached_chunk(chunk_key, data) # Already cached, the other protocol knows
 			return
 
-		data = buff.read() # Get rest of chunk data
-		if not data:
-			# There is nothing here, this means we are supposed to send a cached chunk!
-			cached_data = self.generate_cached_chunk_packet(chunk_key)
-			if cached_data:
-				return ("chunk_data", self.protocol.buff_class(cached_data))
+		if (self.dimension, chunk_key) in self.protocol.factory.uncaching:
+			self.set_cached_chunk(chunk_key, data) # Evicted, but the other protocol may still refer to this version
 
-		# Cache it
-		# The cache stores the everything in the chunk data packet after the full chunk bool
-		self.set_cached_chunk(chunk_key, data, insert=True)
+		admitted, evicted = self.protocol.factory.cache_manager.admit(self.dimension, chunk_key)
+		for key in evicted:
+			uncache_chunk(self.protocol.factory, self.dimension, key)
+
+		if not admitted:
+			return # Chunk hasn't been pulled enough to warrant caching
 
-		# A chunk with a tracker value > self.threshold will recieve chunk updates
-		# This should be allowed since the data is cached
-		self.protocol.factory.tracker[self.dimension][chunk_key] += 1
+		self.set_cached_chunk(chunk_key, data)
+		self.protocol.factory.uncaching.discard((self.dimension, chunk_key)) # Cached again before it was destroyed
+
+		# Tell the other protocol, cached chunks will recieve chunk updates
+		self.toggle_chunk(self.dimension, chunk_key, True)
+
+	def packet_send_chunk_reference(self, buff):
+		"""
+		The internal proxy only sent the key and the hash of a chunk it believes is cached
+		The cached chunk is sent if it hashes the same, otherwise the chunk is asked for in full
+		"""
+		chunk_key = buff.read(8)
+		body_hash = buff.read(16)
+
+		if not self.protocol.factory.cache_manager.record(self.dimension, chunk_key) and (self.dimension, chunk_key) not in self.protocol.factory.uncaching:
+			return self.request_resend(chunk_key, body_hash) # Evicted chunks are still served until the other protocol knows
+
+		# Packets to the client are held until the chunk is read, after a delta another client got for it is applied
+		self.wait_for_chunk(chunk_key + body_hash)
+		deferred = self.after_deltas(chunk_key)
+		deferred.addCallback(lambda _: self.get_cached_chunk(chunk_key))
+		deferred.addCallback(self.serve_chunk_reference, chunk_key, body_hash)
+
+		return ("chunk_data", None) # Sent once it is read
+
+	def serve_chunk_reference(self, column, chunk_key, body_hash):
+		"""
+		Called with the cached chunk a chunk_reference refers to
+		"""
+		if self.awaited_chunk != chunk_key + body_hash:
+			return # Gave up on it
+
+		if column and hash_bytes(column.buff) == body_hash: # Hash everything after the full chunk bool
+			self.protocol.send_packet("chunk_data", chunk_key, self.protocol.buff_class.pack("?", True), column.buff)
+			self.stop_waiting()
+		else:
+			self.request_resend(chunk_key, body_hash)
+
+	def packet_send_chunk_delta(self, buff):
+		"""
+		The internal proxy only sent the sections of a chunk that aren't in the version it believes is cached
+		The delta is applied if the cached chunk is that version, otherwise the chunk is asked for in full
+		"""
+		chunk_key = buff.read(8)
+		base_hash = buff.read(16)
+		body_hash = buff.read(16)
+
+		if not self.protocol.factory.cache_manager.record(self.dimension, chunk_key) and (self.dimension, chunk_key) not in self.protocol.factory.uncaching:
+			return self.request_resend(chunk_key, body_hash) # Evicted chunks are still served until the other protocol knows
+
+		# Packets to the client are held until the delta is applied, deltas for the same chunk are applied in order
+		self.wait_for_chunk(chunk_key + body_hash)
+		deferred = self.after_deltas(chunk_key)
+		applying = self.protocol.factory.applying[(self.dimension, chunk_key)] = []
+
+		deferred.addCallback(lambda _: self.get_cached_chunk(chunk_key))
+		deferred.addCallback(self.apply_chunk_delta, chunk_key, base_hash, body_hash, buff.read())
+		deferred.addBoth(self.delta_applied, self.dimension, chunk_key, applying)
+
+		return ("chunk_data", None) # Sent once it is applied
+
+	def after_deltas(self, chunk_key):
+		"""
+		Args:
+			chunk_key: chunk x and z
+		Returns:
+			Deferred: fires once the deltas being applied to a chunk are, right away if there are none
+		"""
+		applying = self.protocol.factory.applying.get((self.dimension, chunk_key))
+		if applying is None:
+			return defer.succeed(None)
+
+		deferred = defer.Deferred()
+		applying.append(deferred)
+		return deferred
+
+	def delta_applied(self, result, dimension, chunk_key, applying):
+		"""
+		Called once a delta was applied or couldn't be, lets the chunk be read again
+		"""
+		if self.protocol.factory.applying.get((dimension, chunk_key)) is applying:
+			del self.protocol.factory.applying[(dimension, chunk_key)]
+
+		for deferred in applying:
+			deferred.callback(None)
+
+		return result
+
+	def apply_chunk_delta(self, column, chunk_key, base_hash, body_hash, delta):
+		"""
+		Called with the cached chunk a chunk_delta is meant for, the delta is applied on the worker thread
+		"""
+		if self.awaited_chunk != chunk_key + body_hash:
+			return # Gave up on it
+
+		if not column or hash_bytes(column.buff) != base_hash:
+			self.request_resend(chunk_key, body_hash)
+			return
 
-		# Tell the other protocol
-		self.protocol.other_factory.instance.send_packet("toggle_chunk", self.protocol.buff_class.pack_varint(self.dimension), chunk_key)
+		deferred = self.protocol.factory.chunk_worker.run(apply_delta, self.protocol.buff_class, column.buff, delta)
+		deferred.addErrback(lambda failure: failure.trap(BufferUnderrun, IndexError) and None)
+		deferred.addCallback(self.serve_chunk_delta, chunk_key, body_hash)
+		return deferred
+
+	def serve_chunk_delta(self, data, chunk_key, body_hash):
+		"""
+		Called with a chunk rebuilt from a delta
+		"""
+		if self.awaited_chunk != chunk_key + body_hash:
+			return # Gave up on it
+
+		if not data or hash_bytes(data) != body_hash:
+			self.request_resend(chunk_key, body_hash)
+			return
+
+		packet = self.protocol.buff_class(b"".join((chunk_key, self.protocol.buff_class.pack("?", True), data)))
+		self.packet_send_chunk_data(packet) # Cache the new version
+
+		self.protocol.send_packet("chunk_data", packet.buff)
+		self.stop_waiting()
+
+	def request_resend(self, chunk_key, body_hash):
+		"""
+		Asks the internal proxy for a chunk in full with chunk_nack
+		Args:
+			chunk_key: chunk x and z
+			body_hash: hash of everything after the full chunk bool
+		"""
+		self.protocol.link.stats["chunk_nacks"] += 1
+		self.protocol.link.buffer_packet(self.protocol.uuid, "chunk_nack", self.protocol.buff_class(chunk_key + body_hash))
+		self.wait_for_chunk(chunk_key + body_hash)
+
+		return ("chunk_data", None) # Sent once it is resent
+
+	def wait_for_chunk(self, reference):
+		"""
+		Holds back packets to the client until the chunk is sent, so they stay in order
+		Packets are released anyway after resend_timeout
+		Args:
+			reference: chunk key and hash of the chunk
+		"""
+		self.awaited_chunk = reference
+		self.protocol.hold_packets()
+
+		if self.give_up_call and self.give_up_call.active():
+			self.give_up_call.cancel()
+		self.give_up_call = reactor.callLater(self.resend_timeout, self.stop_waiting)
+
+	def stop_waiting(self, later=False):
+		"""
+		Releases held packets
+		Args:
+			later: release them after the packet being handled is sent
+		"""
+		self.awaited_chunk = None
+		if self.give_up_call and self.give_up_call.active():
+			self.give_up_call.cancel()
+
+		if later:
+			reactor.callLater(0, self.protocol.release_packets)
+		else:
+			self.protocol.release_packets()
+
+	def packet_send_chunk_resend(self, buff):
+		"""
+		A chunk asked for with chunk_nack, it is cached like any other chunk_data packet
+		Held packets are released after it is sent
+		"""
+		if buff.read(24) != self.awaited_chunk: # Chunk key and hash
+			return ("chunk_resend", None) # Came after the timeout, the client was sent newer packets already
+
+		self.stop_waiting(later=True)
+
+		if not buff.buff[buff.pos:]:
+			return ("chunk_resend", None) # The internal proxy no longer had it
+
+		packet = self.protocol.buff_class(buff.read())
+		new_packet = self.packet_send_chunk_data(packet)
+
+		return new_packet or ("chunk_data", self.protocol.buff_class(packet.buff))
+
+	def packet_send_update_light_cached(self, buff):
+		"""
+		Rebuilds a light update of a cached chunk, arrays that were sent before were replaced by their hash
+		Arrays are read from and added to the light cache on the worker thread, packets to the client are held until the update is sent
+		"""
+		packet_hash = buff.read(16) # Hash of the update_light packet
+		chunk_x = buff.unpack_varint()
+		chunk_z = buff.unpack_varint()
+		masks = [buff.unpack_varint() for _ in range(4)] # Sky light, block light, empty sky light and empty block light masks
+
+		arrays = [] # Whether each array is cached, its hash if it is and the array if it isn't
+		for i in (0, 1): # Sky light arrays come first
+			for section in range(masks[i].bit_length()):
+				if not masks[i] & (1 << section):
+					continue
+
+				if buff.unpack("?"): # Cached array
+					arrays.append((True, buff.read(16)))
+				else:
+					arrays.append((False, buff.read(buff.unpack_varint())))
+
+		header = b"".join((
+			self.protocol.buff_class.pack_varint(chunk_x),
+			self.protocol.buff_class.pack_varint(chunk_z),
+			*[self.protocol.buff_class.pack_varint(mask) for mask in masks]
+		))
+		reference = self.protocol.buff_class.pack("ii", chunk_x, chunk_z) + packet_hash
+
+		self.wait_for_chunk(reference)
+		deferred = self.protocol.factory.chunk_worker.run(get_light_arrays, self.protocol.factory.light_cache, arrays)
+		deferred.addCallback(self.serve_update_light, reference, header, buff.read())
+		deferred.addErrback(lambda failure: self.logger.warning("Couldn't read cached light: {}".format(failure.getErrorMessage())))
+
+		return ("update_light", None) # Sent once the arrays are read
+
+	def serve_update_light(self, arrays, reference, header, tail):
+		"""
+		Called with the arrays of a light update
+		If an array isn't cached anymore the update is asked for in full with light_nack, the internal proxy is told to send the array in full next time
+		"""
+		if self.awaited_chunk != reference:
+			return # Gave up on it
+
+		missing = [light_hash for light_hash, array in arrays if array is None]
+		if missing:
+			for light_hash in missing:
+				self.protocol.link.buffer_packet(self.protocol.uuid, "light_miss", self.protocol.buff_class(light_hash))
+			self.protocol.link.buffer_packet(self.protocol.uuid, "light_nack", self.protocol.buff_class(reference))
+			self.wait_for_chunk(reference) # Sent once it is resent
+			return
+
+		self.protocol.send_packet("update_light", header, *[self.protocol.buff_class.pack_varint(len(array)) + array for _, array in arrays], tail)
+		self.stop_waiting()
+
+	def packet_send_light_resend(self, buff):
+		"""
+		A light update asked for with light_nack, held packets are released after it is sent
+		"""
+		if buff.read(24) != self.awaited_chunk: # Chunk key and hash
+			return ("light_resend", None) # Came after the timeout, the client was sent newer packets already
+
+		self.stop_waiting(later=True)
+
+		if not buff.buff[buff.pos:]:
+			return ("light_resend", None) # The internal proxy no longer had it
+
+		return ("update_light", self.protocol.buff_class(buff.read()))
 
 	def packet_send_block_change(self, buff):
 		"""
@@ -169,7 +458,7 @@ class ChunkCacher(Module):
 		cz, bz = divmod(z, 16)
 
 		chunk_key = self.protocol.buff_class.pack("ii", cx, cz) # Get chunk key
-		if self.protocol.factory.tracker[self.dimension][chunk_key] > self.threshold: # Check if chunk is cached (not equal to since when the threshold is equal to stored amount the chunk is actually cached)
+		if self.protocol.factory.cache_manager.contains(self.dimension, chunk_key): # Check if chunk is cached
 			# Chunk is cached, update
 
 			# Unpack rest of data
@@ -210,7 +499,7 @@ class ChunkCacher(Module):
 
 		# Call set_blocks for each chunk section
 		for key, values in records.items():
-			if self.protocol.factory.tracker[self.dimension][key] > self.threshold: # Check if chunk is cached (not equal to since when the threshold is equal to stored amount the chunk is actually cached)
+			if self.protocol.factory.cache_manager.contains(self.dimension, key): # Check if chunk is cached
 				# Chunk is cached, update
 				self.set_blocks(key, *values)
 
@@ -226,7 +515,7 @@ class ChunkCacher(Module):
 		chunk_x, chunk_z  = buff.unpack("ii") # Use the chunk x and z values in bytes as the key
 		chunk_key = self.protocol.buff_class.pack("ii", chunk_x, chunk_z)
 
-		if self.protocol.factory.tracker[self.dimension][chunk_key] > self.threshold: # Check if chunk is cached (not equal to since when the threshold is equal to stored amount the chunk is actually cached)
+		if self.protocol.factory.cache_manager.contains(self.dimension, chunk_key): # Check if chunk is cached
 			# Chunk is cached, update
 
 			# Unpack rest of data
@@ -257,228 +546,492 @@ class ChunkCacher(Module):
 		chunk_key = self.protocol.buff_class.pack("ii", x // 16, z // 16) # Get chunk key
 
 		# Check if the chunk is cached
-		if self.protocol.factory.tracker[self.dimension][chunk_key] > self.threshold:
-			# Get tile entities
-			tile_entities = self.get_tile_entities(chunk_key)
-			if not tile_entities:
-				# Chunk no longer exists
-				self.handle_missing_data(chunk_key)
-				return
-
+		if self.protocol.factory.cache_manager.contains(self.dimension, chunk_key):
 			# Unpack rest of data
 			buff.unpack('B') # We don't care about the action
 			new_tag = buff.unpack_nbt()
-			old_tag = tile_entities.get((x, y, z))
 
-			# Update tag
-			if old_tag and not new_tag:
-				del tile_entities[(x, y, z)]
-			elif not old_tag and new_tag:
-				tile_entities[(x, y, z)] = new_tag
-			elif old_tag and new_tag:
-				old_tag.update(new_tag)
+			def apply_change(column):
+				if not column:
+					return # Chunk no longer exists
 
-			# Apply update
-			self.set_tile_entities(chunk_key, tile_entities)
+				old_tag = column.tile_entities.get((x, y, z))
+
+				# Update tag
+				if old_tag and not new_tag:
+					del column.tile_entities[(x, y, z)]
+				elif not old_tag and new_tag:
+					column.tile_entities[(x, y, z)] = new_tag
+				elif old_tag and new_tag:
+					old_tag.update(new_tag)
+
+				column.dirty = True
+
+			self.get_decoded_chunk(chunk_key).addCallback(apply_change)
 
 	def is_duplicate(self, data):
 		"""
-		Checks whether data has already been processed
+		Checks whether data has already been processed in this dimension
 		Args:
 			data: packet data to hash and compare with
 		Returns:
 			bool: whether data is duplicated or not
 		"""
-		comp_hash = hash128(data) # Hash and check the list
-		res = comp_hash in self.protocol.factory.processed_packets[self.dimension]
+		if self.protocol.factory.processed_packets.is_duplicate(self.dimension, data):
+			self.protocol.link.stats["duplicate_packets"] += 1
+			return True
 
-		if not res: # Add to the list if this is unique
-			self.protocol.factory.processed_packets[self.dimension].append(comp_hash)
+		return False
 
-		return res
-
-	def clear_processed_packets(self):
+	def get_cached_chunk(self, chunk_key):
 		"""
-		Clears the hashes in processed_packets
+		Grabs chunk data from the cache, changes to the decoded chunk are encoded first
+		Args:
+			chunk_key: identifier in cache
+		Returns:
+			Deferred: fires with a buffer of the chunk data, or None if the chunk is no longer cached
 		"""
-		reactor.callLater(self.protocol.config["global"]["buffer_ms"]/500, self.clear_processed_packets) # Recall
+		dimension = self.dimension
+		deferred = write_decoded_chunk(self.protocol.factory, dimension, chunk_key)
+		deferred.addCallback(lambda _: self.read_cached_chunk(dimension, chunk_key))
+		return deferred
 
-		for l in self.protocol.factory.processed_packets.values():
-			l.clear()
-
-	def get_cached_chunk(self, chunk_key):
+	def read_cached_chunk(self, dimension, chunk_key):
 		"""
-		Grabs chunk data from the cache and uncompresses it
+		Reads chunk data from the cache on the worker thread, chunks that aren't written yet are returned right away
 		Args:
+			dimension: dimension of the chunk
 			chunk_key: identifier in cache
+		Returns:
+			Deferred or buffer: the chunk data, or None if the chunk is no longer cached
 		"""
-		data = self.protocol.factory.last_grabbed_value
-		if chunk_key != self.protocol.factory.last_grabbed_key: # Use the last grabbed value if possible
-			# Grab a new chunk
-			self.protocol.factory.last_grabbed_key = chunk_key
+		data = self.protocol.factory.dirty_chunks.get((dimension, chunk_key)) # Not written to the cache yet
+		if data is not None:
+			return self.protocol.buff_class(data)
 
-			cached_data = self.protocol.factory.caches[self.dimension].get(chunk_key)
-			if not cached_data:
-				self.handle_missing_data(chunk_key)
-				return None
+		deferred = self.protocol.factory.chunk_worker.run(self.protocol.factory.caches[dimension].get, chunk_key)
+		deferred.addCallback(self.chunk_grabbed, dimension, chunk_key)
+		deferred.addErrback(lambda failure: self.logger.warning("Couldn't read a cached chunk: {}".format(failure.getErrorMessage())))
+		return deferred
 
-			# Uncompress
-			data = self.protocol.factory.last_grabbed_value = self.plasma.decompress(cached_data)
+	def chunk_grabbed(self, data, dimension, chunk_key):
+		"""
+		Called with chunk data read from the cache
+		"""
+		data = self.protocol.factory.dirty_chunks.get((dimension, chunk_key), data) # Changed while it was read
+		if not data:
+			self.handle_missing_data(dimension, chunk_key)
+			return None
 
-		# Return
 		return self.protocol.buff_class(data)
 
-	def set_cached_chunk(self, chunk_key, data, insert=False):
+	def set_cached_chunk(self, chunk_key, data):
 		"""
-		Compresses data and sets it in the cache
+		Sets data in the cache, it is written with the next flush
 		Args:
 			chunk_key: identifier in cache
 			data: bytes object
-			insert: whether to insert or update, only use insert if you are adding new data
 		"""
-		# update last set value
-		self.protocol.factory.last_grabbed_key = chunk_key
-		self.protocol.factory.last_grabbed_value = data
+		forget_decoded_chunk(self.protocol.factory, self.dimension, chunk_key) # Replaced by the new data
+		self.protocol.factory.decoding.pop((self.dimension, chunk_key), None) # Changes waiting for the old data are dropped
+		self.protocol.factory.encoding.pop((self.dimension, chunk_key), None) # The old data isn't marked dirty once it is encoded
+		mark_dirty(self.protocol.factory, self.dimension, chunk_key, data)
 
-		# Compress and set!
-		func = self.protocol.factory.caches[self.dimension].insert if insert else self.protocol.factory.caches[self.dimension].update
-		func(chunk_key, self.plasma.compress(data))
+		if self.protocol.factory.dirty_bytes > self.dirty_budget:
+			flush_chunks(self.protocol.factory)
 
-	def set_blocks(self, key, *blocks):
+	def get_decoded_chunk(self, chunk_key, dimension=None):
 		"""
-		Sets blocks in a cached chunk
+		Gets a cached chunk decoded for changes, changes are made to it in place and set its dirty flag
+		Decoded chunks are kept in a working set until they are evicted or the chunk is read encoded
 		Args:
-			key: chunk key
-			blocks: tuples of (cy, x, y, z, block_id) Note that the coords are relative to the chunk (cy is the section to modify)
+			chunk_key: identifier in cache
+			dimension: dimension of the chunk, the player's if None
+		Returns:
+			Deferred: fires with the DecodedColumn, or None if the chunk is no longer cached
 		"""
-		sections, biomes = self.get_chunk_sections(key) # Get chunk
-		if not sections or not biomes:
-			# Data is gone! Ignore the change request
-			self.handle_missing_data(key)
-			return
+		if dimension is None:
+			dimension = self.dimension
+
+		# Changes wait while the chunk is encoded on the worker thread, so none are made to it while it is read
+		encoding = self.protocol.factory.encoding.get((dimension, chunk_key))
+		if encoding is not None:
+			deferred = defer.Deferred()
+			encoding.append(deferred)
+			deferred.addCallback(lambda _: self.get_decoded_chunk(chunk_key, dimension))
+			return deferred
+
+		decoded_chunks = self.protocol.factory.decoded_chunks
+		column = decoded_chunks.get((dimension, chunk_key))
+		if column:
+			decoded_chunks.move_to_end((dimension, chunk_key))
+			return defer.succeed(column)
+
+		# Changes made while the chunk is decoded wait for the same decode, in order
+		deferred = defer.Deferred()
+		waiting = self.protocol.factory.decoding.get((dimension, chunk_key))
+		if waiting is not None:
+			waiting.append(deferred)
+			return deferred
+
+		waiting = self.protocol.factory.decoding[(dimension, chunk_key)] = [deferred]
+		decode = defer.maybeDeferred(self.read_cached_chunk, dimension, chunk_key)
+		decode.addCallback(lambda column: column and self.protocol.factory.chunk_worker.run(DecodedColumn.decode, column))
+		decode.addErrback(lambda failure: self.logger.warning("Couldn't decode a cached chunk: {}".format(failure.getErrorMessage())))
+		decode.addCallback(self.chunk_decoded, dimension, chunk_key, waiting)
+
+		return deferred
+
+	def chunk_decoded(self, column, dimension, chunk_key, waiting):
+		"""
+		Called with a decoded chunk, adds it to the working set
+		"""
+		if self.protocol.factory.decoding.get((dimension, chunk_key)) is not waiting:
+			column = None # Replaced while it was decoded
+		else:
+			del self.protocol.factory.decoding[(dimension, chunk_key)]
+
+		if column:
+			decoded_chunks = self.protocol.factory.decoded_chunks
+			decoded_chunks[(dimension, chunk_key)] = column
+			self.protocol.factory.decoded_bytes += column.size
 
-		for change in blocks:
-			sections[change[0]][0][change[2]*256 + change[3]*16 + change[1]] = change[4] # Set block id
+			# Evict the least recently used chunks over the budget, changed ones are marked dirty once they are encoded
+			while self.protocol.factory.decoded_bytes > self.decoded_budget and len(decoded_chunks) > 1:
+				evicted_dimension, evicted_key = next(iter(decoded_chunks))
+				write_decoded_chunk(self.protocol.factory, evicted_dimension, evicted_key)
+				forget_decoded_chunk(self.protocol.factory, evicted_dimension, evicted_key)
 
-		# Save chunk section
-		self.set_chunk_sections(key, sections, biomes)
+		for deferred in waiting:
+			deferred.callback(column)
 
-	def get_chunk_sections(self, key):
+	def set_blocks(self, key, *blocks):
 		"""
-		Gets cached chunk sections as a tuple
+		Sets blocks in a cached chunk
 		Args:
-			key: chunk column to get
-		Returns:
-			sections: list of BlockArray chunk sections
-			biomes: list of biome data
+			key: chunk key
+			blocks: tuples of (cy, x, y, z, block_id) Note that the coords are relative to the chunk (cy is the section to modify)
 		"""
-		column = self.get_cached_chunk(key)
-		if not column:
-			return (None, None)
+		def apply_changes(column):
+			if not column:
+				return # Data is gone! Ignore the change request
 
-		prim_bit_mask = column.unpack_varint()
-		column.unpack_nbt() # Ignore heightmap
+			for change in blocks:
+				column.sections[change[0]][0][change[2]*256 + change[3]*16 + change[1]] = change[4] # Set block id
+
+			column.dirty = True
 
-		return column.unpack_chunk(prim_bit_mask) # Biome data is stored after chunk sections, this is used for repacking
+		self.get_decoded_chunk(key).addCallback(apply_changes)
 
-	def set_chunk_sections(self, key, sections, biomes):
+	def handle_missing_data(self, dimension, key):
 		"""
-		Sets a cached chunk section
-		Args:
-			key: chunk column to save to
-			sections: list of BlockArray chunk sections
-			biomes: list of biome data
+		Call when chunk data is missing from the database
 		"""
-		column = self.get_cached_chunk(key)
-		if not column:
-			return
+		forget_decoded_chunk(self.protocol.factory, dimension, key)
+		if self.protocol.factory.cache_manager.remove(dimension, key): # The chunk is no longer cached
+			self.toggle_chunk(dimension, key, False)
 
-		# Unpack existing data, most will be reused
-		column.unpack_varint() # Old bitmask won't be used
-		heightmap = column.unpack_nbt()
-		column.read(length=column.unpack_varint()) # Ignore current chunk data
-		tile_entity_data = column.read() # We won't mess with this
-
-		# Repack cached data
-		cached_data = b"".join((self.protocol.buff_class.pack_chunk_bitmask(sections),
-							self.protocol.buff_class.pack_nbt(heightmap),
-							self.protocol.buff_class.pack_chunk(sections, biomes),
-							tile_entity_data))
+	def toggle_chunk(self, dimension, key, cached):
+		"""
+		Tells the other protocol a chunk was cached or isn't anymore, evicted chunks it wasn't told about are sent first
+		"""
+		send_uncached(self.protocol.factory)
 
-		# Save new data
-		self.set_cached_chunk(key, cached_data)
+		link = self.protocol.other_factory.get_control_instance() # Over the link uncache_chunks and cache_sync take, so they stay in order
+		if link:
+			link.send_packet("toggle_chunk", self.protocol.buff_class.pack_varint(dimension), key, self.protocol.buff_class.pack("?", cached))
 
-	def generate_cached_chunk_packet(self, key):
+class DecodedColumn:
+	"""
+	A cached chunk column unpacked into block arrays and nbt tags
+	"""
+	def __init__(self, sections, biomes, heightmap, tile_entities, size):
 		"""
-		Generates a chunk data packet from a key
 		Args:
-			key: chunk x and z
+			sections: list of BlockArray chunk sections
+			biomes: list of biome data
+			heightmap: heightmap nbt tag
+			tile_entities: dict of tile entity nbt tags by position
+			size: size of the encoded column, counted against the working set budget
 		"""
-		cached_data = self.get_cached_chunk(key)
-		if not cached_data:
-			return None
-
-		return b"".join((key, self.protocol.buff_class.pack("?", True), cached_data.buff))
-
-	def get_tile_entities(self, key):
+		self.sections = sections
+		self.biomes = biomes
+		self.heightmap = heightmap
+		self.tile_entities = tile_entities
+		self.size = size
+		self.dirty = False # Whether it was changed since it was decoded or written
+
+	@classmethod
+	def decode(cls, column):
 		"""
-		Gets block entities as a dictionary of nbt tags
 		Args:
-			key: chunk key
+			column: buffer of the cached column data
 		Returns:
-			dict: tile entities as nbt tags, or None if chunk is no longer cached
+			DecodedColumn: decoded column
 		"""
-		# Get cached chunk
-		chunk = self.get_cached_chunk(key)
-		if not chunk:
-			return None
-
-		# Read through all the unimportant stuff
-		chunk.unpack_varint()
-		chunk.unpack_nbt()
-		chunk.read(chunk.unpack_varint())
+		size = len(column.buff)
+		prim_bit_mask = column.unpack_varint()
+		heightmap = column.unpack_nbt()
+		sections, biomes = column.unpack_chunk(prim_bit_mask) # Biome data is stored after chunk sections, this is used for repacking
 
 		# Parse the nbt data
 		tile_entities = {}
-		for _ in range(chunk.unpack_varint()): # Loop through every tile entity
-			tile_entity = chunk.unpack_nbt()
+		for _ in range(column.unpack_varint()): # Loop through every tile entity
+			tile_entity = column.unpack_nbt()
 			te_obj = tile_entity.to_obj()[""]
 
 			tile_entities[(te_obj["x"], te_obj["y"], te_obj["z"])] = tile_entity
 
-		return tile_entities
+		return cls(sections, biomes, heightmap, tile_entities, size)
 
-	def set_tile_entities(self, key, tile_entities):
+	def encode(self, buff_class):
 		"""
-		Applies tile_entities to a cached chunk
 		Args:
-			key: chunk key
-			tile_entities: tile entities as nbt tags
+			buff_class: buffer class to pack with
+		Returns:
+			bytes: cached column data
 		"""
-		column = self.get_cached_chunk(key)
-		if not column:
-			return
+		return b"".join((buff_class.pack_chunk_bitmask(self.sections),
+						buff_class.pack_nbt(self.heightmap),
+						buff_class.pack_chunk(self.sections, self.biomes),
+						buff_class.pack_varint(len(self.tile_entities)),
+						*[buff_class.pack_nbt(e) for e in self.tile_entities.values()]))
+
+# Chunk cache state is shared by every player's chunk cacher, these work on it through the factory alone so timers
+# and shutdown triggers don't depend on a player that may have left
+def mark_dirty(factory, dimension, chunk_key, data):
+	"""
+	Keeps chunk data until the next flush, replacing data of the same chunk that wasn't written yet
+	Args:
+		factory: factory the cache state is kept on
+		dimension: dimension of the chunk
+		chunk_key: identifier in cache
+		data: bytes object
+	"""
+	old_data = factory.dirty_chunks.pop((dimension, chunk_key), b"")
+	factory.dirty_chunks[(dimension, chunk_key)] = data
+	factory.dirty_bytes += len(data) - len(old_data)
 
-		# Get other chunk data
-		prim_bit_mask = column.unpack_varint()
-		heightmap = column.unpack_nbt()
-		chunk_data = column.read(length=column.unpack_varint())
-		column.read() # Ignore chunk data
+def write_decoded_chunk(factory, dimension, chunk_key):
+	"""
+	Encodes a decoded chunk on the worker thread and marks it dirty for the next flush if it was changed
+	Args:
+		factory: factory the cache state is kept on
+		dimension: dimension of the chunk
+		chunk_key: identifier in cache
+	Returns:
+		Deferred: fires once it is marked dirty, right away if it wasn't changed
+	"""
+	waiting = factory.encoding.get((dimension, chunk_key))
+	if waiting is None:
+		column = factory.decoded_chunks.get((dimension, chunk_key))
+		if not column or not column.dirty:
+			return defer.succeed(None)
+
+		waiting = hold_decoded_chunk(factory, dimension, chunk_key, column)
+		deferred = factory.chunk_worker.run(column.encode, factory.buff_class)
+		deferred.addCallback(decoded_chunk_encoded, factory, dimension, chunk_key, waiting)
+		deferred.addBoth(release_decoded_chunk, factory, dimension, chunk_key, waiting)
+
+	deferred = defer.Deferred()
+	waiting.append(deferred)
+	return deferred
+
+def hold_decoded_chunk(factory, dimension, chunk_key, column):
+	"""
+	Marks a changed decoded chunk as being encoded, changes to it and reads of it wait until it is released
+	Args:
+		factory: factory the cache state is kept on
+		dimension: dimension of the chunk
+		chunk_key: identifier in cache
+		column: DecodedColumn handed to the worker thread
+	Returns:
+		list: Deferreds fired once it is released
+	"""
+	column.dirty = False
+	waiting = factory.encoding[(dimension, chunk_key)] = []
+	return waiting
 
-		# Repack cached data with new tile entity data
-		cached_data = b"".join((self.protocol.buff_class.pack_varint(prim_bit_mask),
-							self.protocol.buff_class.pack_nbt(heightmap),
-							self.protocol.buff_class.pack_varint(len(chunk_data)),
-							chunk_data,
-							self.protocol.buff_class.pack_varint(len(tile_entities)),
-							*[self.protocol.buff_class.pack_nbt(e) for e in tile_entities.values()]))
+def decoded_chunk_encoded(data, factory, dimension, chunk_key, waiting):
+	"""
+	Called with an encoded decoded chunk, it is marked dirty unless it was replaced while it was encoded
+	"""
+	if factory.encoding.get((dimension, chunk_key)) is not waiting:
+		return
 
-		# Save new data
-		self.set_cached_chunk(key, cached_data)
+	mark_dirty(factory, dimension, chunk_key, data)
+	if factory.dirty_bytes > factory.config["chunk_caching"]["dirty_bytes"]:
+		flush_chunks(factory)
 
-	def handle_missing_data(self, key):
-		"""
-		Call when chunk data is missing from the database
-		"""
-		del self.protocol.factory.tracker[self.dimension][key] # Reset the counter since the chunk is no longer cached
-		self.protocol.other_factory.instance.send_packet("toggle_chunk", self.protocol.buff_class.pack_varint(self.dimension), key)
+def release_decoded_chunk(result, factory, dimension, chunk_key, waiting):
+	"""
+	Called once a decoded chunk is encoded or couldn't be, lets changes and reads waiting for it continue
+	"""
+	if factory.encoding.get((dimension, chunk_key)) is waiting:
+		del factory.encoding[(dimension, chunk_key)]
+
+	for deferred in waiting:
+		deferred.callback(None)
+
+	return result
+
+def forget_decoded_chunk(factory, dimension, chunk_key):
+	"""
+	Removes a chunk from the working set without writing it
+	Args:
+		factory: factory the cache state is kept on
+		dimension: dimension of the chunk
+		chunk_key: identifier in cache
+	"""
+	column = factory.decoded_chunks.pop((dimension, chunk_key), None)
+	if column:
+		factory.decoded_bytes -= column.size
+
+def flush_chunks(factory):
+	"""
+	Writes dirty chunks to the cache in one transaction per dimension on the worker thread
+	Changed decoded chunks are encoded there first, changes to them and reads of them wait until they are written
+	Args:
+		factory: factory the cache state is kept on
+	Returns:
+		Deferred: fires once they are written
+	"""
+	chunks = defaultdict(dict)
+	for (dimension, chunk_key), data in factory.dirty_chunks.items():
+		chunks[dimension][chunk_key] = data
+
+	factory.dirty_chunks.clear()
+	factory.dirty_bytes = 0
+
+	columns = defaultdict(list)
+	for (dimension, chunk_key), column in factory.decoded_chunks.items():
+		if column.dirty:
+			columns[dimension].append((chunk_key, column, hold_decoded_chunk(factory, dimension, chunk_key, column)))
+
+	# Reads queued after this see the new data, the worker runs everything in order
+	deferreds = []
+	for dimension in set(chunks) | set(columns):
+		deferred = factory.chunk_worker.run(write_chunks, factory.caches[dimension], factory.buff_class, chunks[dimension], [(chunk_key, column) for chunk_key, column, _ in columns[dimension]])
+		for chunk_key, _, waiting in columns[dimension]:
+			deferred.addBoth(release_decoded_chunk, factory, dimension, chunk_key, waiting)
+		deferred.addCallback(chunks_evicted, factory, dimension)
+		deferreds.append(deferred)
+
+	return defer.DeferredList(deferreds)
+
+def write_chunks(store, buff_class, chunks, columns):
+	"""
+	Encodes changed decoded chunks and writes them with the dirty chunks, runs on the worker thread
+	Args:
+		store: chunk store of the dimension
+		buff_class: buffer class to pack with
+		chunks: dict of dirty chunk data by key
+		columns: list of keys and changed DecodedColumns
+	Returns:
+		list: keys the store picked for eviction
+	"""
+	for chunk_key, column in columns:
+		chunks[chunk_key] = column.encode(buff_class) # Newer than the data it was decoded from
+
+	return store.insert_many(list(chunks.items()))
+
+def stop_chunk_cache(factory):
+	"""
+	Writes dirty chunks and buffered light arrays before the proxy stops, after the chunks being encoded are marked dirty
+	Args:
+		factory: factory the cache state is kept on
+	Returns:
+		Deferred: fires once they are written
+	"""
+	encoded = []
+	for waiting in factory.encoding.values():
+		deferred = defer.Deferred()
+		waiting.append(deferred)
+		encoded.append(deferred)
+
+	deferred = defer.DeferredList(encoded)
+	deferred.addCallback(lambda _: defer.DeferredList([flush_chunks(factory), factory.chunk_worker.run(factory.light_cache.commit)]))
+	return deferred
+
+def get_light_arrays(light_cache, arrays):
+	"""
+	Reads cached light arrays and caches the ones sent in full, runs on the worker thread
+	Args:
+		light_cache: Cache of light arrays by hash
+		arrays: list of whether each array is cached, its hash if it is and the array if it isn't
+	Returns:
+		list: hash and array of each, the array is None if it isn't cached anymore
+	"""
+	arrays = [(value, None) if cached else (hash_bytes(value), value) for cached, value in arrays]
+	found = light_cache.get_many([light_hash for light_hash, _ in arrays])
+	light_cache.put_many([(light_hash, array) for light_hash, array in arrays if array is not None and light_hash not in found])
+
+	return [(light_hash, found.get(light_hash, array)) for light_hash, array in arrays]
+
+def chunks_evicted(keys, factory, dimension):
+	"""
+	Called with the chunks a store picked for eviction, they are readable until they are destroyed
+	"""
+	orphans = []
+	for key in keys:
+		if factory.cache_manager.remove(dimension, key):
+			uncache_chunk(factory, dimension, key)
+		elif (dimension, key) not in factory.uncaching:
+			orphans.append(key) # Nobody reads them
+
+	if orphans:
+		factory.chunk_worker.run(factory.caches[dimension].destroy_many, orphans)
+
+def uncache_chunk(factory, dimension, key):
+	"""
+	Tells the other protocol a chunk is evicted, in a batch with the other chunks evicted this reactor iteration
+	The chunk stays readable for uncache_grace seconds, so references to it that are already on their way are served
+	Args:
+		factory: factory the cache state is kept on
+		dimension: dimension of the chunk
+		key: chunk key
+	"""
+	factory.uncaching.add((dimension, key))
+	factory.uncache_pending[dimension].append(key)
+	if not factory.uncache_call:
+		factory.uncache_call = reactor.callLater(0, send_uncached, factory)
+
+def send_uncached(factory):
+	"""
+	Sends the batched uncache_chunks packets, the chunks are destroyed once the grace period is over
+	Without a link they are only destroyed, the other protocol gets the whole cache state when a link connects
+	Args:
+		factory: factory the cache state is kept on
+	"""
+	if factory.uncache_call and factory.uncache_call.active():
+		factory.uncache_call.cancel()
+	factory.uncache_call = None
+
+	link = factory.other_factory.get_control_instance()
+	for dimension, keys in factory.uncache_pending.items():
+		if link:
+			link.send_packet("uncache_chunks", factory.buff_class.pack_varint(dimension), factory.buff_class.pack_varint(len(keys)), *keys)
+		reactor.callLater(factory.config["chunk_caching"]["uncache_grace"], destroy_chunks, factory, dimension, keys)
+
+	factory.uncache_pending.clear()
+
+def destroy_chunks(factory, dimension, keys):
+	"""
+	Removes evicted chunks from the cache once their grace period is over, unless they were cached again
+	Args:
+		factory: factory the cache state is kept on
+		dimension: dimension of the chunks
+		keys: chunk keys
+	"""
+	keys = [key for key in keys if (dimension, key) in factory.uncaching and not factory.cache_manager.contains(dimension, key)]
+	for key in keys:
+		factory.uncaching.discard((dimension, key))
+		forget_decoded_chunk(factory, dimension, key)
+		factory.decoding.pop((dimension, key), None) # Changes waiting for it are dropped
+		factory.encoding.pop((dimension, key), None) # Not marked dirty once it is encoded
+		data = factory.dirty_chunks.pop((dimension, key), None)
+		if data is not None:
+			factory.dirty_bytes -= len(data)
+
+	if keys:
+		factory.chunk_worker.run(factory.caches[dimension].destroy_many, keys) # After writes queued before
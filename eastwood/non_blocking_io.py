@@ -106,7 +106,7 @@ class OutboxHandlerThread(Thread):
 			if packet_tuple[0] != self.index:
 				# Packet is supposed to be sent after one being processed
 				self.wait_list[packet_tuple[0]] = packet_tuple
-				return
+				continue
 
 			# Packet is next to be sent
 			if packet_tuple[1]:
@@ -0,0 +1,509 @@
+"""
+Packing and parsing of poems, the buffered packets sent between the proxies
+Every record in a poem starts with a flags byte, followed by its recipients and then the packet itself
+Identical packets queued for several players are sent once as a multicast record with a list of recipients
+Packet bodies that were sent before can be sent as a reference to a slot of a cache both sides keep in lockstep
+If the receiver can't resolve a reference anyway, it skips every record from there on and asks for a reset. The
+sender clears its cache, and sends the skipped records again right after the reset record, so nothing is lost
+"""
+import numpy as np
+from collections import OrderedDict, deque
+from mmh3 import hash as hash32, hash128
+from quarry.net.protocol import BufferUnderrun
+from quarry.types.uuid import UUID
+
+# Record flags
+MULTICAST = 0x01 # Record has a varint count of recipients instead of a single one
+STORE = 0x02 # Record body is stored in the reference cache, the varint slot follows the recipients
+REFERENCE = 0x04 # Record has no body, only the varint slot and a 32 bit hash of the body stored in it
+RESET = 0x08 # Reference caches are cleared, a reset record has nothing after the flags
+
+COLUMNS = 0x80 # First byte of a poem packed as columns, rows start with the flags of the first record instead
+
+HISTORY = 256 # Poems the sender keeps to send again after a reset
+
+class ReferenceCache:
+	"""
+	Sender side of the reference cache
+	The sender picks the slots, least recently used slots are reused once all of them are taken
+	"""
+	def __init__(self, slots, min_size, max_size):
+		"""
+		Args:
+			slots: amount of slots
+			min_size: bodies smaller than this are not worth referencing
+			max_size: bodies larger than this are not stored, to bound the memory of the receiver
+		"""
+		self.slots = slots
+		self.min_size = min_size
+		self.max_size = max_size
+		self.reset()
+
+	def reset(self):
+		"""
+		Forgets every slot, the receiver is told with a reset record
+		"""
+		self.lru = OrderedDict() # Slot by body hash, least recently used first
+
+	def lookup(self, body):
+		"""
+		Args:
+			body: packet body
+		Returns:
+			tuple: REFERENCE and the slot if the body is cached, STORE and the slot it is stored in, or 0 and None
+		"""
+		if not self.min_size <= len(body) <= self.max_size:
+			return 0, None
+
+		key = hash128(body)
+		slot = self.lru.get(key)
+		if slot is not None:
+			self.lru.move_to_end(key)
+			return REFERENCE, slot
+
+		if len(self.lru) < self.slots:
+			slot = len(self.lru)
+		else:
+			slot = self.lru.popitem(last=False)[1] # Evict the least recently used body
+
+		self.lru[key] = slot
+		return STORE, slot
+
+class ReferenceStore:
+	"""
+	Receiver side of the reference cache
+	"""
+	def __init__(self):
+		self.bodies = {} # Body by slot
+
+	def store(self, slot, body):
+		self.bodies[slot] = body
+
+	def get(self, slot, check):
+		"""
+		Args:
+			slot: slot of the body
+			check: 32 bit hash of the body
+		Returns:
+			bytes: the body, None if the slot doesn't hold it (the caches are out of sync)
+		"""
+		body = self.bodies.get(slot)
+		if body is None or hash32(body) != check:
+			return None
+
+		return body
+
+	def clear(self):
+		self.bodies.clear()
+
+class PoemWriter:
+	"""
+	Packs a list of packets into a poem
+	"""
+	def __init__(self, buff_class, multicast=True, references=None, layout="rows"):
+		"""
+		Args:
+			buff_class: buffer class to pack with
+			multicast: whether identical packets for several players are sent once
+			references: ReferenceCache to send repeated bodies as references with, None to disable
+			layout: "rows" to pack records one after another, "columns" to pack every field in its own column
+		"""
+		self.buff_class = buff_class
+		self.layout = layout
+		self.multicast = multicast
+		self.references = references
+		self.reset_pending = False # Whether the next poem starts with a reset record
+		self.poems = 0 # Poems packed
+		self.history = deque(maxlen=HISTORY) # Number and records (recipients, packet name, data, None for resets) of the last poems, only kept with references
+		self.replay = [] # Records sent again after the next reset record
+		self.saved = 0 # Packets that didn't have to be sent because of multicasting, for the last poem
+		self.reference_hits = 0 # Bodies sent as references, for the last poem
+		self.reference_stores = 0 # Bodies stored in the reference cache, for the last poem
+		self.reference_bytes_saved = 0 # Bytes saved by references, for the last poem
+
+	def request_reset(self, poem, index):
+		"""
+		The receiver missed a reference, start over with empty caches
+		The records it skipped are sent again after the reset record
+		Args:
+			poem: number of the poem the receiver missed a reference in, counted from 1
+			index: index of the record with the reference in that poem
+		Returns:
+			bool: False if the poem isn't kept anymore, the skipped records are lost then
+		"""
+		if not self.references:
+			return True
+
+		numbers = [number for number, records in self.history]
+		if poem not in numbers:
+			return False
+
+		self.references.reset()
+		self.reset_pending = True
+		self.replay = []
+		for number, records in self.history:
+			if number >= poem:
+				self.replay.extend(record for record in records[index if number == poem else 0:] if record)
+
+		self.history.clear() # Nothing before the reset can be missed anymore
+		return True
+
+	def group(self, bodies, uuids):
+		"""
+		Groups identical packets into recipient lists
+		A copy is only moved up to an earlier identical packet if its player has nothing queued in between, so every player's packets stay in order
+		Args:
+			bodies: packed packets (name + data) in order
+			uuids: recipient of every packet
+		Returns:
+			list: (index of the packet to send, indexes of every recipient's copy) in order
+		"""
+		previous = [] # Index of the previous packet of the same player, for every packet
+		last_index = {}
+		for i, uuid in enumerate(uuids):
+			previous.append(last_index.get(uuid.int, -1))
+			last_index[uuid.int] = i
+
+		groups = {} # Open groups by packet body: list of (anchor index, recipient indexes, recipient ids)
+		anchors = {} # Recipient indexes by anchor index
+		consumed = set() # Indexes that were moved into an earlier group
+		for i, body in enumerate(bodies):
+			for anchor, recipients, recipient_ids in groups.get(body, ()):
+				if uuids[i].int not in recipient_ids and previous[i] < anchor:
+					recipients.append(i)
+					recipient_ids.add(uuids[i].int)
+					consumed.add(i)
+					break
+			else:
+				group = (i, [i], {uuids[i].int})
+				groups.setdefault(body, []).append(group)
+				anchors[i] = group[1]
+
+		return [(i, anchors[i]) for i in range(len(bodies)) if i not in consumed]
+
+	def pack(self, entries):
+		"""
+		Args:
+			entries: list of (uuid, packet name, packet data) tuples, in order
+		Returns:
+			bytes: the poem
+		"""
+		names = []
+		payloads = []
+		bodies = []
+		uuids = []
+		for uuid, packet_name, packet_data in entries:
+			names.append(packet_name)
+			payloads.append(packet_data.buff)
+			# TODO: Pass the id instead of the string name to save bandwidth?
+			bodies.append(self.buff_class.pack_string(packet_name) + packet_data.buff) # Prepend packet name to buffer
+			uuids.append(uuid)
+			packet_data.discard() # Buffer is no longer needed
+
+		if self.multicast:
+			groups = self.group(bodies, uuids)
+		else:
+			groups = [(i, [i]) for i in range(len(bodies))]
+
+		records = [] # (flags, recipient uuids, slot, check, index of the packet)
+		if self.reset_pending:
+			records.append((RESET, (), None, None, None))
+			self.reset_pending = False
+
+			# Records the receiver skipped go first, in their order, without references
+			for recipients, packet_name, payload in self.replay:
+				names.append(packet_name)
+				payloads.append(payload)
+				bodies.append(self.buff_class.pack_string(packet_name) + payload)
+				records.append((MULTICAST if len(recipients) > 1 else 0, recipients, None, None, len(bodies) - 1))
+			self.replay = []
+
+		self.reference_hits = self.reference_stores = self.reference_bytes_saved = 0
+		for i, recipients in groups:
+			flags, slot = self.references.lookup(bodies[i]) if self.references else (0, None)
+			if len(recipients) > 1:
+				flags |= MULTICAST
+
+			check = None
+			if flags & REFERENCE:
+				check = hash32(bodies[i])
+				self.reference_hits += 1
+				self.reference_bytes_saved += len(self.buff_class.pack_packet(bodies[i])) - len(self.buff_class.pack_varint(slot)) - 4
+			elif flags & STORE:
+				self.reference_stores += 1
+
+			records.append((flags, [uuids[r] for r in recipients], slot, check, i))
+
+		self.saved = len(entries) - len(groups)
+
+		self.poems += 1
+		if self.references:
+			self.history.append((self.poems, [None if flags & RESET else (recipients, names[i], payloads[i]) for flags, recipients, slot, check, i in records]))
+
+		if self.layout == "columns":
+			return self.pack_columns(records, names, payloads)
+
+		return self.pack_rows(records, bodies)
+
+	def pack_rows(self, records, bodies):
+		"""
+		Packs records one after another
+		Args:
+			records: list of (flags, recipient uuids, slot, check, index of the packet)
+			bodies: packed packets (name + data)
+		Returns:
+			bytes: the poem
+		"""
+		poem = []
+		for flags, recipients, slot, check, i in records:
+			poem.append(bytes((flags,)))
+			if flags & RESET:
+				continue
+
+			if flags & MULTICAST:
+				poem.append(self.buff_class.pack_varint(len(recipients)))
+
+			poem.extend(self.buff_class.pack_uuid(uuid) for uuid in recipients) # Pack uuids of recipients
+
+			if flags & REFERENCE:
+				poem.append(self.buff_class.pack_varint(slot) + self.buff_class.pack("i", check))
+				continue
+
+			if flags & STORE:
+				poem.append(self.buff_class.pack_varint(slot))
+
+			poem.append(self.buff_class.pack_packet(bodies[i])) # Append buffer (as packet for length prefixing)
+
+		return b"".join(poem)
+
+	def pack_columns(self, records, names, payloads):
+		"""
+		Packs every field of the records into its own column, so similar bytes end up next to each other for the compressor
+		Args:
+			records: list of (flags, recipient uuids, slot, check, index of the packet)
+			names: packet names
+			payloads: packet data
+		Returns:
+			bytes: the poem
+		"""
+		pack_varint = self.buff_class.pack_varint
+
+		name_table = {} # Index of every packet name in the name column
+		flags_column, counts, recipients_column, slots, checks, name_indexes, lengths, payloads_column = ([] for _ in range(8))
+		for flags, recipients, slot, check, i in records:
+			flags_column.append(flags)
+			if flags & RESET:
+				continue
+
+			if flags & MULTICAST:
+				counts.append(pack_varint(len(recipients)))
+
+			recipients_column.extend(uuid.bytes for uuid in recipients)
+
+			if flags & (STORE | REFERENCE):
+				slots.append(pack_varint(slot))
+
+			if flags & REFERENCE:
+				checks.append(check)
+				continue
+
+			name_indexes.append(pack_varint(name_table.setdefault(names[i], len(name_table))))
+			lengths.append(pack_varint(len(payloads[i])))
+			payloads_column.append(payloads[i])
+
+		columns = (
+			bytes(flags_column),
+			b"".join(counts),
+			b"".join(recipients_column),
+			b"".join(slots),
+			self.buff_class.pack("{}i".format(len(checks)), *checks), # Big endian, fixed width
+			pack_varint(len(name_table)) + b"".join(self.buff_class.pack_string(name) for name in name_table),
+			b"".join(name_indexes),
+			b"".join(lengths)
+		)
+
+		poem = [bytes((COLUMNS,)), pack_varint(len(flags_column))]
+		for column in columns:
+			poem.append(pack_varint(len(column)))
+			poem.append(column)
+
+		poem.extend(payloads_column) # Payloads are last, their lengths are known
+		return b"".join(poem)
+
+class PoemReader:
+	"""
+	Parses a poem back into packets
+	"""
+	def __init__(self, buff_class, on_miss=None):
+		"""
+		Args:
+			buff_class: buffer class to parse with
+			on_miss: called with the poem number and record index when a reference can't be resolved, it should ask the sender to reset
+		"""
+		self.buff_class = buff_class
+		self.on_miss = on_miss
+		self.references = ReferenceStore()
+		self.poems = 0 # Poems read
+		self.rewinding = False # Whether records are skipped until the reset record, the sender sends them again after it
+		self.misses = 0 # References that couldn't be resolved
+
+	def read(self, data):
+		"""
+		Args:
+			data: the poem
+		Yields:
+			tuple: uuid, packet name and buffer of the packet, once for every recipient
+		"""
+		self.poems += 1
+		if data[:1] == bytes((COLUMNS,)):
+			records = self.read_columns(data)
+		else:
+			records = self.read_rows(data)
+
+		for index, (flags, uuids, slot, check, body, packet_name, payload) in enumerate(records):
+			if flags & RESET:
+				self.references.clear()
+				self.rewinding = False
+				continue
+
+			if self.rewinding: # Sent again after the reset record
+				continue
+
+			if flags & REFERENCE:
+				body = self.references.get(slot, check)
+				if body is None: # Out of sync, this record and everything after it is sent again
+					self.misses += 1
+					self.rewinding = True
+					if self.on_miss:
+						self.on_miss(self.poems, index)
+					continue
+
+				packet_name = None
+			elif flags & STORE:
+				if body is None:
+					body = self.buff_class.pack_string(packet_name) + payload
+				self.references.store(slot, body)
+
+			if packet_name is None: # Split the name from the body
+				packet = self.buff_class(body)
+				packet_name = packet.unpack_string()
+				payload = packet.read()
+
+			for uuid in uuids: # Every recipient gets its own buffer, handlers consume them
+				yield uuid, packet_name, self.buff_class(payload)
+
+	def read_rows(self, data):
+		"""
+		Parses records that were packed one after another
+		Args:
+			data: the poem
+		Returns:
+			list: (flags, uuids, slot, check, body, packet name, payload), the body or the name and payload are None
+		"""
+		buff = self.buff_class(data) # Create buffer
+		records = []
+
+		try:
+			while True: # Unpack data until a bufferunderrun
+				flags = buff.unpack("B")
+				if flags & RESET:
+					records.append((flags, (), None, None, None, None, None))
+					continue
+
+				count = buff.unpack_varint() if flags & MULTICAST else 1
+				uuids = [buff.unpack_uuid() for _ in range(count)]
+
+				slot = check = body = None
+				if flags & (STORE | REFERENCE):
+					slot = buff.unpack_varint()
+
+				if flags & REFERENCE:
+					check = buff.unpack("i")
+				else:
+					body = buff.unpack_packet(self.buff_class).read()
+
+				records.append((flags, uuids, slot, check, body, None, None))
+		except BufferUnderrun:
+			pass
+
+		buff.discard() # Discard when done
+		return records
+
+	def read_columns(self, data):
+		"""
+		Parses records that were packed as columns
+		The header columns are decoded all at once with numpy, payloads are sliced out of the poem without copying it
+		Args:
+			data: the poem
+		Returns:
+			list: (flags, uuids, slot, check, body, packet name, payload), the body is None
+		"""
+		view = memoryview(data)
+		buff = self.buff_class(data)
+		buff.unpack("B") # Layout marker
+		record_count = buff.unpack_varint()
+
+		columns = []
+		for _ in range(8):
+			length = buff.unpack_varint()
+			columns.append(view[buff.pos:buff.pos + length])
+			buff.pos += length
+		payload_offset = buff.pos
+		buff.discard()
+
+		flags_column = np.frombuffer(columns[0], dtype=np.uint8)
+		counts = iter(decode_varints(columns[1]).tolist())
+		recipients = columns[2]
+		slots = iter(decode_varints(columns[3]).tolist())
+		checks = iter(np.frombuffer(columns[4], dtype=">i4").tolist())
+
+		name_buff = self.buff_class(bytes(columns[5]))
+		name_table = [name_buff.unpack_string() for _ in range(name_buff.unpack_varint())]
+		name_indexes = iter(decode_varints(columns[6]).tolist())
+
+		lengths = decode_varints(columns[7])
+		offsets = iter((payload_offset + np.concatenate(([0], np.cumsum(lengths)[:-1]))).tolist() if len(lengths) else [])
+		lengths = iter(lengths.tolist())
+
+		records = []
+		recipient_offset = 0
+		for flags in flags_column[:record_count].tolist():
+			if flags & RESET:
+				records.append((flags, (), None, None, None, None, None))
+				continue
+
+			count = next(counts) if flags & MULTICAST else 1
+			uuids = [UUID(bytes=bytes(recipients[recipient_offset + 16*r:recipient_offset + 16*(r + 1)])) for r in range(count)]
+			recipient_offset += 16*count
+
+			slot = next(slots) if flags & (STORE | REFERENCE) else None
+			if flags & REFERENCE:
+				records.append((flags, uuids, slot, next(checks), None, None, None))
+				continue
+
+			offset = next(offsets)
+			payload = bytes(view[offset:offset + next(lengths)])
+			records.append((flags, uuids, slot, None, None, name_table[next(name_indexes)], payload))
+
+		return records
+
+def decode_varints(data):
+	"""
+	Decodes a column of unsigned varints at once
+	Args:
+		data: bytes of the column
+	Returns:
+		numpy.ndarray: the values
+	"""
+	column = np.frombuffer(data, dtype=np.uint8)
+	if not len(column):
+		return np.zeros(0, dtype=np.int64)
+
+	ends = np.flatnonzero(column < 0x80) # Last byte of every varint
+	starts = np.concatenate(([0], ends[:-1] + 1))
+
+	# Every byte is shifted by 7 bits for each byte before it in its varint
+	positions = np.arange(len(column)) - np.repeat(starts, ends - starts + 1)
+	values = (column & 0x7f).astype(np.int64) << (7*positions)
+
+	return np.bitwise_or.reduceat(values, starts)
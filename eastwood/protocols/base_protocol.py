@@ -28,6 +28,9 @@ class BaseProtocol(Protocol):
 		self.buff_class = buff_class
 		self.config = config
 		self.pers_buff = self.buff_class() # There is a persistant buffer to prevent dropping of incomplete packets
+		self.compression_threshold = -1 # Minecraft packet compression threshold, -1 while compression is off
+		self.inflater = None # HandlerManager that decompresses packet frames off the reactor once compression is on, inline if None
+		self.deflater = None # HandlerManager that compresses and writes packets off the reactor once compression is on, inline if None
 
 		# Determine handle and send direction based off one argument
 		# Note: Send direction means that these packets are never touched by the protocol, just sent
@@ -84,34 +87,53 @@ class BaseProtocol(Protocol):
 			self.pers_buff.save() # At this stage, the buffer has the cursor at the right position, save it
 
 			try:
-				buff = self.pers_buff.unpack_packet(self.buff_class)
+				# Frames are decompressed later by the inflater if there is one
+				buff = self.pers_buff.unpack_packet(self.buff_class, -1 if self.inflater else self.compression_threshold)
 			except BufferUnderrun:
 				# The packet we are trying to unpack is incomplete!
 				# Wait for the next dataRecieved to process packets
 				self.pers_buff.restore() # Revert buffer to the good state
 				break
 
-			# Attempt to identify the packet
-			try:
-				id = buff.unpack_varint()
-				name = self.get_packet_name(id) # The first datavalue in the packet is the identifier
-			except ValueError:
-				self.logger.info("Could not retrieve packet id")
-				self.transport.loseConnection()
-				return
-			except KeyError:
-				self.transport.loseConnection()
-				return
+			if self.inflater and self.compression_threshold >= 0:
+				# Every frame goes through the inflater once compression is on, so packets stay in order
+				self.inflater.add_to_queue(buff.read(), self)
+				continue
 
-			# Dispach the packet to packet handlers
-			buff.save()
-			try:
-				self.packet_received(buff, name)
-			except BufferUnderrun:
-				self.logger.info("Packet is too short: {}".format(name))
-				self.transport.loseConnection()
+			if not self.frame_received(buff):
 				return
 
+	def frame_received(self, buff):
+		"""
+		Identifies and handles an uncompressed packet
+		Args:
+			buff: buffer of the packet id and packet data
+		Returns:
+			bool: whether the connection is still usable
+		"""
+		# Attempt to identify the packet
+		try:
+			id = buff.unpack_varint()
+			name = self.get_packet_name(id) # The first datavalue in the packet is the identifier
+		except ValueError:
+			self.logger.info("Could not retrieve packet id")
+			self.transport.loseConnection()
+			return False
+		except KeyError:
+			self.transport.loseConnection()
+			return False
+
+		# Dispach the packet to packet handlers
+		buff.save()
+		try:
+			self.packet_received(buff, name)
+		except BufferUnderrun:
+			self.logger.info("Packet is too short: {}".format(name))
+			self.transport.loseConnection()
+			return False
+
+		return True
+
 	def dispatch(self, function_name, *args, **kwargs):
 		"""
 		Calls the packet function packet_{*lookup_args} in a module, and returns whether or not the call is successful
@@ -143,7 +165,12 @@ class BaseProtocol(Protocol):
 		"""
 		data = b"".join(data) # Combine data
 		data = self.buff_class.pack_varint(self.get_packet_id(name)) + data # Prepend packet ID
-		data = self.buff_class.pack_packet(data) # Pack data as a packet
+
+		if self.deflater and self.compression_threshold >= 0:
+			self.deflater.add_to_queue(data, self) # Written once compressed, in order with every other packet
+			return
+
+		data = self.buff_class.pack_packet(data, self.compression_threshold) # Pack data as a packet
 
 		self.transport.write(data) # Send
 
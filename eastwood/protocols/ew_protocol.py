@@ -1,13 +1,106 @@
+from collections import Counter, deque
 from quarry.net.protocol import BufferUnderrun
 from twisted.internet import reactor
 
+from eastwood.coalescer import PacketCoalescer
+from eastwood.datagram import EntityOrder
 from eastwood.modules import Module
 from eastwood.non_blocking_io import HandlerManager
 from eastwood.plasma import ParallelAESInterface, ParallelCompressionInterface
+from eastwood.poem import PoemReader, PoemWriter, ReferenceCache
 from eastwood.protocols.base_protocol import BaseProtocol
 from eastwood.ew_packet import packet_ids, packet_names
 
-class EWModule(Module):
+class PoemModule(Module):
+	"""
+	Internal module that sends and parses uncompressed poems
+	"""
+	def compress_and_send(self, data):
+		"""
+		Sends poem data as is
+		"""
+		self.protocol.send_packet("poem", data)
+
+	def packet_recv_poem(self, buff):
+		"""
+		Parses poem packet data as is
+		"""
+		self.parse_packet_recv_poem(buff.read())
+
+	def parse_packet_recv_poem(self, uncompressed_data):
+		"""
+		Parses the poem and dispatches callouts with packet_mc_* callbacks
+		Also forwards the packets afterwards
+		"""
+		self.protocol.stats["poems_received"] += 1
+		self.protocol.stats["poem_bytes_received"] += len(uncompressed_data)
+
+		order = self.protocol.entity_order
+		if order:
+			order.poem_received()
+
+		# Multicast packets are fanned out to every recipient here
+		lane = self.protocol.datagram_lane
+		for uuid, packet_name, packet in self.protocol.poem_reader.read(uncompressed_data):
+			self.protocol.stats["packets_received"] += 1
+
+			if packet_name == "datagram": # Resent datagram packet, which may be stale by now
+				if lane:
+					try:
+						lane.parse_resent_packet(uuid, packet)
+					except BufferUnderrun:
+						pass
+				continue
+
+			if order:
+				order.packet_received(uuid, packet_name, packet.buff)
+
+			self.deliver_packet(uuid, packet_name, packet)
+
+		if lane: # Datagrams that overtook this poem
+			lane.release_held()
+
+	def packet_recv_reference_reset(self, buff):
+		"""
+		The other side missed a reference, the next poem starts with a reset record and the records it skipped
+		"""
+		poem = buff.unpack_varint()
+		if not self.protocol.poem_writer.request_reset(poem, buff.unpack_varint()):
+			self.logger.error("Poem {} to resend after a reference miss isn't kept anymore, dropping link".format(poem))
+			self.protocol.transport.loseConnection()
+
+	def deliver_packet(self, uuid, packet_name, packet):
+		"""
+		Dispatches packet_send_* callbacks on the client a packet is meant for and forwards it
+		Args:
+			uuid: unique id of the client
+			packet_name: name of the packet
+			packet: buffer of the packet
+		"""
+		try:
+			client = self.protocol.get_client(uuid) # Get client
+		except KeyError:
+			return # The client has disconnected already, ignore
+
+		if getattr(client, "held_packets", None) is not None and packet_name not in ("chunk_resend", "light_resend"):
+			client.held_packets.append((packet_name, packet)) # Waiting for a resent packet
+			return
+
+		try: # Attempt to dispatch
+			new_packet = client.dispatch("_".join(("packet", "send", packet_name)), packet)
+		except BufferUnderrun:
+			client.logger.info("Packet is too short: {}".format(packet_name))
+			return
+
+		# If nothing was returned, the packet should be sent as it was originally
+		if not new_packet:
+			new_packet = (packet_name, packet)
+
+		# Forward packet
+		if new_packet[1] != None: # If the buffer is none, it was explictly stated to not send the packet!
+			client.send_packet(new_packet[0], new_packet[1].buff)
+
+class EWModule(PoemModule):
 	"""
 	Internal module that deals with peom compression/decompression
 	"""
@@ -44,52 +137,34 @@ class EWModule(Module):
 		"""
 		self.depression_handler.add_to_queue(buff.read())
 
-	def parse_packet_recv_poem(self, uncompressed_data):
-		"""
-		Parses the poem and dispatches callouts with packet_mc_* callbacks
-		Also forwards the packets afterwards
-		"""
-		buff = self.protocol.buff_class(uncompressed_data) # Create buffer
-
-		try:
-			while True: # Unpack data until a bufferunderrun
-				uuid = buff.unpack_uuid()
-				packet = buff.unpack_packet(self.protocol.buff_class) # Packet is unpacked here as the subclass will just forward it
-				packet_name = packet.unpack_string()
-				packet.save()
-
-				try:
-					client = self.protocol.other_factory.get_client(uuid) # Get client
-				except KeyError:
-					continue # The client has disconnected already, ignore
-
-				try: # Attempt to dispatch
-					new_packet = client.dispatch("_".join(("packet", "send", packet_name)), packet)
-				except BufferUnderrun:
-					client.logger.info("Packet is too short: {}".format(packet_name))
-					continue
-
-				# If nothing was returned, the packet should be sent as it was originally
-				if not new_packet:
-					new_packet = (packet_name, packet)
-
-				# Forward packet
-				if new_packet[1] != None: # If the buffer is none, it was explictly stated to not send the packet!
-					client.send_packet(new_packet[0], new_packet[1].buff)
-		except BufferUnderrun:
-			pass
-
-		buff.discard() # Discard when done
-
 class EWProtocol(BaseProtocol):
 	"""
 	Base class that contains shared functionality between the two proxy's comm protocols
 	Data sent over is buffered and compressed
 	"""
+	poem_module=EWModule # Module that sends and parses poems
+
 	def create(self):
 		self.buffer_wait = self.config["global"]["buffer_ms"]
 		self.password = self.config["global"]["password"] # NOTE: Not used by EWProtocol, its subclasses will handle authentication with it
 		self.secret = self.config["global"]["secret"]
+		self.input_buffer = deque() # Packets waiting to be sent in the next poem
+		self.deferred_packets = Counter() # Packets that aren't ready or sent yet by player, later packets of the player wait for them
+		self.send_call = None # Delayed call for send_buffered_packets
+		self.peer = None # External proxy on the other end, only used by the internal proxy
+		self.stats = Counter() # Traffic counters of this link
+		self.datagram_lane = None # Optional UDP lane for packets that are superseded quickly
+		self.entity_order = EntityOrder(self.buff_class) if self.config["datagram"]["enabled"] else None # Keeps datagrams in order with this link's packets
+
+		# Packets superseded within the same poem are merged before sending
+		coalesce = self.config["poem"]["coalesce"]
+		self.coalescer = PacketCoalescer(self.buff_class, coalesce) if coalesce else None
+
+		# Identical packets for several players are sent once, packets that were sent before are sent as references
+		poem_config = self.config["poem"]
+		references = ReferenceCache(poem_config["reference_slots"], poem_config["reference_min_size"], poem_config["reference_max_size"]) if poem_config["reference_slots"] else None
+		self.poem_writer = PoemWriter(self.buff_class, poem_config["multicast"], references, poem_config["layout"])
+		self.poem_reader = PoemReader(self.buff_class, self.request_reference_reset)
 
 		if self.secret: # Secret can be falsy (empty string)
 			self.encryption_handler = HandlerManager(1,
@@ -108,7 +183,7 @@ class EWProtocol(BaseProtocol):
 												)
 
 	def create_modules(self, modules):
-		super().create_modules((EWModule,) + modules) # Prepend ew module (poem parsing)
+		super().create_modules((self.poem_module,) + modules) # Prepend ew module (poem parsing)
 
 	def connectionMade(self):
 		"""
@@ -116,11 +191,11 @@ class EWProtocol(BaseProtocol):
 		"""
 		self.logger.info("Connected to other proxy!")
 
-		if self.factory.instance: # Only one protocol can exist
+		if len(self.factory.instances) >= self.factory.max_instances: # Only the configured amount of links can exist
 			self.transport.loseConnection()
 			return
 
-		self.factory.instance = self
+		self.factory.instances.append(self)
 
 		# Start handlers
 		if self.secret:
@@ -128,7 +203,7 @@ class EWProtocol(BaseProtocol):
 			self.decryption_handler.start()
 
 		# Run self.send_buffered_packets every self.buffer_wait ms
-		reactor.callLater(self.buffer_wait/1000, self.send_buffered_packets)
+		self.send_call = reactor.callLater(self.buffer_wait/1000, self.send_buffered_packets)
 
 		# Call module handlers
 		super().connectionMade()
@@ -139,8 +214,18 @@ class EWProtocol(BaseProtocol):
 		"""
 		self.logger.info("Lost connection to other proxy! Reason: {}".format(reason))
 
+		if self not in self.factory.instances: # Link was refused, nothing was started
+			return
+
 		# Remove factory instance
-		self.factory.instance = None
+		self.factory.instances.remove(self)
+
+		# Stop sending poems
+		if self.send_call and self.send_call.active():
+			self.send_call.cancel()
+
+		if self.datagram_lane:
+			self.datagram_lane.stop()
 
 		# Stop handlers
 		if self.secret:
@@ -154,6 +239,8 @@ class EWProtocol(BaseProtocol):
 		"""
 		Decrypt the packets
 		"""
+		self.stats["bytes_received"] += len(buff.buff)
+
 		if self.secret:
 			self.decryption_handler.add_to_queue(buff.read(), name)
 			buff.discard()
@@ -213,6 +300,8 @@ class EWProtocol(BaseProtocol):
 		"""
 		Encrypts packet before sending it
 		"""
+		self.stats["bytes_sent"] += sum(len(d) for d in data)
+
 		if self.secret:
 			self.encryption_handler.add_to_queue(b"".join(data), name)
 		else:
@@ -225,27 +314,119 @@ class EWProtocol(BaseProtocol):
 		"""
 		super().send_packet(name, data)
 
+	def get_client(self, uuid):
+		"""
+		Gets the client a packet in a received poem is meant for
+		Args:
+			uuid: unique id of client
+		Returns:
+			protocol: protocol of client
+		"""
+		return self.other_factory.get_client(uuid)
+
+	def request_reference_reset(self, poem, index):
+		"""
+		A reference in a received poem couldn't be resolved, the other side has to start its cache over and send the rest again
+		Args:
+			poem: number of the poem with the reference
+			index: index of its record
+		"""
+		self.stats["reference_misses"] += 1
+		self.logger.warning("Reference cache out of sync, resetting")
+		self.send_packet("reference_reset", self.buff_class.pack_varint(poem), self.buff_class.pack_varint(index))
+
+	def buffer_packet(self, uuid, packet_name, packet_data):
+		"""
+		Adds a packet to the next poem
+		Args:
+			uuid: unique id of the client the packet belongs to
+			packet_name: name of the packet
+			packet_data: buffer of the packet
+		"""
+		lane = self.datagram_lane
+		if lane and lane.addr and packet_name in lane.packets and not self.deferred_packets[uuid.int]: # Only once the other side's address is known, and nothing of the player is held
+			if lane.buffer_packet(uuid, packet_name, packet_data):
+				return
+
+		if self.entity_order:
+			self.entity_order.packet_buffered(uuid, packet_name, packet_data.buff)
+		self.input_buffer.append((uuid, packet_name, packet_data))
+
+	def buffer_deferred(self, uuid, deferred):
+		"""
+		Adds a packet that is still being worked on off the reactor to the next poem
+		Packets of the same player buffered after it are held back until it is ready, so they stay in order
+		Args:
+			uuid: unique id of the client the packet belongs to
+			deferred: Deferred that fires with the packet name and buffer
+		"""
+		entry = [uuid, None, None] # Filled in once the packet is ready
+
+		def packet_ready(packet):
+			entry[1], entry[2] = packet
+			return packet
+
+		deferred.addCallback(packet_ready)
+		self.input_buffer.append(entry)
+		self.deferred_packets[uuid.int] += 1
+
 	def send_buffered_packets(self):
 		"""
-		Sends all packets in self.input_buffer to the other proxy as a poem
+		Sends a poem every self.buffer_wait ms
+		Every link has its own buffer, so players on other links are never held up by this one
 		"""
 		# Schedule the next call
-		reactor.callLater(self.buffer_wait/1000, self.send_buffered_packets)
+		self.send_call = reactor.callLater(self.buffer_wait/1000, self.send_buffered_packets)
+
+		self.send_poem()
+
+	def send_poem(self):
+		"""
+		Sends all packets in self.input_buffer to the other proxy as a poem
+		Packets of a player that come after one of its packets that isn't ready yet stay in the buffer
+		"""
+		entries = []
+		if self.deferred_packets:
+			held = set() # Players with a packet that isn't ready yet
+			waiting = deque()
+			for entry in self.input_buffer:
+				uuid = entry[0].int
+				if uuid in held or entry[1] is None:
+					held.add(uuid)
+					waiting.append(entry)
+					continue
+
+				if type(entry) is list: # Entry of buffer_deferred, which is filled in once the packet is ready
+					self.deferred_packets[uuid] -= 1
+					if not self.deferred_packets[uuid]:
+						del self.deferred_packets[uuid]
+				entries.append(tuple(entry))
+
+			self.input_buffer = waiting
+		else:
+			entries = list(self.input_buffer)
+			self.input_buffer.clear()
 
-		if len(self.factory.input_buffer) < 1: # Do not send empty packets
+		if len(entries) < 1: # Do not send empty packets
 			return
 
-		poem = []
-		for i in range(len(self.factory.input_buffer)): # Per packet info
-			uuid, packet_name, packet_data = self.factory.input_buffer.popleft()
+		if self.entity_order: # Before coalescing, merged packets still go in this poem
+			self.entity_order.poem_sent(entries)
 
-			# TODO: Pass the id instead of the string name to save bandwidth?
-			buff = self.buff_class.pack_string(packet_name) + packet_data.buff # Prepend packet name to buffer
+		if self.coalescer:
+			packet_count = len(entries)
+			entries = self.coalescer.coalesce(entries)
+			self.stats["packets_coalesced"] += packet_count - len(entries)
 
-			poem.append(self.buff_class.pack_uuid(uuid)) # Pack uuid of client
-			poem.append(self.buff_class.pack_packet(buff)) # Append buffer (as packet for length prefixing)
+		poem = self.poem_writer.pack(entries)
 
-			packet_data.discard() # Buffer is no longer needed
+		self.stats["poems_sent"] += 1
+		self.stats["packets_sent"] += len(entries)
+		self.stats["packets_multicast"] += self.poem_writer.saved
+		self.stats["reference_hits"] += self.poem_writer.reference_hits
+		self.stats["reference_stores"] += self.poem_writer.reference_stores
+		self.stats["reference_bytes_saved"] += self.poem_writer.reference_bytes_saved
 
 		# Compress poem and send
-		self.dispatch("compress_and_send", b"".join(poem))
+		self.stats["poem_bytes_sent"] += len(poem)
+		self.dispatch("compress_and_send", poem)
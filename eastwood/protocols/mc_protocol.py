@@ -12,6 +12,9 @@ class MCProtocol(BaseProtocol):
 		self.protocol_version = self.config["global"]["protocol_version"]
 		self.protocol_mode = "init"
 		self.uuid = UUID.random() # UUID can be overriden
+		self.link = None # EWProtocol link this client's packets travel over
+		self.inflater = self.factory.inflater
+		self.deflater = self.factory.deflater
 
 	def connectionMade(self):
 		# Assign uuid to self
@@ -37,8 +40,9 @@ class MCProtocol(BaseProtocol):
 			new_packet = (name, buff)
 
 		# Intercept packet here
-		# Append it to the buffer list
-		self.other_factory.input_buffer.append((self.uuid, *new_packet))
+		# Append it to the buffer list of the link
+		if new_packet[1] is not None: # If the buffer is none, it was explictly stated to not send the packet!
+			self.link.buffer_packet(self.uuid, *new_packet)
 
 	def get_packet_name(self, id):
 		"""
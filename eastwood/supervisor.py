@@ -0,0 +1,95 @@
+"""
+Pre-forks worker processes and restarts them if they crash
+"""
+import logging
+from multiprocessing import get_context
+from twisted.internet import reactor, task
+from twisted.python import log
+
+def setup_logging():
+	"""
+	Same logging setup as eastwood.py, spawned workers don't inherit it
+	"""
+	observer = log.PythonLoggingObserver()
+	observer.start()
+	logging.getLogger().setLevel(logging.INFO)
+
+class WorkerSupervisor:
+	"""
+	Keeps a fixed amount of worker processes running alongside the reactor
+	"""
+	def __init__(self, name, target, num_workers, args=(), check_interval=1):
+		"""
+		Args:
+			name: name of the workers, used for logging and process names
+			target: function ran by each worker, called with the worker index followed by args
+			num_workers: amount of workers to keep running
+			args: args to pass to target after the worker index
+			check_interval: how often to check on workers, in seconds
+		"""
+		self.logger = logging.getLogger(name=self.__class__.__name__)
+		self.logger.setLevel(logging.INFO)
+
+		# Workers are spawned instead of forked so they don't inherit this process' reactor and listeners
+		self.context = get_context("spawn")
+
+		self.name = name
+		self.target = target
+		self.num_workers = num_workers
+		self.args = args
+		self.check_interval = check_interval
+		self.on_restart = None # Called with the worker index before a crashed worker is restarted
+
+		self.workers = [None] * num_workers
+		self.checker = task.LoopingCall(self.check_workers)
+
+	def start(self):
+		"""
+		Starts all workers and begins watching them
+		"""
+		for index in range(self.num_workers):
+			self.spawn(index)
+
+		self.checker.start(self.check_interval, now=False)
+		reactor.addSystemEventTrigger("before", "shutdown", self.stop)
+
+	def spawn(self, index):
+		"""
+		Starts a worker
+		Args:
+			index: index of the worker
+		"""
+		process = self.context.Process(target=self.target, args=(index, *self.args), name="{}-{}".format(self.name, index))
+		process.start()
+		self.workers[index] = process
+
+		self.logger.info("Started {} worker #{} (pid {})".format(self.name, index, process.pid))
+
+	def check_workers(self):
+		"""
+		Restarts workers that have exited
+		"""
+		for index, process in enumerate(self.workers):
+			if process.is_alive():
+				continue
+
+			self.logger.warning("{} worker #{} exited with code {}, restarting".format(self.name, index, process.exitcode))
+			if self.on_restart:
+				self.on_restart(index)
+
+			self.spawn(index)
+
+	def stop(self):
+		"""
+		Stops all workers, called when the reactor shuts down
+		"""
+		if self.checker.running:
+			self.checker.stop()
+
+		for process in self.workers:
+			if process and process.is_alive():
+				process.terminate()
+
+		for process in self.workers:
+			if process:
+				process.join(timeout=5)
@@ -0,0 +1,102 @@
+import matplotlib.pyplot as plt
+import numpy as np
+import os, sqlite3, tempfile, time
+from bincache import Cache
+
+CHUNKS = 100000
+CHUNK_SIZE = 2048 # About the size of a compressed chunk
+LOOKUPS = 200 # The unindexed table scans every row per lookup, both layouts get the same keys
+BATCH = 256
+GCTIME = 4 # Seconds between the old bincache's commits
+
+def make_keys(count):
+	return [(x*1000 + z).to_bytes(8, "big") for x in range(count // 1000 + 1) for z in range(1000)][:count]
+
+def zipf_lookups(keys, count):
+	"""
+	Players mostly walk around the same chunks, a few keys get most of the lookups
+	"""
+	rng = np.random.RandomState(0)
+	return [keys[i % len(keys)] for i in rng.zipf(1.3, count)]
+
+def old_layout(path, keys, data, lookups):
+	"""
+	The table bincache used before: no primary key, every write and lookup runs the gc, which commits every GCTIME seconds
+	"""
+	connection = sqlite3.connect(path)
+	cursor = connection.cursor()
+	cursor.execute('CREATE TABLE elements (identifier BLOB, accessed INTEGER, data BLOB);')
+	cursor.execute('CREATE INDEX idx_elements_accessed ON elements (accessed);')
+	last_gc = time.time()
+
+	def regcall():
+		nonlocal last_gc
+		if time.time() - last_gc > GCTIME:
+			cursor.execute('DELETE FROM elements WHERE accessed IN (SELECT accessed FROM elements ORDER BY accessed DESC LIMIT -1 OFFSET {0});'.format(CHUNKS))
+			connection.commit()
+			last_gc = time.time()
+
+	s = time.time()
+	for key in keys:
+		cursor.execute('INSERT INTO elements (identifier, accessed, data) VALUES (?, ?, ?);', (key, time.time(), data))
+		regcall()
+	connection.commit()
+	insert_time = (time.time() - s) / len(keys)
+
+	s = time.time()
+	for key in lookups:
+		cursor.execute('SELECT * FROM elements WHERE identifier = ?', (key,))
+		cursor.fetchone()
+		cursor.execute('UPDATE elements SET accessed = ? where identifier = ?', (time.time(), key))
+		regcall()
+	connection.commit()
+	get_time = (time.time() - s) / len(lookups)
+
+	connection.close()
+	return insert_time, get_time, get_time # No bulk reads
+
+def new_layout(path, keys, data, lookups):
+	cache = Cache(capacity=CHUNKS*CHUNK_SIZE*2, path=path, batch=BATCH, hot_bytes=16*1024*1024)
+
+	s = time.time()
+	for i in range(0, len(keys), BATCH):
+		cache.put_many((key, data) for key in keys[i:i+BATCH])
+	cache.commit()
+	insert_time = (time.time() - s) / len(keys)
+
+	s = time.time()
+	for key in lookups:
+		cache.get(key)
+	cache.commit()
+	get_time = (time.time() - s) / len(lookups)
+
+	cache.hot.clear() # Bulk reads from sqlite only
+	cache.hot_size = 0
+	s = time.time()
+	for i in range(0, len(lookups), BATCH):
+		cache.get_many(lookups[i:i+BATCH])
+	cache.commit()
+	get_many_time = (time.time() - s) / len(lookups)
+
+	return insert_time, get_time, get_many_time
+
+keys = make_keys(CHUNKS)
+data = os.urandom(CHUNK_SIZE)
+lookups = zipf_lookups(keys, LOOKUPS)
+
+results = {}
+with tempfile.TemporaryDirectory() as directory:
+	for name, layout in (('unindexed', old_layout), ('bincache', new_layout)):
+		results[name] = [t * 1000000 for t in layout(os.path.join(directory, name + '.db'), keys, data, lookups)]
+		print('{}: {:.1f} us/insert, {:.1f} us/get, {:.1f} us/key get_many'.format(name, *results[name]))
+
+labels = ['insert', 'get', 'get_many']
+positions = np.arange(len(labels))
+plt.bar(positions - 0.2, results['unindexed'], 0.4, label='unindexed')
+plt.bar(positions + 0.2, results['bincache'], 0.4, label='bincache')
+plt.xticks(positions, labels)
+plt.yscale('log')
+plt.title('{} cached chunks of {} B'.format(CHUNKS, CHUNK_SIZE))
+plt.ylabel('time per key (us)')
+plt.legend()
+plt.show()
@@ -0,0 +1,67 @@
+import matplotlib.pyplot as plt
+import numpy as np
+from collections import OrderedDict, defaultdict
+from cache_manager import CacheManager
+
+PULLS = 200000
+CAPACITIES = [256, 512, 1024, 2048, 4096]
+THRESHOLD = 5 # The default in the config
+
+def make_trace(count):
+	"""
+	Players mostly pull chunks around spawn and their bases (zipf), while explorers pull chunks nobody comes back to
+	"""
+	rng = np.random.RandomState(0)
+	popular = rng.zipf(1.2, count) % 50000
+	explored = 100000 + np.arange(count) # Never pulled twice
+	trace = np.where(rng.random_sample(count) < 0.3, explored, popular)
+	return [int(key).to_bytes(8, "big") for key in trace]
+
+def threshold_lru(trace, capacity):
+	"""
+	The old policy: cache a chunk once it was pulled more than threshold times, evict the least recently used one
+	"""
+	tracker = defaultdict(int)
+	cached = OrderedDict()
+	hits = 0
+	for key in trace:
+		if key in cached:
+			cached.move_to_end(key)
+			hits += 1
+			continue
+
+		tracker[key] += 1
+		if tracker[key] > THRESHOLD:
+			cached[key] = None
+			if len(cached) > capacity:
+				cached.popitem(last=False)
+
+	return hits / len(trace), len(tracker)
+
+def tiny_lfu(trace, capacity):
+	manager = CacheManager(capacity, THRESHOLD)
+	hits = 0
+	for key in trace:
+		if manager.record(0, key):
+			hits += 1
+		else:
+			manager.admit(0, key)
+
+	return hits / len(trace), manager.sketch.width * len(manager.sketch.rows)
+
+trace = make_trace(PULLS)
+results = ([], [])
+for capacity in CAPACITIES:
+	(old_rate, tracked), (new_rate, counters) = threshold_lru(trace, capacity), tiny_lfu(trace, capacity)
+	results[0].append(old_rate)
+	results[1].append(new_rate)
+	print('capacity {}: threshold {:.1%} hit rate ({} tracked chunks), tinylfu {:.1%} hit rate ({} sketch counters)'.format(capacity, old_rate, tracked, new_rate, counters))
+
+plt.plot(CAPACITIES, results[0], label='threshold + lru')
+plt.plot(CAPACITIES, results[1], label='tinylfu')
+plt.xscale('log')
+plt.title('{} pulls'.format(PULLS))
+plt.xlabel('cached chunks')
+plt.ylabel('hit rate')
+plt.legend()
+plt.show()
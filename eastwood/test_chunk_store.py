@@ -0,0 +1,103 @@
+import matplotlib.pyplot as plt
+import numpy as np
+import os, sys, time
+import zstandard as zstd
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # chunk_store imports from the eastwood package
+from quarry.types.buffer import Buffer1_14 as Buffer
+from quarry.types.nbt import TagCompound, TagRoot
+from bincache import Cache
+from chunk_store import ChunkStore
+from chunk_transcoder import pack_indices
+
+CHUNK_COUNTS = [256, 1024, 4096]
+LEVEL = 3
+RELOADED = 0.25 # Share of the chunks that are stored again after a few block changes
+WORLDS = {"terrain": (0.01, 4), "flat": (0, 0)} # Share of stone that is ore and how much the surface height varies
+
+def make_section(rng, cy, height, palette, ore_rate):
+	"""
+	A 16x16x16 section of stone with scattered ores under dirt and grass, air above
+	"""
+	bits = 4
+	y = np.arange(cy*16, cy*16 + 16)[:, None, None]
+	blocks = np.where(y < height - 3, 1, np.where(y < height, 2, np.where(y == height, 3, 0)))
+	if cy > 0: # The bottom section is the same everywhere, ores only show up higher
+		ores = (rng.random_sample(blocks.shape) < ore_rate) & (blocks == 1)
+		blocks[ores] = rng.randint(4, len(palette), ores.sum())
+
+	indices = blocks.ravel() # y, z, x order
+	return b"".join((
+		Buffer.pack("HB", int((indices != 0).sum()), bits),
+		Buffer.pack_varint(len(palette)), *[Buffer.pack_varint(p) for p in palette],
+		Buffer.pack_varint(bits*64), pack_indices(indices, bits, bits*64)
+	))
+
+def make_column(rng, cx, cz, world):
+	"""
+	Column data (everything in chunk_data after the full chunk bool) of a terrain-like chunk
+	"""
+	ore_rate, hills = WORLDS[world]
+	palette = list(range(0, 64, 4)) # air, stone, dirt, grass, then ores
+	heightmaps = Buffer.pack_nbt(TagRoot({"": TagCompound({})}))
+	height = 60 + (np.sin(np.arange(16)[:, None] / 5 + cx) * hills + np.cos(np.arange(16)[None, :] / 7 + cz) * hills).astype(int) # z, x
+
+	column = b"".join(make_section(rng, cy, height, palette, ore_rate) for cy in range(5)) + Buffer.pack("i"*256, *[1]*256)
+	return b"".join((Buffer.pack_varint(0b11111), heightmaps, Buffer.pack_varint(len(column)), column, Buffer.pack_varint(0)))
+
+def change_block(rng, column):
+	"""
+	Flips a byte in the top section, like a block change does
+	"""
+	column = bytearray(column)
+	column[-1100 - rng.randint(1000)] ^= 1
+	return bytes(column)
+
+def ptest(count, world):
+	"""
+	Stores the same chunks in both caches
+	Returns:
+		tuple: compressed bytes of whole columns and of the section store, seconds spent storing each
+	"""
+	rng = np.random.RandomState(0)
+	side = int(count ** 0.5)
+	items = [(Buffer.pack("ii", cx, cz), make_column(rng, cx, cz, world)) for cx in range(side) for cz in range(side)]
+	items += [(key, change_block(rng, data)) for key, data in items[:int(len(items) * RELOADED)]]
+
+	compressor = zstd.ZstdCompressor(level=LEVEL)
+	whole = Cache(capacity=2**40) # How chunks were cached before the section store
+	s = time.time()
+	for key, data in items:
+		whole.insert(key, compressor.compress(data))
+	whole.commit()
+	whole_time = time.time() - s
+
+	store = ChunkStore(elements=count * 2, level=LEVEL, buff_class=Buffer)
+	s = time.time()
+	store.insert_many(items)
+	store_time = time.time() - s
+	assert all(store.get(key) == data for key, data in items[len(items) - count:])
+
+	store.cursor.execute("SELECT COALESCE(SUM(length(data)), 0) FROM sections;")
+	section_bytes = store.cursor.fetchone()[0]
+	store.cursor.execute("SELECT SUM(length(head) + COALESCE(length(sections), 0) + length(tail)) FROM chunks;")
+	chunk_bytes = store.cursor.fetchone()[0]
+	print('{} {} chunks: {}'.format(count, world, store.get_stats()))
+
+	return whole.size, section_bytes + chunk_bytes, whole_time, store_time
+
+for world in WORLDS:
+	results = ([], [])
+	for count in CHUNK_COUNTS:
+		whole, sections, whole_time, store_time = ptest(count, world)
+		results[0].append(whole)
+		results[1].append(sections)
+		print('{} {} chunks: {} B whole columns, {} B sections, {:.1f}% smaller, {:.2f} ms/chunk whole, {:.2f} ms/chunk sections'.format(count, world, whole, sections, (1 - sections / whole) * 100, whole_time / count * 1000, store_time / count * 1000))
+
+	plt.plot(CHUNK_COUNTS, results[0], label='{}, whole columns'.format(world))
+	plt.plot(CHUNK_COUNTS, results[1], label='{}, content addressed sections'.format(world))
+
+plt.title('Cache footprint (zstd level {})'.format(LEVEL))
+plt.xlabel('chunks')
+plt.ylabel('compressed bytes')
+plt.legend()
+plt.show()
@@ -0,0 +1,99 @@
+import matplotlib.pyplot as plt
+import numpy as np
+import plasma, time
+from quarry.data.packets import packet_idents
+from quarry.types.buffer import Buffer1_14 as Buffer
+from quarry.types.nbt import TagCompound, TagRoot
+from chunk_transcoder import pack_indices, rebuild_chunk, transcode_chunk
+
+x = plasma.ParallelCompressionInterface()
+
+LEVELS = [1, 3, 9, 15, 22]
+SYNTHETIC_CHUNKS = 64
+algo = x
+
+def load_chunks():
+	"""
+	Captured traffic is a stream of uncompressed minecraft packets (varint length, varint id, data)
+	"""
+	chunk_id = packet_idents[(498, "play", "downstream", "chunk_data")]
+	buff = Buffer(open('./testdata/packet_samples.bin', 'rb').read())
+	chunks = []
+	try:
+		while True:
+			packet = buff.unpack_packet(Buffer)
+			if packet.unpack_varint() == chunk_id:
+				chunks.append(packet.read())
+	except Exception:
+		pass
+
+	return chunks
+
+def make_chunks(count):
+	"""
+	Terrain-like full chunks: stone with scattered ores under dirt and grass, air above
+	"""
+	rng = np.random.RandomState(0)
+	palette = list(range(0, 160, 4)) # air, stone, dirt, grass, then ores
+	heightmaps = Buffer.pack_nbt(TagRoot({"": TagCompound({})}))
+	chunks = []
+	for cx in range(count):
+		height = 60 + (np.sin(np.arange(16)[:, None] / 5 + cx) * 4 + np.cos(np.arange(16)[None, :] / 7) * 4).astype(int) # z, x
+
+		sections = []
+		for cy in range(5):
+			size = rng.choice([8, 20, 40]) # Blocks in the section palette
+			bits = max(4, int(size - 1).bit_length())
+
+			y = np.arange(cy*16, cy*16 + 16)[:, None, None]
+			blocks = np.where(y < height - 3, 1, np.where(y < height, 2, np.where(y == height, 3, 0)))
+			ores = (rng.random_sample(blocks.shape) < 0.02) & (blocks == 1)
+			blocks[ores] = rng.randint(4, size, ores.sum())
+
+			indices = blocks.ravel() # y, z, x order
+			sections.append(b"".join((
+				Buffer.pack("HB", int((indices != 0).sum()), bits),
+				Buffer.pack_varint(size), *[Buffer.pack_varint(p) for p in palette[:size]],
+				Buffer.pack_varint(bits*64), pack_indices(indices, bits, bits*64)
+			)))
+
+		column = b"".join(sections) + Buffer.pack("i"*256, *[1]*256)
+		chunks.append(b"".join((Buffer.pack("ii?", cx, 0, True), Buffer.pack_varint(0b11111), heightmaps, Buffer.pack_varint(len(column)), column, Buffer.pack_varint(0))))
+
+	return chunks
+
+def ptest(chunks, level):
+	raw = transcoded = 0
+	for chunk in chunks:
+		raw += len(algo.compress(chunk, level))
+		transcoded += len(algo.compress(transcode_chunk(Buffer, chunk) or chunk, level)) # Chunks that can't be transcoded are sent as is
+
+	return raw, transcoded
+
+chunks = load_chunks()
+if not chunks:
+	print('No chunk_data in the capture, using {} synthetic chunks'.format(SYNTHETIC_CHUNKS))
+	chunks = make_chunks(SYNTHETIC_CHUNKS)
+
+s = time.time()
+transcoded_chunks = [transcode_chunk(Buffer, chunk) for chunk in chunks]
+transcode_time = time.time() - s
+s = time.time()
+assert all(rebuild_chunk(Buffer, new) == old for new, old in zip(transcoded_chunks, chunks) if new)
+rebuild_time = time.time() - s
+print('{:.2f} ms/chunk transcode, {:.2f} ms/chunk rebuild'.format(transcode_time / len(chunks) * 1000, rebuild_time / len(chunks) * 1000))
+
+results = ([], [])
+for level in LEVELS:
+	raw, transcoded = ptest(chunks, level)
+	results[0].append(raw)
+	results[1].append(transcoded)
+	print('level {}: {} B raw, {} B transcoded, {:.1f}% smaller'.format(level, raw, transcoded, (1 - transcoded / raw) * 100))
+
+plt.plot(LEVELS, results[0], label='bit packed')
+plt.plot(LEVELS, results[1], label='transcoded')
+plt.title('Algo: '+str(repr(algo)))
+plt.xlabel('compression level')
+plt.ylabel('compressed size (B)')
+plt.legend()
+plt.show()
@@ -0,0 +1,50 @@
+import matplotlib.pyplot as plt
+import numpy as np
+from duplicate_filter import DuplicateFilter
+
+WINDOW = 100 # Clock ticks, whole numbers keep the boundary exact
+OFFSETS = range(0, 2*WINDOW + 1, 5) # When the packet is first seen, in ticks after the filter started
+AGES = range(0, 2*WINDOW + 1) # How long after that it is seen again, in ticks
+
+class Clock:
+	def __init__(self):
+		self.now = 0
+
+	def __call__(self):
+		return self.now
+
+def is_found(offset, age):
+	"""
+	Sees a packet offset ticks after the filter started, and again age ticks later
+	Other packets are checked in between, so generations rotate like they do under traffic
+	"""
+	clock = Clock()
+	packets = DuplicateFilter(WINDOW, clock=clock)
+
+	clock.now = offset
+	assert not packets.is_duplicate(0, b"packet")
+	for step in range(offset, offset + age, 7):
+		clock.now = step
+		packets.is_duplicate(0, b"filler %d" % step)
+
+	clock.now = offset + age
+	return packets.is_duplicate(0, b"packet")
+
+found = np.array([[is_found(offset, age) for age in AGES] for offset in OFFSETS])
+
+# A packet is a duplicate for exactly one window after it was first seen, wherever the rotations fall
+for i, offset in enumerate(OFFSETS):
+	for j, age in enumerate(AGES):
+		assert found[i, j] == (age <= WINDOW), "seen {} ticks into the filter, again {} ticks later".format(offset, age)
+print('{} first sightings x {} ages: duplicates found for exactly one window'.format(len(OFFSETS), len(AGES)))
+
+# Different keys never collide
+packets = DuplicateFilter(WINDOW, clock=Clock())
+assert not packets.is_duplicate(0, b"packet") and not packets.is_duplicate(-1, b"packet") and packets.is_duplicate(0, b"packet")
+print(packets.get_stats())
+
+plt.imshow(found, aspect='auto', origin='lower', extent=(AGES[0], AGES[-1], OFFSETS[0], OFFSETS[-1]))
+plt.title('Duplicates found (window {} ticks)'.format(WINDOW))
+plt.xlabel('age (ticks)')
+plt.ylabel('first seen (ticks after start)')
+plt.show()
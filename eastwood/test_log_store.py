@@ -0,0 +1,61 @@
+import matplotlib.pyplot as plt
+import numpy as np
+import os, tempfile
+from log_store import LogStore
+
+KEYS = 15
+ROUNDS = 200
+WRITES = 8 # Chunks written per round
+SEGMENT_BYTES = 4096 # Small segments, so they are compacted and dropped often
+CAPACITY = 6144
+
+def open_store(path):
+	return LogStore(capacity=CAPACITY, path=path, gctime=0, segment_bytes=SEGMENT_BYTES)
+
+def churn(path):
+	"""
+	Writes, removes and evicts chunks like the chunk cacher does, and reopens the store after every round
+	Every chunk that was removed or evicted must stay gone after a restart, the others must read back as written
+	Returns:
+		tuple: segments and chunks after every round
+	"""
+	rng = np.random.RandomState(0)
+	keys = [i.to_bytes(8, "big") for i in range(KEYS)]
+	stored = {} # What the store should have by key
+	segments, chunks = [], []
+
+	store = open_store(path)
+	for _ in range(ROUNDS):
+		items = []
+		for key in rng.choice(len(keys), WRITES):
+			data = rng.bytes(rng.randint(100, 400)) # Doesn't compress, so segments fill up
+			items.append((keys[key], data))
+			stored[keys[key]] = data
+
+		evicted = store.insert_many(items)
+		removed = set(evicted) | {keys[key] for key in rng.choice(len(keys), 2)} # Evicted chunks and chunks that were uncached
+		store.destroy_many(removed)
+		for key in removed:
+			stored.pop(key, None)
+
+		del store # Restart
+		store = open_store(path)
+		for key in keys:
+			data = store.get(key)
+			assert data == stored.get(key), "{} came back after a restart".format(int.from_bytes(key, "big")) if data else "{} was lost".format(int.from_bytes(key, "big"))
+
+		segments.append(len(store.segments))
+		chunks.append(len(store.index))
+
+	return segments, chunks
+
+with tempfile.TemporaryDirectory() as directory:
+	segments, chunks = churn(os.path.join(directory, "chunks"))
+	print('{} restarts: no removed chunk came back, {} segments at most'.format(ROUNDS, max(segments)))
+
+plt.plot(range(ROUNDS), segments, label='segments')
+plt.plot(range(ROUNDS), chunks, label='chunks')
+plt.title('Log store across restarts ({} keys)'.format(KEYS))
+plt.xlabel('round')
+plt.legend()
+plt.show()
@@ -0,0 +1,81 @@
+import matplotlib.pyplot as plt
+import plasma, random, time
+from quarry.data.packets import packet_idents
+from quarry.types.buffer import Buffer1_14 as Buffer
+from quarry.types.uuid import UUID
+from poem import PoemReader, PoemWriter
+
+x = plasma.ParallelCompressionInterface()
+
+PLAYERS = 20
+POEM_SIZES = [16, 32, 64, 128, 256, 512]
+LAYOUTS = ["rows", "columns"]
+LEVEL = 3
+algo = x
+
+def load_packets():
+	"""
+	Captured traffic is a stream of uncompressed minecraft packets (varint length, varint id, data)
+	"""
+	names = {ident: key[3] for key, ident in packet_idents.items() if key[:3] == (498, "play", "downstream")}
+	buff = Buffer(open('./testdata/packet_samples.bin', 'rb').read())
+	packets = []
+	try:
+		while True:
+			packet = buff.unpack_packet(Buffer)
+			packets.append((names[packet.unpack_varint()], packet.read()))
+	except Exception:
+		pass
+
+	return packets
+
+def make_poems(packets, size):
+	random.seed(0)
+	players = [UUID.random() for _ in range(PLAYERS)]
+	return [
+		[(random.choice(players), name, data) for name, data in packets[i:i+size]]
+		for i in range(0, len(packets), size)
+	]
+
+def ptest(layout, poems):
+	writer = PoemWriter(Buffer, multicast=False, layout=layout)
+	reader = PoemReader(Buffer)
+
+	raw = compressed = 0
+	decode_time = 0
+	for poem in poems:
+		data = writer.pack([(uuid, name, Buffer(payload)) for uuid, name, payload in poem])
+		raw += len(data)
+		compressed += len(algo.compress(data, LEVEL))
+
+		s = time.time()
+		for _ in reader.read(data):
+			pass
+		decode_time += time.time() - s
+
+	return raw, compressed, decode_time
+
+packets = load_packets()
+results = {layout: ([], [], []) for layout in LAYOUTS}
+for size in POEM_SIZES:
+	poems = make_poems(packets, size)
+	for layout in LAYOUTS:
+		raw, compressed, decode_time = ptest(layout, poems)
+		results[layout][0].append(raw)
+		results[layout][1].append(compressed)
+		results[layout][2].append(decode_time / len(packets) * 1000 * 1000 * 1000)
+		print('{} packets/poem, {}: {} B raw, {} B compressed, {:.0f} ns/packet decode'.format(size, layout, raw, compressed, results[layout][2][-1]))
+
+plt.subplot(2, 1, 1)
+for layout in LAYOUTS:
+	plt.plot(POEM_SIZES, results[layout][1], label=layout)
+plt.title('Algo: '+str(repr(algo)))
+plt.ylabel('compressed size (B)')
+plt.legend()
+
+plt.subplot(2, 1, 2)
+for layout in LAYOUTS:
+	plt.plot(POEM_SIZES, results[layout][2], label=layout)
+plt.xlabel('packets per poem')
+plt.ylabel('decode time per packet (ns)')
+plt.show()